@@ -0,0 +1,185 @@
+import torch
+import numpy as np
+import h5py
+import sys
+import time
+import logging
+
+from lofar_tools import *
+
+log = logging.getLogger()
+
+# Microbenchmarks for the data pipeline and models
+# usage: python benchmarks.py <benchmark> [arguments]
+#  reader filename SAP [nbase] : VisibilityReader vs h5py hyperslab reads
+#  sampler filename SAP [nbase] : random vs chunk aligned baseline selection
+#  compact filename SAP [nbase] : memory of float32 vs int8+scales minibatch
+#  graph filename SAP [batch_size] : GCN training nodes/s, full batch vs neighbour sampling (needs torch_geometric)
+#  latents filename SAP [nbase] [model_dir] : FLOPs and time per patch, AutoEncoderCascade forward vs latents
+
+########################################################
+def _timeit(fn,repeats=3):
+  # best wall clock time of repeats calls of fn()
+  best=float('inf')
+  for ci in range(repeats):
+    tic=time.perf_counter()
+    fn()
+    best=min(best,time.perf_counter()-tic)
+  return best
+
+########################################################
+def bench_reader(filename,SAP,nbase=64,num_channels=4):
+  # compare reading nbase random baselines (all channels needed by num_channels)
+  # using per-call h5py hyperslabs (g[mybase,:,:,ci,0]) vs VisibilityReader
+  pols=[0,1,2,3] if num_channels==8 else [0,3]
+  f=h5py.File(filename,'r')
+  g=f['measurement']['saps'][SAP]['visibilities']
+  h=f['measurement']['saps'][SAP]['visibility_scale_factors']
+  (nb,ntime,nfreq,npol,ncomplex)=g.shape
+  baselinelist=np.random.randint(0,nb,nbase)
+
+  def h5py_path():
+    for mybase in baselinelist:
+      for ci in pols:
+        h[mybase,:,ci]
+        g[mybase,:,:,ci,0]
+        g[mybase,:,:,ci,1]
+
+  reader=VisibilityReader(filename,SAP)
+  def reader_path():
+    for mybase in baselinelist:
+      reader.read_scales(mybase)
+      reader.read_baseline(mybase)
+
+  def reader_batch_path():
+    reader.read_scales(baselinelist)
+    reader.read_baselines(baselinelist)
+
+  nbytes=nbase*ntime*nfreq*npol*ncomplex
+  print(f"{filename} SAP {SAP}: layout {reader.mode}, chunks {g.chunks}, {nbase} baselines of {ntime}x{nfreq}")
+  for name,fn in [('h5py hyperslab',h5py_path),('reader per baseline',reader_path),('reader batched',reader_batch_path)]:
+    t=_timeit(fn)
+    print(f"  {name:24s} {1e3*t/nbase:8.3f} ms/baseline {nbytes/t/1e6:10.1f} MB/s")
+  reader.close()
+
+########################################################
+def bench_sampler(filename,SAP,nbase=96,niter=10):
+  # effective read rate (MB/s) of minibatches of nbase baselines
+  # selected uniformly vs in runs aligned with the HDF5 chunks
+  reader=VisibilityReader(filename,SAP)
+  (nb,ntime,nfreq,npol,ncomplex)=reader.shape
+  run_length=reader.chunks[0] if reader.chunks else 1
+  print(f"{filename} SAP {SAP}: layout {reader.mode}, chunks {reader.chunks}, {nbase} of {nb} baselines")
+  for name,rl in [('uniform',1),('chunk aligned',run_length)]:
+    reader.bytes_read=0
+    reader.read_time=0.0
+    for ci in range(niter):
+      reader.read_baselines(sample_baselines(nb,nbase,rl))
+    print(f"  {name:24s} {reader.bytes_read/reader.read_time/1e6:10.1f} MB/s")
+  reader.close()
+
+########################################################
+def bench_compact(filename,SAP,nbase=96,patch_size=128,num_channels=4):
+  # memory used by a full minibatch as float32 patches vs CompactPatches
+  # and time to dequantize on the device
+  np.random.seed(0)
+  patchx,patchy,y,uv=get_data_minibatch([filename],[SAP],batch_size=nbase,patch_size=patch_size,num_channels=num_channels,normalize_data=True,uvdist=True)
+  np.random.seed(0)
+  _,_,yc,_=get_data_minibatch([filename],[SAP],batch_size=nbase,patch_size=patch_size,num_channels=num_channels,normalize_data=True,uvdist=True,compact=True)
+  nfloat=y.numel()*y.element_size()
+  ncompact=yc.nbytes()
+  print(f"{filename} SAP {SAP}: {nbase} baselines, {y.shape[0]} patches of {patch_size}x{patch_size}")
+  print(f"  float32 {nfloat/1e6:10.1f} MB")
+  print(f"  compact {ncompact/1e6:10.1f} MB ({nfloat/ncompact:.2f}x smaller)")
+  print(f"  dequantize {1e3*_timeit(lambda: yc.dequantize(mydevice)):8.2f} ms, max error {(yc.dequantize(mydevice)-y).abs().max().item():e}")
+
+########################################################
+def bench_graph(filename,SAP,batch_size=512,num_neighbors=(10,10),nepoch=3,nfeat=288,nlabel=10):
+  # GCN training throughput (baselines per second) on the line graph of a SAP
+  # with random features: full batch (as train_graph.py) vs LineGraphSampler minibatches
+  from torch_geometric.nn import GCNConv
+  from lofar_graph import get_line_graph, LineGraphSampler
+  class GCN(torch.nn.Module):
+    def __init__(self):
+      super(GCN,self).__init__()
+      self.conv1=GCNConv(nfeat,4)
+      self.conv2=GCNConv(4,nlabel)
+    def forward(self,x,edge_index):
+      return self.conv2(self.conv1(x,edge_index).relu(),edge_index)
+
+  B,edge_index=get_line_graph(filename,SAP)
+  nbase=B.shape[0]
+  x=torch.randn(nbase,nfeat)
+  y=torch.randn(nbase,nlabel)
+  edge_index=torch.from_numpy(edge_index)
+  print(f"{filename} SAP {SAP}: {nbase} baselines, {B.shape[1]} stations, {edge_index.shape[1]} edges")
+  criterion=torch.nn.MSELoss()
+
+  gnet=GCN()
+  optimizer=torch.optim.Adam(gnet.parameters(),lr=0.01)
+  def full_batch():
+    optimizer.zero_grad()
+    loss=criterion(gnet(x,edge_index),y)
+    loss.backward()
+    optimizer.step()
+  t=_timeit(full_batch,nepoch)
+  print(f"  {'full batch':24s} {nbase/t:12.1f} nodes/s")
+
+  sampler=LineGraphSampler([(B,x,y)],num_neighbors=num_neighbors,batch_size=batch_size)
+  def minibatch():
+    for xb,eb,yb,nseed in sampler:
+      optimizer.zero_grad()
+      loss=criterion(gnet(xb,eb)[:nseed],yb[:nseed])
+      loss.backward()
+      optimizer.step()
+  t=_timeit(minibatch,nepoch)
+  print(f"  {'neighbour sampling':24s} {nbase/t:12.1f} nodes/s")
+
+########################################################
+def bench_latents(filename,SAP,nbase=16,model_dir=None):
+  # FLOPs and inference time per patch of the scoring workloads:
+  # full cascade (reconstructions and latents) vs latents only
+  # (trained models of score_server.py from model_dir, random weights if not given)
+  from torch.utils.flop_counter import FlopCounterMode
+  from score_server import load_models, L, Lt, use_rica, patch_size, num_in_channels
+  from lofar_models import AutoEncoderCNN2, AutoEncoder1DCNN, AutoEncoderCascade
+  if model_dir:
+    cascade,mod=load_models(model_dir,device=mydevice)
+  else:
+    harmonic_scales=torch.tensor([1e-4, 1e-3, 1e-2, 1e-1]).to(mydevice)
+    cascade=AutoEncoderCascade(AutoEncoderCNN2(latent_dim=L,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica),
+      AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica),
+      AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica)).to(mydevice)
+    cascade.eval()
+  patchx,patchy,x,uv=get_data_for_baselines(filename,SAP,np.arange(nbase),patch_size=patch_size,num_channels=num_in_channels,uvdist=True,device=mydevice)
+  npatch=x.shape[0]
+  print(f"{filename} SAP {SAP}: {nbase} baselines, {npatch} patches of {patch_size}x{patch_size}")
+  with torch.no_grad():
+    Mu=cascade(x,uv)[3]
+    print(f"  max |Mu(forward)-Mu(latents)| {(Mu-cascade.latents(x,uv)).abs().max().item():e}")
+    result=dict()
+    for name,fn in [('forward',lambda: cascade(x,uv)),('latents',lambda: cascade.latents(x,uv))]:
+      counter=FlopCounterMode(display=False)
+      with counter:
+        fn()
+      flops=counter.get_total_flops()/npatch
+      t=_timeit(fn)/npatch
+      result[name]=(flops,t)
+      print(f"  {name:24s} {flops/1e6:10.1f} MFLOP/patch {1e3*t:8.3f} ms/patch")
+  print(f"  reduction {result['forward'][0]/result['latents'][0]:.2f}x FLOPs, {result['forward'][1]/result['latents'][1]:.2f}x time")
+
+########################################################
+if __name__=='__main__':
+  if len(sys.argv)<2:
+    print('usage: python benchmarks.py reader|sampler|compact|graph|latents filename SAP [nbase] [model_dir]')
+    sys.exit(1)
+  if sys.argv[1]=='reader':
+    bench_reader(sys.argv[2],sys.argv[3],nbase=int(sys.argv[4]) if len(sys.argv)>4 else 64)
+  elif sys.argv[1]=='sampler':
+    bench_sampler(sys.argv[2],sys.argv[3],nbase=int(sys.argv[4]) if len(sys.argv)>4 else 96)
+  elif sys.argv[1]=='compact':
+    bench_compact(sys.argv[2],sys.argv[3],nbase=int(sys.argv[4]) if len(sys.argv)>4 else 96)
+  elif sys.argv[1]=='graph':
+    bench_graph(sys.argv[2],sys.argv[3],batch_size=int(sys.argv[4]) if len(sys.argv)>4 else 512)
+  elif sys.argv[1]=='latents':
+    bench_latents(sys.argv[2],sys.argv[3],nbase=int(sys.argv[4]) if len(sys.argv)>4 else 16,model_dir=sys.argv[5] if len(sys.argv)>5 else None)
@@ -0,0 +1,92 @@
+import time
+import logging
+
+from sklearn.manifold import TSNE
+from sklearn.decomposition import PCA
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans
+from sklearn.neighbors import kneighbors_graph
+from sklearn.preprocessing import StandardScaler
+
+log = logging.getLogger()
+
+# Final stage of evaluate_clustering: low dimensional embedding (for plotting)
+# and hard clustering of the baselines, using the per baseline distances
+# to the K-harmonic centroids (nbase x Kc) as features.
+# Exact t-SNE and average linkage clustering are quadratic in the number of
+# baselines (time and memory), so the method is selected by input size:
+#  embedding : t-SNE (Barnes-Hut, PCA initialised) up to tsne_limit points, PCA above
+#  clustering : average linkage up to exact_limit points,
+#     average linkage constrained to the k-nearest neighbour graph up to connectivity_limit points,
+#     minibatch k-means above
+
+tsne_limit=20000 # max points for t-SNE
+exact_limit=5000 # max points for unconstrained agglomerative clustering
+connectivity_limit=50000 # max points for connectivity constrained agglomerative clustering
+n_neighbors=15 # neighbours in the connectivity graph
+
+########################################################
+def embed(X,n_components=2,method='auto',random_state=99,verbose=False):
+  # X: npoints x nfeatures
+  # method: 'auto','tsne','pca' or 'none'
+  # return npoints x n_components embedding, None if method=='none'
+  (npoints,nfeat)=X.shape
+  if method=='auto':
+    method='tsne' if npoints<=tsne_limit else 'pca'
+  tic=time.perf_counter()
+  if method=='none':
+    return None
+  elif method=='tsne':
+    # perplexity has to be smaller than the number of points
+    perplexity=min(30.0,max(1.0,(npoints-1)/3))
+    tsne=TSNE(n_components=n_components,method='barnes_hut',init='pca',
+       learning_rate='auto',perplexity=perplexity,random_state=random_state,verbose=verbose)
+    X_emb=tsne.fit_transform(X)
+  elif method=='pca':
+    pca=PCA(n_components=min(n_components,nfeat,npoints),random_state=random_state)
+    X_emb=pca.fit_transform(X)
+  else:
+    raise ValueError(f"Unknown embedding method {method}")
+  log.info(f"[embed] {method} of {npoints} points in {time.perf_counter()-tic:.2f} s.")
+  return X_emb
+
+########################################################
+def final_clustering(X,n_clusters,method='auto',random_state=99):
+  # X: npoints x nfeatures
+  # method: 'auto','average','connectivity' or 'minibatch'
+  # return labels (npoints,) in 0..n_clusters-1
+  (npoints,_)=X.shape
+  n_clusters=min(n_clusters,npoints)
+  if method=='auto':
+    if npoints<=exact_limit:
+      method='average'
+    elif npoints<=connectivity_limit:
+      method='connectivity'
+    else:
+      method='minibatch'
+  tic=time.perf_counter()
+  if method=='average':
+    db=AgglomerativeClustering(linkage='average',n_clusters=n_clusters).fit(X)
+  elif method=='connectivity':
+    # sparse kNN graph: linkage only merges neighbouring clusters, memory O(npoints*n_neighbors)
+    connectivity=kneighbors_graph(X,n_neighbors=min(n_neighbors,npoints-1),include_self=False)
+    db=AgglomerativeClustering(linkage='average',n_clusters=n_clusters,connectivity=connectivity).fit(X)
+  elif method=='minibatch':
+    db=MiniBatchKMeans(n_clusters=n_clusters,batch_size=4096,n_init=3,random_state=random_state).fit(X)
+  else:
+    raise ValueError(f"Unknown clustering method {method}")
+  log.info(f"[final_clustering] {method} of {npoints} points in {time.perf_counter()-tic:.2f} s.")
+  return db.labels_
+
+########################################################
+def cluster_stage(X,n_clusters,embedding='auto',clustering='auto',random_state=99,verbose=False):
+  # X: npoints x nfeatures (baselines x distances)
+  # embedding: see embed(), 'none' to only get labels
+  # clustering: see final_clustering()
+  # clustering is done on the standardized embedding, or
+  # on the standardized features if the embedding is skipped
+  # return X_emb (None if skipped), labels
+  X_emb=embed(X,method=embedding,random_state=random_state,verbose=verbose)
+  scaler=StandardScaler()
+  X_embsc=scaler.fit_transform(X_emb if X_emb is not None else X)
+  labels=final_clustering(X_embsc,n_clusters,method=clustering,random_state=random_state)
+  return X_emb,labels
@@ -5,13 +5,15 @@ import h5py
 
 import torch.fft
 
-from sklearn.manifold import TSNE
 from matplotlib import pyplot as plt
 import seaborn as sns
 sns.set(rc={'figure.figsize':(11.7,8.27)})
 
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.preprocessing import StandardScaler
+from cluster_stage import cluster_stage
+from image_export import *
+from score_store import ScoreWriter
+from latent_store import LatentStore, checkpoint_hash
+from station_health import StationHealth, one_hot
 
 # Load pre-trained model to evaluate clustering for given LOFAR dataset
 
@@ -24,9 +26,28 @@ Ko=10 # final hard clusters
 use_rica=True
 
 patch_size=128
+inference_stride=patch_size//2 # patch stride at inference (patch_size//2 as in training)
+baseline_batch=16 # number of baselines passed through the models at once
+save_residual_maps=False # save per pixel residual maps of all baselines (residual.npy)
+score_file='scores.h5' # per baseline distances, cluster, loss, mean latent and reconstruction error (see score_store.py)
+station_health_file='stations.csv' # per station mean distances and cluster fractions (see station_health.py), None: do not save
+latent_store_file='latents.h5' # latents of all patches, to rescore with new centroids (see latent_store.py), None: do not save
+
+# final stage: embedding 'auto','tsne','pca','none' (skip, only labels)
+# clustering 'auto','average','connectivity','minibatch' (see cluster_stage.py)
+final_embedding='auto'
+final_clustering='auto'
 
 # enable this to create psuedocolor images using all XX and YY
 colour_output=True
+# images are written in the background, number of threads
+image_workers=4
+# max images rendered per cluster (reconstructions: per K-harmonic cluster, spectrograms: per final cluster), None: all
+exemplars_per_cluster=None
+# write the spectrograms of each final cluster tiled into mosaics (cluster<k>_<page>.png) of this many images, None: one file per baseline
+mosaic_size=64
+# memory (bytes) to keep rendered spectrograms from the scoring pass, baselines not kept are read again
+image_cache_bytes=2**30
 
 from lofar_tools import *
 from lofar_models import *
@@ -67,58 +88,112 @@ sap_list=['0', '0', '1', '1', '2', '1', '2', '0', '1', '2', '0', '1', '2', '1',
 
 which_sap=-16 # valid in file_list/sap_list -7
 
-# get nbase,nfreq,ntime,npol,ncomplex
-nbase,nfreq,ntime,npol,ncomplex=get_metadata(file_list[which_sap],sap_list[which_sap])
+# get nbase,ntime,nfreq,npol,ncomplex
+baselines,(nbase,ntime,nfreq,npol,ncomplex)=get_metadata(file_list[which_sap],sap_list[which_sap],give_baseline=True)
 
 X=np.zeros([Kc,nbase],dtype=np.float64)
 clusid=np.zeros(nbase,dtype=np.float64)
 
-# iterate over each baselines
+cascade=AutoEncoderCascade(net,net1D1,net1D2)
+if save_residual_maps:
+  # per pixel norm (over channels) of x-xrecon, stitched from the overlapping patches
+  residual_maps=np.lib.format.open_memmap('residual.npy',mode='w+',dtype=np.float32,shape=(nbase,ntime,nfreq))
+
+writer=ImageWriter(num_workers=image_workers)
+def render_baselines(x):
+  # N x num_in_channels x ntime x nfreq spectrograms -> N x (3 or 1) x ntime x nfreq images,
+  # each normalized by its own mean,std (so the result is the same for raw and normalized data)
+  if colour_output:
+    return channels_to_rgb(x)
+  xstd,xmean=torch.std_mean(x[:,0].reshape(x.shape[0],-1),dim=1)
+  return (x[:,0:1]-xmean.view(-1,1,1,1))/xstd.view(-1,1,1,1)
+# rendered spectrograms (uint8) of the baselines, keyed by baseline
+image_cache=dict()
+cache_bytes=0
+# reconstructions rendered per K-harmonic cluster
+nrendered=np.zeros(Kc,dtype=np.int64)
+
+sas_id=int(h5py.File(file_list[which_sap],'r')['measurement/sas_id'][0])
+scores=ScoreWriter(score_file,K=Kc,latent_dim=L+Lt+Lt)
+# rows of an earlier run of this observation are replaced
+scores.remove(sas_id,sap_list[which_sap])
+if station_health_file:
+  # columns: mean distance to each centroid, fraction of baselines in each cluster
+  stations=StationHealth(baselines,2*Kc)
+if latent_store_file:
+  latents=LatentStore(latent_store_file,checkpoint_hash(['./net.model','./netT.model','./netF.model']),latent_dim=L+Lt+Lt)
+  stored=set(latents.stored_baselines(sas_id,sap_list[which_sap]))
+
+# iterate over baselines, baseline_batch at a time
 with torch.no_grad():
-  for nb in range(nbase):
-   patchx,patchy,x,uvcoords=get_data_for_baseline(file_list[which_sap],sap_list[which_sap],baseline_id=nb,patch_size=128,num_channels=num_in_channels,uvdist=True)
-   x=x.cpu() # send to cpu
-   uv=uvcoords.cpu()
-   # get latent variable
-   x1,mu=net(x,uv)
-   x11=(x-x1)/2
-   # vectorize
-   iy1=torch.flatten(x11,start_dim=2,end_dim=3)
-   iy2=torch.flatten(torch.transpose(x11,2,3),start_dim=2,end_dim=3)
-   yy1,yy1mu=net1D1(iy1,uv)
-   yy2,yy2mu=net1D2(iy2,uv)
-   x2=yy1.view_as(x)
-   x3=torch.transpose(yy2.view_as(x),2,3)
-   # reconstruction
-   xrecon=x1+x2+x3
-   if not colour_output:
-    torchvision.utils.save_image( torch.cat((torch.cat((x[0,1],x1[0,1])),
-     torch.cat((x2[0,1],x3[0,1]))
-     ),1).data, 'xx_'+str(nb)+'.png' )
-   else:
-    x0=channel_to_rgb(x[0])
-    xhat0=channel_to_rgb(x1[0])
-    y1D1=channel_to_rgb(x2[0,0:4])
-    y1D2=channel_to_rgb(x3[0,0:4])
-    xrec=channel_to_rgb(xrecon[0,0:4])
-    xerr=channel_to_rgb(x[0,0:4]-xrecon[0,0:4])
-    print("norm x=%f xhat=%f"%(torch.linalg.norm(x0),
-       torch.linalg.norm(xhat0)))
-    torchvision.utils.save_image( torch.cat((torch.cat((x0,xhat0),1),
-       torch.cat((y1D1,y1D2),1),torch.cat((xrec,xerr),1)),
-       2).data, 'xx_'+str(nb)+'.png' )
-   Mu=torch.cat((mu,yy1mu,yy2mu),1)
-   kdist=mod(Mu)
-   (nbatch,_)=Mu.shape
-   dist=torch.zeros(Kc)
-   for ck in range(Kc):
-     for cn in range(nbatch):
-       dist[ck]=dist[ck]+torch.sum(torch.pow(torch.linalg.norm(Mu[cn,:]-mod.M[ck,:],2),Khp))
-   dist=dist/nbatch 
-   X[:,nb]=dist.detach().numpy()
-   (values,indices)=torch.min(dist.view(Kc,1),0)
-   print('%d %e %d'%(nb,kdist,indices[0])) 
-   clusid[nb]=indices[0]
+  for nb0 in range(0,nbase,baseline_batch):
+   baselinelist=np.arange(nb0,min(nbase,nb0+baseline_batch))
+   patchx,patchy,xb,uvb=get_data_for_baselines(file_list[which_sap],sap_list[which_sap],baselinelist,patch_size=patch_size,num_channels=num_in_channels,uvdist=True,stride=inference_stride,device='cpu')
+   # get latent variables and reconstructions for all patches of all baselines
+   x1b,x2b,x3b,Mub=cascade(xb,uvb)
+   if save_residual_maps:
+     err=stitch_patches(xb-(x1b+x2b+x3b),patchx,patchy,stride=inference_stride,out_shape=(ntime,nfreq))
+     residual_maps[baselinelist]=torch.linalg.norm(err,dim=1).numpy()
+   npatch=patchx*patchy
+   # mean distance (^Khp) of the patches of each baseline to each centroid
+   distb=mod.group_mean(mod.distances(Mub),npatch)
+   X[:,baselinelist]=distb.t().numpy()
+   clusid[baselinelist]=torch.argmin(distb,dim=1).numpy()
+   nbb=len(baselinelist)
+   kharmonic=mod.group_mean(mod.harmonic_mean(Mub).view(-1,1),npatch)[:,0]/(Kc*mod.latent_dim)
+   recon_error=torch.mean(torch.pow(xb-(x1b+x2b+x3b),2).view(nbb,-1),dim=1)
+   scores.append(sas_id,sap_list[which_sap],baselinelist,distb.numpy(),clusid[baselinelist],
+      kharmonic.numpy(),mod.group_mean(Mub,npatch).numpy(),recon_error.numpy())
+   if station_health_file:
+     stations.update(baselinelist,np.hstack((distb.numpy(),one_hot(clusid[baselinelist],Kc))))
+   if latent_store_file:
+     # only baselines not yet in the store (a rerun may batch them differently)
+     new=np.array([cb for cb,nb in enumerate(baselinelist) if nb not in stored],dtype=np.int64)
+     if new.shape[0]>0:
+       rows=(new[:,None]*npatch+np.arange(npatch)).reshape(-1)
+       latents.append(sas_id,sap_list[which_sap],baselinelist[new],Mub.numpy()[rows],npatch,recon_error.numpy()[new])
+       stored.update(baselinelist[new].tolist())
+   # spectrograms of this batch, to reuse for the final cluster images
+   # (only if the patches cover the full baseline, otherwise the edges are missing)
+   if cache_bytes<image_cache_bytes and (patchx-1)*inference_stride+patch_size>=ntime and (patchy-1)*inference_stride+patch_size>=nfreq:
+     xs=stitch_patches(xb,patchx,patchy,stride=inference_stride,out_shape=(ntime,nfreq))
+     rgb=render_baselines(xs)
+     for cb,nb in enumerate(baselinelist):
+       if cache_bytes<image_cache_bytes:
+         image_cache[nb]=to_uint8(rgb[cb])
+         cache_bytes+=image_cache[nb].numel()
+   for cb,nb in enumerate(baselinelist):
+    x=xb[cb*npatch:(cb+1)*npatch]
+    x1=x1b[cb*npatch:(cb+1)*npatch]
+    x2=x2b[cb*npatch:(cb+1)*npatch]
+    x3=x3b[cb*npatch:(cb+1)*npatch]
+    # reconstruction
+    xrecon=x1+x2+x3
+    if exemplars_per_cluster is not None and nrendered[int(clusid[nb])]>=exemplars_per_cluster:
+     pass
+    elif not colour_output:
+     nrendered[int(clusid[nb])]+=1
+     writer.save( torch.cat((torch.cat((x[0,1],x1[0,1])),
+      torch.cat((x2[0,1],x3[0,1]))
+      ),1).data, 'xx_'+str(nb)+'.png' )
+    else:
+     nrendered[int(clusid[nb])]+=1
+     (x0,xhat0,y1D1,y1D2,xrec,xerr)=channels_to_rgb(torch.stack((x[0],x1[0],x2[0,0:4],
+        x3[0,0:4],xrecon[0,0:4],x[0,0:4]-xrecon[0,0:4])))
+     print("norm x=%f xhat=%f"%(torch.linalg.norm(x0),
+        torch.linalg.norm(xhat0)))
+     writer.save( torch.cat((torch.cat((x0,xhat0),1),
+        torch.cat((y1D1,y1D2),1),torch.cat((xrec,xerr),1)),
+        2).data, 'xx_'+str(nb)+'.png' )
+    print('%d %e %d'%(nb,kharmonic[cb],clusid[nb]))
+
+scores.close()
+if station_health_file:
+  stations.save(station_health_file,header='station,baselines,'+','.join(['dist'+str(ck) for ck in range(Kc)]+['frac'+str(ck) for ck in range(Kc)])+',zscore',cols=np.arange(Kc))
+if latent_store_file:
+  latents.close()
+if save_residual_maps:
+  residual_maps.flush()
 
 # subtract mean from each row of X
 for ck in range(Kc):
@@ -127,39 +202,50 @@ for ck in range(Kc):
 mydict={'X':X}
 savemat('X.mat',mydict)
 
-### tSNE
-tsne=TSNE(n_components=2,random_state=99,verbose=True)
-X_emb=tsne.fit_transform(X.transpose())
-uniq=np.unique(clusid)
-snsplot=sns.scatterplot(x=X_emb[:,0], y=X_emb[:,1], hue=clusid, legend='full',
-  palette = sns.color_palette("bright", n_colors=len(uniq)))
-snsplot.figure.savefig('scatter.png')
-
-### final clustering
-scaler=StandardScaler()
-X_embsc=scaler.fit_transform(X_emb)
-db=AgglomerativeClustering(linkage='average',n_clusters=Ko).fit(X_embsc)
-#db=DBSCAN(eps=0.3).fit(X_embsc)
-# Number of clusters in labels, ignoring noise if present.
-n_clusters_ = len(set(db.labels_)) - (1 if -1 in db.labels_ else 0)
-
-unique_labels = set(db.labels_)
-colors = [plt.cm.Spectral(each)
-  for each in np.linspace(0, 1, len(unique_labels))]
-for k, col in zip(unique_labels, colors):
-  class_member_mask = (db.labels_ == k)
-  xy = X_emb[class_member_mask]
-  plt.plot(xy[:, 0], xy[:, 1], 'o', markerfacecolor=tuple(col),
-    markeredgecolor='k', markersize=14)
-
-plt.legend(labels=np.unique(db.labels_))
-plt.title('Number of clusters: %d' % n_clusters_)
-plt.savefig('clusters.png')
+### embedding and final clustering
+X_emb,labels=cluster_stage(X.transpose(),Ko,embedding=final_embedding,clustering=final_clustering,verbose=True)
+if X_emb is not None:
+  uniq=np.unique(clusid)
+  snsplot=sns.scatterplot(x=X_emb[:,0], y=X_emb[:,1], hue=clusid, legend='full',
+    palette = sns.color_palette("bright", n_colors=len(uniq)))
+  snsplot.figure.savefig('scatter.png')
 
-
-for nb in range(nbase):
+# Number of clusters in labels, ignoring noise if present.
+n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
+
+if X_emb is not None:
+  unique_labels = set(labels)
+  colors = [plt.cm.Spectral(each)
+    for each in np.linspace(0, 1, len(unique_labels))]
+  for k, col in zip(unique_labels, colors):
+    class_member_mask = (labels == k)
+    xy = X_emb[class_member_mask]
+    plt.plot(xy[:, 0], xy[:, 1], 'o', markerfacecolor=tuple(col),
+      markeredgecolor='k', markersize=14)
+
+  plt.legend(labels=np.unique(labels))
+  plt.title('Number of clusters: %d' % n_clusters_)
+  plt.savefig('clusters.png')
+
+
+def baseline_image(nb):
+ # rendered spectrogram of baseline nb, from the scoring pass if kept, else read again
+ if nb in image_cache:
+  return image_cache[nb]
  vis=get_data_for_baseline_flat(file_list[which_sap],sap_list[which_sap],baseline_id=nb,num_channels=num_in_channels)
- if not colour_output:
-  torchvision.utils.save_image(vis[0,0].data, 'b'+str(db.labels_[nb])+'_'+str(nb)+'.png')
- else:
-  torchvision.utils.save_image(channel_to_rgb(vis[0]), 'b'+str(db.labels_[nb])+'_'+str(nb)+'.png')
+ # same clipping as get_data_for_baselines()
+ vis.clamp_(-1e6,1e6)
+ return to_uint8(render_baselines(vis)[0])
+
+exemplars=sample_exemplars(labels,exemplars_per_cluster)
+if not mosaic_size:
+ for nb in exemplars:
+  writer.save(baseline_image(nb), 'b'+str(labels[nb])+'_'+str(nb)+'.png')
+else:
+ for k in np.unique(labels):
+  members=exemplars[labels[exemplars]==k]
+  for page,ci in enumerate(range(0,members.shape[0],mosaic_size)):
+   images=torch.stack([baseline_image(nb) for nb in members[ci:ci+mosaic_size]])
+   writer.save(make_mosaic(images), 'cluster'+str(k)+'_'+str(page)+'.png')
+
+writer.close()
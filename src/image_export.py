@@ -0,0 +1,97 @@
+import torch
+import torchvision
+import numpy as np
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+log = logging.getLogger()
+
+# Background export of diagnostic images (evaluate_clustering).
+# PNG encoding is slow compared to scoring, so images are handed over to
+# a small thread pool. The queue of pending images is bounded, so the
+# scoring loop only blocks when the writers fall behind (and memory stays bounded).
+
+########################################################
+def to_uint8(img):
+  # img: 3 x nx x ny (or 1 x nx x ny) float image, values in [0,1] are displayed
+  # return the same image as uint8 (exactly what save_image() would write)
+  # 4x smaller than float32, used to keep rendered images in memory
+  return img.detach().mul(255).add_(0.5).clamp_(0,255).to('cpu',torch.uint8)
+
+########################################################
+def _write_image(img,filename):
+  if img.dtype==torch.uint8:
+    # C x nx x ny -> nx x ny x C
+    arr=img.permute(1,2,0).numpy()
+    if arr.shape[2]==1:
+      arr=arr[:,:,0]
+    Image.fromarray(arr).save(filename)
+  else:
+    torchvision.utils.save_image(img,filename)
+
+########################################################
+class ImageWriter(object):
+  """
+  Write images to disk in a thread pool.
+
+  num_workers: number of encoding threads
+  max_pending: max images queued or being written, save() blocks when reached
+  """
+  def __init__(self,num_workers=4,max_pending=64):
+    self.pool=ThreadPoolExecutor(max_workers=num_workers)
+    self.slots=threading.BoundedSemaphore(max_pending)
+    self.errors=list()
+    self.written=0
+
+  def save(self,img,filename):
+    # img: float image (as torchvision.utils.save_image()) or uint8 image from to_uint8()
+    # the image is copied, so the caller can reuse/modify it after this returns
+    self.slots.acquire()
+    img=img.detach().to('cpu',copy=True)
+    future=self.pool.submit(_write_image,img,filename)
+    future.add_done_callback(self._done)
+
+  def _done(self,future):
+    self.slots.release()
+    if future.exception():
+      self.errors.append(future.exception())
+    else:
+      self.written+=1
+
+  def close(self):
+    # wait for all pending images, raise the first error (if any)
+    self.pool.shutdown(wait=True)
+    log.info(f"[ImageWriter] wrote {self.written} images, {len(self.errors)} errors.")
+    if self.errors:
+      raise self.errors[0]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,traceback):
+    self.close()
+
+########################################################
+def make_mosaic(images,nrow=8,padding=2):
+  # images: N x C x nx x ny (float or uint8), all of the same size
+  # return one image with the images tiled nrow per row
+  return torchvision.utils.make_grid(images,nrow=nrow,padding=padding,pad_value=255 if images.dtype==torch.uint8 else 1.0)
+
+########################################################
+def sample_exemplars(labels,n_per_cluster=None,seed=0):
+  # labels: (npoints,) cluster labels
+  # n_per_cluster: max number of points to select from each cluster, None: all
+  # return sorted indices of the selected points
+  labels=np.asarray(labels)
+  if n_per_cluster is None:
+    return np.arange(labels.shape[0])
+  rng=np.random.default_rng(seed)
+  selected=list()
+  for k in np.unique(labels):
+    members=np.flatnonzero(labels==k)
+    if members.shape[0]>n_per_cluster:
+      members=rng.choice(members,n_per_cluster,replace=False)
+    selected.append(members)
+  return np.sort(np.concatenate(selected))
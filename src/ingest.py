@@ -0,0 +1,197 @@
+import torch
+import numpy as np
+import sqlite3
+import fnmatch
+import glob
+import os
+import sys
+import time
+import logging
+
+from lofar_tools import *
+from score_store import ScoreWriter
+from score_server import load_models, Kc, L, Lt, patch_size, num_in_channels
+
+log = logging.getLogger()
+
+# Incremental ingest: watch a data directory for new L*.MS_extract.h5 files,
+# score all baselines of their valid SAPs (same checks as get_fileSAP())
+# and append the results to a score file (score_store.py).
+# Progress is kept in a sqlite database, so observations (sas_id) are only
+# processed once (as get_dataset_map(), files with the same sas_id are duplicates)
+# and a restart resumes after the last completed file: the rows of an
+# interrupted file are removed from the score file and it is processed again.
+# New files are found with inotify (if the optional inotify_simple package
+# is installed), otherwise by polling the directory.
+
+pattern='L*.MS_extract.h5'
+poll_interval=30 # seconds between directory scans (polling, or as a safety net with inotify)
+settle_time=10 # seconds a file must be unchanged before it is ingested (still being copied otherwise)
+baseline_batch=16 # number of baselines scored at once
+
+########################################################
+class IngestState(object):
+  """
+  Persistent ingest progress (sqlite).
+  files: path, sas_id, status (running, done, duplicate, invalid, failed),
+   first row in the score file, rows written, time
+
+  filename: (str) sqlite database
+  """
+  def __init__(self,filename):
+    self.db=sqlite3.connect(filename)
+    self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, sas_id INTEGER, status TEXT, row0 INTEGER, nrows INTEGER, updated REAL)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS files_sas_id ON files (sas_id)')
+    self.db.commit()
+
+  def status(self,path):
+    row=self.db.execute('SELECT status FROM files WHERE path=?',(path,)).fetchone()
+    return row[0] if row else None
+
+  def sas_done(self,sas_id):
+    return self.db.execute("SELECT 1 FROM files WHERE sas_id=? AND status='done'",(sas_id,)).fetchone() is not None
+
+  def interrupted(self):
+    # files that were being processed when the last run stopped : (path,row0)
+    return self.db.execute("SELECT path,row0 FROM files WHERE status='running'").fetchall()
+
+  def set(self,path,sas_id,status,row0=None,nrows=None):
+    self.db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?)',(path,sas_id,status,row0,nrows,time.time()))
+    self.db.commit()
+
+########################################################
+def score_range(filename,SAP,first,last,cascade,mod,scores,sas_id=None,device='cpu'):
+  # score baselines first..last-1 of a SAP, append to scores (ScoreWriter)
+  # return number of rows written
+  if sas_id is None:
+    sas_id=get_sas_id(filename)
+  with torch.no_grad():
+    for nb0 in range(first,last,baseline_batch):
+      baselinelist=np.arange(nb0,min(last,nb0+baseline_batch))
+      patchx,patchy,x,uv=get_data_for_baselines(filename,SAP,baselinelist,patch_size=patch_size,num_channels=num_in_channels,uvdist=True,device=device)
+      x1,x2,x3,Mu=cascade(x,uv)
+      npatch=patchx*patchy
+      dist=mod.group_mean(mod.distances(Mu),npatch)
+      kharmonic=mod.group_mean(mod.harmonic_mean(Mu).view(-1,1),npatch)[:,0]/(mod.K*mod.latent_dim)
+      recon_error=torch.mean(torch.pow(x-(x1+x2+x3),2).view(len(baselinelist),-1),dim=1)
+      scores.append(sas_id,SAP,baselinelist,dist.cpu().numpy(),torch.argmin(dist,dim=1).cpu().numpy(),
+         kharmonic.cpu().numpy(),mod.group_mean(Mu,npatch).cpu().numpy(),recon_error.cpu().numpy())
+  return last-first
+
+########################################################
+def score_file(filename,SAPs,cascade,mod,scores,device='cpu'):
+  # score all baselines of the SAPs of filename, append to scores (ScoreWriter)
+  # return number of rows written
+  sas_id=get_sas_id(filename)
+  nrows=0
+  for SAP in SAPs:
+    (nbase,_,_,_,_)=get_metadata(filename,SAP)
+    nrows+=score_range(filename,SAP,0,nbase,cascade,mod,scores,sas_id=sas_id,device=device)
+  return nrows
+
+########################################################
+def scan(data_path):
+  # candidate files under data_path (same search as get_fileSAP())
+  if rec_file_search:
+    return glob.glob(data_path+os.sep+'**'+os.sep+pattern,recursive=True)
+  return glob.glob(data_path+os.sep+pattern)
+
+########################################################
+def watch(data_path):
+  # yield batches of candidate files, forever: first everything already there,
+  # then files created or moved into data_path, at least every settle_time seconds
+  # (possibly empty, so files that were not settled yet are checked again)
+  yield scan(data_path)
+  try:
+    from inotify_simple import INotify, flags
+  except ImportError:
+    INotify=None
+    log.info('[watch] inotify_simple not available, polling.')
+  if INotify is None:
+    while True:
+      time.sleep(poll_interval)
+      yield scan(data_path)
+  inotify=INotify()
+  mask=flags.CLOSE_WRITE|flags.MOVED_TO|flags.CREATE
+  watches=dict()
+  def add_watches():
+    # inotify is not recursive: watch each directory
+    dirs=[data_path]
+    if rec_file_search:
+      dirs+=[root for root,_,_ in os.walk(data_path)]
+    for d in dirs:
+      if d not in watches.values():
+        watches[inotify.add_watch(d,mask)]=d
+  add_watches()
+  last_scan=time.time()
+  while True:
+    events=inotify.read(timeout=settle_time*1000)
+    new=list()
+    for event in events:
+      if event.mask&flags.ISDIR:
+        add_watches()
+      elif fnmatch.fnmatch(event.name,pattern):
+        new.append(os.path.join(watches[event.wd],event.name))
+    # full scan every poll_interval, in case events were missed
+    if time.time()-last_scan>=poll_interval:
+      new+=scan(data_path)
+      last_scan=time.time()
+    yield new
+
+########################################################
+def settled(filename):
+  # file not modified for settle_time seconds
+  return time.time()-os.path.getmtime(filename)>=settle_time
+
+########################################################
+def ingest(data_path,score_file_name,state_file,model_dir='.',device='cpu'):
+  state=IngestState(state_file)
+  cascade,mod=load_models(model_dir,device=device)
+  scores=ScoreWriter(score_file_name,K=Kc,latent_dim=L+Lt+Lt)
+  # resume: drop partial results of an interrupted file, it will be processed again
+  for (path,row0) in state.interrupted():
+    log.info(f"[ingest] {path} was interrupted, removing rows from {row0}.")
+    scores.truncate(row0)
+    state.set(path,None,'interrupted')
+  # files seen but not settled yet, checked again on every wakeup of watch()
+  unsettled=set()
+  for candidates in watch(data_path):
+    candidates=unsettled|set(candidates)
+    unsettled=set()
+    for filename in sorted(candidates):
+      if state.status(filename) in ('done','duplicate','invalid','failed'):
+        continue
+      if not os.path.exists(filename):
+        continue
+      if not settled(filename):
+        unsettled.add(filename)
+        continue
+      try:
+        sas_id=get_sas_id(filename)
+        if state.sas_done(sas_id):
+          state.set(filename,sas_id,'duplicate')
+          continue
+        SAPs=get_valid_SAPs(filename)
+        if not SAPs:
+          state.set(filename,sas_id,'invalid')
+          continue
+      except Exception:
+        log.exception(f"[ingest] cannot read {filename}")
+        state.set(filename,None,'invalid')
+        continue
+      log.info(f"[ingest] {filename} sas_id {sas_id} SAPs {SAPs}.")
+      row0=scores.rows
+      state.set(filename,sas_id,'running',row0)
+      try:
+        nrows=score_file(filename,SAPs,cascade,mod,scores,device=device)
+        state.set(filename,sas_id,'done',row0,nrows)
+      except Exception:
+        log.exception(f"[ingest] failed {filename}")
+        scores.truncate(row0)
+        state.set(filename,sas_id,'failed',row0)
+
+########################################################
+if __name__=='__main__':
+  # usage: python ingest.py data_path scores.h5 ingest.db [model_dir]
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s %(message)s')
+  ingest(sys.argv[1],sys.argv[2],sys.argv[3],model_dir=sys.argv[4] if len(sys.argv)>4 else '.',device=mydevice)
@@ -20,6 +20,7 @@ from sqlite3 import Error
 from lofar_tools import *
 from lofar_models import *
 from lofar_tools import mydevice
+from train_utils import AdaptiveADMM, StageScheduler
 # Train autoencoder and k-harmonic mean clustering using LOFAR data
 
 # Some pre-amble variables
@@ -53,7 +54,17 @@ total_bl = 406870 # Total number of useable baselines
 default_batch=96 # no. of baselines per iter, batch size determined by how many patches are created
 num_epochs=10 # total epochs
 Niter=int(total_bl/default_batch) # how many minibatches are considered for an epoch
-Nadmm=10 # Inner optimization iterations (ADMM)
+Nadmm=10 # Inner optimization iterations (ADMM), maximum if adaptive_admm
+adaptive_admm=True # stop ADMM early when the residuals converge, adapt rho (residual balancing)
+admm_min_iter=2 # minimum ADMM iterations if adaptive_admm
+admm_eps_abs=1e-3 # ADMM absolute (per element) and relative tolerance
+admm_eps_rel=1e-3
+admm_rho_limits=(0.1,10) # range of rho (residual balancing)
+chunk_aligned=False # select baselines in runs aligned with the HDF5 chunks
+num_sources=1 # number of file/SAP pairs mixed in one minibatch (read concurrently)
+compact_data=False # keep minibatch as int8+scales until it reaches the model
+staged_training=True # alternate training of the 2D CNN, the 1D CNNs and the K-harmonic model
+phase_length=100 # minibatches per phase of staged training
 save_model=True
 load_model=False
 
@@ -63,6 +74,13 @@ load_model=False
 file_list,sap_list=get_fileSAP('C:\\LOFAR\\')
 # or ../../drive/My Drive/Colab Notebooks/
 
+# preprocessed patch store (see patch_store.py), if given, minibatches
+# are read from the store instead of the raw H5 files
+patch_store_path=None
+if patch_store_path:
+  from patch_store import PatchStoreDataset
+  patch_store=PatchStoreDataset(patch_store_path)
+
 Lt=16#32 # latent dimensions in time/frequency axes (1D CNN)
 L=256-(2*Lt)#256 # latent dimension in real space
 Kc=10 # K-harmonic clusters
@@ -70,7 +88,7 @@ Khp=4 # order of K harmonic mean 1/|| ||^p norm
 alpha=0.01 # loss+alpha*cluster_loss
 beta=0.01 # loss+beta*cluster_similarity (penalty)
 gamma=0.01 # loss+gamma*augmentation_loss
-rho=1 # ADMM rho
+rho=1 # ADMM rho (initial value if adaptive_admm)
 
 # reconstruction ICA
 use_rica=True
@@ -129,6 +147,8 @@ try:
   cur = conn.cursor()
   sql = f"create table if not exists lossTable ({(',').join(db_items)})"
   cur.execute(sql)
+  # training phase, ADMM iterations, final rho and residuals of each minibatch
+  cur.execute("create table if not exists admmTable (epoch INTEGER, iter INTEGER, phase TEXT, iterations INTEGER, rho FLOAT, primal FLOAT, dual FLOAT, seconds FLOAT)")
   conn.commit()
 except Error as e:
   log.error(e)
@@ -137,15 +157,20 @@ except Error as e:
 import torch.optim as optim
 from lbfgsnew import LBFGSNew # custom optimizer
 criterion=nn.MSELoss(reduction='sum')
-# start with empty parameter list
-params=list()
-params.extend(list(net.parameters()))
-#params.extend(list(netT.parameters()))
-#params.extend(list(netF.parameters()))
-#params.extend(list(mod.parameters()))
-
-optimizer=optim.Adam(params, lr=0.0001) # 0.001
-#optimizer = LBFGSNew(params, history_size=7, max_iter=4, line_search_fn=True,batch_mode=True)
+# training phases: (name, models trained, minibatches), cycled,
+# models of inactive phases are frozen (and run under no_grad if the active ones do not depend on them)
+if staged_training:
+  train_phases=[('net',[net],phase_length),('1d',[netT,netF],phase_length),('khm',[mod],phase_length)]
+  frozen_models=[]
+else:
+  # only the 2D CNN, the other models are frozen
+  train_phases=[('net',[net],Niter)]
+  frozen_models=[netT,netF,mod]
+
+# one optimizer per phase
+stages=StageScheduler(train_phases,lambda params: optim.Adam(params, lr=0.0001),frozen=frozen_models) # 0.001
+admm_control=AdaptiveADMM(rho=rho,max_iter=Nadmm,min_iter=admm_min_iter,eps_abs=admm_eps_abs,eps_rel=admm_eps_rel,rho_min=admm_rho_limits[0],rho_max=admm_rho_limits[1],adaptive=adaptive_admm)
+#stages=StageScheduler(train_phases,lambda params: LBFGSNew(params, history_size=7, max_iter=4, line_search_fn=True,batch_mode=True),frozen=frozen_models)
 
 ############################################################
 # Augmented loss function
@@ -168,10 +193,20 @@ def augmented_loss(mu,batch_per_bline,batch_size):
 
 # train network
 for epoch in range(num_epochs):
+  epoch_tic=time.perf_counter()
+  epoch_admm=0
   for i in range(Niter):
     tic=time.perf_counter()
+    phase=stages.step()
+    optimizer=stages.optimizer
     # get the inputs
-    patchx,patchy,inputs,uvcoords=get_data_minibatch(file_list,sap_list,batch_size=default_batch,patch_size=patch_size,normalize_data=True,num_channels=num_in_channels,uvdist=True)
+    if patch_store_path:
+      patchx,patchy,inputs,uvcoords=patch_store.get_minibatch(batch_size=default_batch,normalize_data=True)
+    else:
+      patchx,patchy,inputs,uvcoords=get_data_minibatch(file_list,sap_list,batch_size=default_batch,patch_size=patch_size,normalize_data=True,num_channels=num_in_channels,uvdist=True,chunk_aligned=chunk_aligned,num_sources=num_sources,compact=compact_data)
+      if compact_data:
+        # scale, clamp and normalize on the device
+        inputs=inputs.dequantize(mydevice)
     # wrap them in variable
     x=Variable(inputs).to(mydevice)
     uv=Variable(uvcoords).to(mydevice)
@@ -183,27 +218,29 @@ for epoch in range(num_epochs):
     # List of loss tuples for the last batch of ADMM iterations
     loss_tuples = []
 
-    # Lagrange multipliers
-    y1=torch.zeros(x.numel(),requires_grad=False).to(mydevice)
-    y2=torch.zeros(x.numel(),requires_grad=False).to(mydevice)
-    y3=torch.zeros(x.numel(),requires_grad=False).to(mydevice)
-    for admm in range(Nadmm):
+    # Lagrange multipliers (admm_control.y) and rho
+    admm_control.start(x.numel(),3,mydevice)
+    for admm in admm_control:
+      (y1,y2,y3)=admm_control.y
+      rho=admm_control.rho
       def closure():
         if torch.is_grad_enabled():
          optimizer.zero_grad()
-        x1,mu=net(x,uv)
-        # residual
-        x11=(x-x1)/2
-        # pass through 1D CNN
-        iy1=torch.flatten(x11,start_dim=2,end_dim=3)
-        yyT,yyTmu=netT(iy1,uv)
-        # reshape 1D outputs 
-        x2=yyT.view_as(x11)
-
-        iy2=torch.flatten(torch.transpose(x11,2,3),start_dim=2,end_dim=3)
-        yyF,yyFmu=netF(iy2,uv)
-        # reshape 1D outputs 
-        x3=torch.transpose(yyF.view_as(x11),2,3)
+        with stages.grad('net'):
+          x1,mu=net(x,uv)
+          # residual
+          x11=(x-x1)/2
+        with stages.grad('net','1d'):
+          # pass through 1D CNN
+          iy1=torch.flatten(x11,start_dim=2,end_dim=3)
+          yyT,yyTmu=netT(iy1,uv)
+          # reshape 1D outputs 
+          x2=yyT.view_as(x11)
+
+          iy2=torch.flatten(torch.transpose(x11,2,3),start_dim=2,end_dim=3)
+          yyF,yyFmu=netF(iy2,uv)
+          # reshape 1D outputs 
+          x3=torch.transpose(yyF.view_as(x11),2,3)
 
         # full reconstruction
         xrecon=x1+x2+x3
@@ -218,8 +255,10 @@ for epoch in range(num_epochs):
         Mu=torch.cat((mu,yyTmu,yyFmu),1)
 
         kdist=alpha*mod.clustering_error(Mu)
-        clus_sim=beta*mod.cluster_similarity()
-        augmentation_loss=gamma*augmented_loss(Mu,batch_per_bline,default_batch)
+        with stages.grad('khm'):
+          clus_sim=beta*mod.cluster_similarity()
+        with stages.grad('net','1d'):
+          augmentation_loss=gamma*augmented_loss(Mu,batch_per_bline,default_batch)
 
         loss=loss0+loss1+loss2+loss3+kdist+augmentation_loss+clus_sim
         # RICA loss
@@ -258,16 +297,17 @@ for epoch in range(num_epochs):
         # reshape 1D outputs 
         x3=torch.transpose(yyF.view_as(x11),2,3)
 
-        y1=y1+rho*(x-x1).view(-1)
-        y2=y2+rho*(x11-x2).view(-1)
-        y3=y3+rho*(x11-x3).view(-1)
+        admm_control.update([x,x11,x11],[x1,x2,x3])
         #print("%d %f %f %f"%(admm,torch.norm(y1),torch.norm(y2),torch.norm(y3)))
+    toc=time.perf_counter()
+    epoch_admm+=admm_control.iterations
     # Record last set of ADMM interations in the loss DB
     sql = f"INSERT INTO lossTable VALUES({','.join(['?']*len(db_items))});"
     cur.executemany(sql,loss_tuples)
+    cur.execute("INSERT INTO admmTable VALUES(?,?,?,?,?,?,?,?)",(epoch,i,phase,admm_control.iterations,admm_control.rho,admm_control.primal,admm_control.dual,toc-tic))
     conn.commit()
-    toc=time.perf_counter()
-    log.info(f"Iteration {i} took {toc-tic:0.4f} seconds.")
+    log.info(f"Iteration {i} ({phase}) took {toc-tic:0.4f} seconds, {admm_control.iterations} ADMM iterations (rho {admm_control.rho:g}, residuals {admm_control.primal:e} {admm_control.dual:e}).")
+  log.info(f"Epoch {epoch} took {time.perf_counter()-epoch_tic:0.4f} seconds, {epoch_admm/Niter:0.2f} ADMM iterations per minibatch.")
   
   # free unused memory
   if use_cuda:
@@ -0,0 +1,212 @@
+import torch
+import numpy as np
+import json
+import os
+import sys
+import logging
+
+log = logging.getLogger()
+
+# Approximate nearest neighbour search over baseline latents
+# (mean of Mu=cat(mu,yyTmu,yyFmu) over the patches of a baseline, see score_store.py),
+# to find past baselines that look like a given one.
+#
+# IVF index: vectors are assigned to the closest of nlist coarse centroids
+# (seeded from the K-harmonic centroids Kmeans.M), a query only scans the
+# vectors of its nprobe closest coarse centroids. Vectors can be projected
+# to fewer dimensions with PCA before indexing.
+#
+# Index layout (one directory), append-only so it can be extended per observation:
+#  meta.json     : dim, pca_dim, nlist
+#  centroids.npy : nlist x pca_dim coarse centroids
+#  pca.npz       : mean (dim) and components (pca_dim x dim), if PCA is used
+#  vectors.f32   : N x pca_dim float32 (raw, memory-mapped)
+#  keys.i64      : N x 3 (sas_id,SAP,baseline) int64 (raw, memory-mapped)
+#  lists.i32     : N coarse centroid of each vector, int32 (raw, memory-mapped)
+
+########################################################
+def _kmeans(X,C,niter=10):
+  # Lloyd iterations starting from centroids C, empty clusters keep their centroid
+  for ci in range(niter):
+    assign=torch.argmin(torch.cdist(X,C),dim=1)
+    S=torch.zeros_like(C).index_add_(0,assign,X)
+    n=torch.bincount(assign,minlength=C.shape[0]).to(X.dtype)
+    C=torch.where(n[:,None]>0,S/n.clamp(min=1)[:,None],C)
+  return C
+
+########################################################
+class LatentIndex(object):
+  """
+  IVF index of latent vectors stored in a directory (see create()).
+
+  path: (str) index directory
+  """
+  def __init__(self,path):
+    self.path=path
+    with open(os.path.join(path,'meta.json'),'r') as fp:
+      self.meta=json.load(fp)
+    self.dim=self.meta['dim']
+    self.pca_dim=self.meta['pca_dim']
+    self.nlist=self.meta['nlist']
+    self.centroids=torch.from_numpy(np.load(os.path.join(path,'centroids.npy')))
+    if self.pca_dim!=self.dim:
+      pca=np.load(os.path.join(path,'pca.npz'))
+      self.pca_mean=torch.from_numpy(pca['mean'])
+      self.pca_components=torch.from_numpy(pca['components'])
+    self._load()
+
+  @classmethod
+  def create(cls,path,M,train_data=None,nlist=None,pca_dim=None,niter=10):
+    # path: directory to create
+    # M: K x dim centroids (Kmeans.M) used as the first coarse centroids
+    # train_data: N x dim sample of latents, needed for PCA or if nlist>K
+    # nlist: number of coarse centroids (default K), the extra ones are drawn from train_data
+    # pca_dim: project to this many dimensions, None: no projection
+    M=torch.as_tensor(M,dtype=torch.float32).detach().cpu()
+    (K,dim)=M.shape
+    if not nlist:
+      nlist=K
+    if not pca_dim:
+      pca_dim=dim
+    if train_data is not None:
+      train_data=torch.as_tensor(train_data,dtype=torch.float32)
+    assert(train_data is not None or (nlist==K and pca_dim==dim))
+    os.makedirs(path,exist_ok=True)
+    if pca_dim!=dim:
+      mean=train_data.mean(dim=0)
+      _,_,V=torch.linalg.svd(train_data-mean,full_matrices=False)
+      components=V[:pca_dim].contiguous()
+      np.savez(os.path.join(path,'pca.npz'),mean=mean.numpy(),components=components.numpy())
+      project=lambda X: torch.matmul(X-mean,components.t())
+    else:
+      project=lambda X: X
+    C=project(M)
+    if train_data is not None:
+      Y=project(train_data)
+      if nlist>K:
+        extra=torch.from_numpy(np.random.choice(Y.shape[0],nlist-K,replace=False))
+        C=torch.cat((C,Y[extra]),0)
+      C=_kmeans(Y,C,niter)
+    np.save(os.path.join(path,'centroids.npy'),C.numpy())
+    for name in ['vectors.f32','keys.i64','lists.i32']:
+      open(os.path.join(path,name),'wb').close()
+    with open(os.path.join(path,'meta.json'),'w') as fp:
+      json.dump({'dim':dim,'pca_dim':pca_dim,'nlist':nlist},fp,indent=1)
+    return cls(path)
+
+  def _load(self):
+    # memory map the vectors and build the inverted lists
+    self.ntotal=os.path.getsize(os.path.join(self.path,'lists.i32'))//4
+    lists=np.fromfile(os.path.join(self.path,'lists.i32'),dtype=np.int32,count=self.ntotal)
+    self._map()
+    # rows of each list, in ascending order (sequential reads of the memmap)
+    self.order=np.argsort(lists,kind='stable')
+    self.offsets=np.zeros(self.nlist+1,dtype=np.int64)
+    self.offsets[1:]=np.cumsum(np.bincount(lists,minlength=self.nlist))
+
+  def _map(self):
+    # memory map the first ntotal rows of vectors and keys
+    if self.ntotal==0:
+      self.vectors=np.zeros((0,self.pca_dim),dtype=np.float32)
+      self.keys=np.zeros((0,3),dtype=np.int64)
+    else:
+      self.vectors=np.memmap(os.path.join(self.path,'vectors.f32'),dtype=np.float32,mode='r',shape=(self.ntotal,self.pca_dim))
+      self.keys=np.memmap(os.path.join(self.path,'keys.i64'),dtype=np.int64,mode='r',shape=(self.ntotal,3))
+
+  def __len__(self):
+    return self.ntotal
+
+  def project(self,X):
+    # X: N x dim -> N x pca_dim
+    X=torch.as_tensor(X,dtype=torch.float32).cpu()
+    if self.pca_dim!=self.dim:
+      X=torch.matmul(X-self.pca_mean,self.pca_components.t())
+    return X
+
+  def add(self,keys,X):
+    # keys: N x 3 (sas_id,SAP,baseline), X: N x dim latents
+    Y=self.project(X)
+    lists=torch.argmin(torch.cdist(Y,self.centroids),dim=1).numpy().astype(np.int32)
+    # drop rows of an interrupted add() (written after the last complete row)
+    for name,row_bytes in [('vectors.f32',4*self.pca_dim),('keys.i64',8*3),('lists.i32',4)]:
+      with open(os.path.join(self.path,name),'r+b') as fp:
+        fp.truncate(self.ntotal*row_bytes)
+    with open(os.path.join(self.path,'vectors.f32'),'ab') as fp:
+      fp.write(Y.numpy().astype(np.float32).tobytes())
+    with open(os.path.join(self.path,'keys.i64'),'ab') as fp:
+      fp.write(np.asarray(keys,dtype=np.int64).tobytes())
+    # lists.i32 is written last, its size gives the number of complete rows
+    with open(os.path.join(self.path,'lists.i32'),'ab') as fp:
+      fp.write(lists.tobytes())
+    # new rows go to the end of their lists
+    idx=np.argsort(lists,kind='stable')
+    self.order=np.insert(self.order,self.offsets[lists[idx]+1],self.ntotal+idx)
+    self.offsets[1:]+=np.cumsum(np.bincount(lists,minlength=self.nlist))
+    self.ntotal+=lists.shape[0]
+    self._map()
+
+  def indexed(self):
+    # set of (sas_id,SAP) already in the index
+    return set(map(tuple,np.unique(self.keys[:,:2],axis=0).tolist()))
+
+  def search(self,Q,k=10,nprobe=4):
+    # Q: B x dim queries
+    # return keys B x k x 3 and distances B x k (ascending, -1 and inf if fewer than k found)
+    Y=self.project(Q)
+    B=Y.shape[0]
+    nprobe=min(nprobe,self.nlist)
+    probes=torch.topk(torch.cdist(Y,self.centroids),nprobe,dim=1,largest=False)[1].numpy()
+    best_d=torch.full((B,k),float('inf'))
+    best_i=torch.full((B,k),-1,dtype=torch.int64)
+    # scan each probed list once, for all queries that probe it
+    for cl in np.unique(probes):
+      rows=np.sort(self.order[self.offsets[cl]:self.offsets[cl+1]])
+      if rows.shape[0]==0:
+        continue
+      qsel=torch.from_numpy(np.flatnonzero((probes==cl).any(axis=1)))
+      D=torch.cdist(Y[qsel],torch.from_numpy(np.asarray(self.vectors[rows])))
+      cand_d=torch.cat((best_d[qsel],D),1)
+      cand_i=torch.cat((best_i[qsel],torch.from_numpy(rows).expand(qsel.shape[0],-1)),1)
+      d,j=torch.topk(cand_d,min(k,cand_d.shape[1]),dim=1,largest=False)
+      best_d[qsel,:d.shape[1]]=d
+      best_i[qsel,:d.shape[1]]=torch.gather(cand_i,1,j)
+    keys=np.full((B,k,3),-1,dtype=np.int64)
+    found=best_i.numpy()>=0
+    keys[found]=self.keys[best_i.numpy()[found]]
+    return keys,best_d.numpy()
+
+########################################################
+if __name__=='__main__':
+  # usage:
+  #  python latent_index.py add index_dir scores.h5 khm.model [nlist] [pca_dim] : create/extend index with the baselines of a score file
+  #  python latent_index.py query index_dir scores.h5 sas_id SAP baseline [k] : nearest baselines to one in the score file
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s %(message)s')
+  from score_store import ScoreReader
+  command,index_dir,score_file=sys.argv[1:4]
+  reader=ScoreReader(score_file,columns=['key','latent'])
+  if command=='add':
+    if not os.path.exists(os.path.join(index_dir,'meta.json')):
+      checkpoint=torch.load(sys.argv[4],map_location=torch.device('cpu'))
+      nlist=int(sys.argv[5]) if len(sys.argv)>5 else None
+      pca_dim=int(sys.argv[6]) if len(sys.argv)>6 else None
+      sample=np.random.choice(len(reader),min(len(reader),100000),replace=False)
+      index=LatentIndex.create(index_dir,checkpoint['model_state_dict']['M'],
+         train_data=reader[np.sort(sample)]['latent'],nlist=nlist,pca_dim=pca_dim)
+    else:
+      index=LatentIndex(index_dir)
+    # only add observations not indexed yet
+    indexed=index.indexed()
+    for chunk in reader.iter_chunks():
+      new=np.array([tuple(key[:2]) not in indexed for key in chunk['key']],dtype=bool)
+      if new.any():
+        index.add(chunk['key'][new],chunk['latent'][new])
+    log.info(f"{index_dir}: {len(index)} baselines.")
+  elif command=='query':
+    index=LatentIndex(index_dir)
+    (sas_id,SAP,baseline)=map(int,sys.argv[4:7])
+    k=int(sys.argv[7]) if len(sys.argv)>7 else 10
+    rows=reader.rows_of(sas_id,SAP)
+    row=rows[reader[rows]['key'][:,2]==baseline]
+    keys,dist=index.search(reader[row]['latent'],k=k)
+    for key,d in zip(keys[0],dist[0]):
+      print('%d %d %d %e'%(key[0],key[1],key[2],d))
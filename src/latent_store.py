@@ -0,0 +1,188 @@
+import torch
+import numpy as np
+import h5py
+import hashlib
+import sys
+import logging
+
+from lofar_models import Kmeans
+from score_store import ScoreWriter
+
+log = logging.getLogger()
+
+# Persistent store of the latent vectors (output of the autoencoder cascade)
+# of all patches of each baseline, so that retraining only the K-harmonic
+# centroids (khm.model) does not need the autoencoders to be run again:
+# distances, clusters and loss are recomputed from the stored latents.
+#
+# The latents are only valid for the encoder checkpoints that produced them,
+# so each HDF5 file keeps one group per checkpoint hash (see checkpoint_hash()):
+#  <hash>/latent    : Npatch x L float32, patches of each baseline are contiguous
+#  <hash>/baselines : Nbline x 5 (sas_id,SAP,baseline,first row,npatch) int64
+#  <hash>/recon_error : Nbline mean squared reconstruction error, float32
+# Writing with a new hash deletes the groups of all other hashes.
+
+########################################################
+def checkpoint_hash(filenames):
+  # sha1 of the contents of the checkpoint files (in the given order)
+  h=hashlib.sha1()
+  for filename in filenames:
+    with open(filename,'rb') as fp:
+      for block in iter(lambda: fp.read(1<<20),b''):
+        h.update(block)
+  return h.hexdigest()
+
+########################################################
+class LatentStore(object):
+  """
+  Latent vectors of baselines, keyed by (sas_id,SAP,baseline,encoder checkpoint hash).
+
+  filename: (str) HDF5 file
+  encoder_hash: (str) hash of the encoder checkpoints, from checkpoint_hash()
+  latent_dim: (int) dimension of the latent vectors (needed to create a new store)
+  chunk_rows: (int) rows per HDF5 chunk
+  readonly: (bool) open for reading only, an unknown hash gives an empty store
+  """
+  def __init__(self,filename,encoder_hash,latent_dim=None,chunk_rows=4096,readonly=False):
+    self.f=h5py.File(filename,'r' if readonly else 'a')
+    self.encoder_hash=encoder_hash
+    self.readonly=readonly
+    if not readonly:
+      # invalidate latents of other checkpoints
+      for name in list(self.f.keys()):
+        if name!=encoder_hash:
+          log.info(f"[LatentStore] {filename}: removing latents of checkpoint {name}.")
+          del self.f[name]
+      if encoder_hash not in self.f:
+        assert(latent_dim)
+        g=self.f.create_group(encoder_hash)
+        g.create_dataset('latent',shape=(0,latent_dim),maxshape=(None,latent_dim),
+           chunks=(chunk_rows,latent_dim),dtype=np.float32)
+        g.create_dataset('baselines',shape=(0,5),maxshape=(None,5),chunks=(1024,5),dtype=np.int64)
+        g.create_dataset('recon_error',shape=(0,),maxshape=(None,),chunks=(1024,),dtype=np.float32)
+        g.attrs['rows']=0
+        g.attrs['nbline']=0
+    if encoder_hash in self.f:
+      g=self.f[encoder_hash]
+      self.rows=int(g.attrs['rows'])
+      self.nbline=int(g.attrs['nbline'])
+      self.latent_dim=g['latent'].shape[1]
+    else:
+      self.rows=0
+      self.nbline=0
+      self.latent_dim=latent_dim
+    self._index=None
+
+  def __len__(self):
+    return self.nbline
+
+  def baselines(self):
+    # Nbline x 5 (sas_id,SAP,baseline,first row,npatch)
+    if self.nbline==0:
+      return np.zeros((0,5),dtype=np.int64)
+    return self.f[self.encoder_hash]['baselines'][:self.nbline]
+
+  def stored_baselines(self,sas_id,SAP):
+    # set of baselines of one observation SAP already in the store
+    if self._index is None:
+      self._index=dict()
+      for (sid,sap,nb,_,_) in self.baselines():
+        self._index.setdefault((int(sid),int(sap)),set()).add(int(nb))
+    return self._index.get((int(sas_id),int(SAP)),set())
+
+  def append(self,sas_id,SAP,baselines,Mu,npatch,recon_error):
+    # baselines: (n,) baseline ids, Mu: n*npatch x L latents grouped per baseline
+    # recon_error: (n,) reconstruction error of each baseline
+    assert(not self.readonly)
+    n=len(baselines)
+    g=self.f[self.encoder_hash]
+    Mu=np.asarray(Mu,dtype=np.float32)
+    assert(Mu.shape[0]==n*npatch)
+    key=np.zeros((n,5),dtype=np.int64)
+    key[:,0]=sas_id
+    key[:,1]=int(SAP)
+    key[:,2]=baselines
+    key[:,3]=self.rows+npatch*np.arange(n)
+    key[:,4]=npatch
+    g['latent'].resize(self.rows+n*npatch,axis=0)
+    g['latent'][self.rows:self.rows+n*npatch]=Mu
+    g['baselines'].resize(self.nbline+n,axis=0)
+    g['baselines'][self.nbline:self.nbline+n]=key
+    g['recon_error'].resize(self.nbline+n,axis=0)
+    g['recon_error'][self.nbline:self.nbline+n]=np.asarray(recon_error,dtype=np.float32)
+    self.rows+=n*npatch
+    self.nbline+=n
+    g.attrs['rows']=self.rows
+    g.attrs['nbline']=self.nbline
+    self.f.flush()
+    self._index=None
+
+  def iter_chunks(self,chunk_rows=1<<18):
+    # iterate over whole baselines, about chunk_rows latents at a time
+    # yield baselines (n x 5), latents (rows x L), recon_error (n)
+    key=self.baselines()
+    g=self.f[self.encoder_hash]
+    cb=0
+    while cb<self.nbline:
+      row0=key[cb,3]
+      ce=cb+1
+      while ce<self.nbline and key[ce,3]+key[ce,4]-row0<=chunk_rows:
+        ce+=1
+      row1=key[ce-1,3]+key[ce-1,4]
+      yield key[cb:ce],g['latent'][row0:row1],g['recon_error'][cb:ce]
+      cb=ce
+
+  def rescore(self,mod,chunk_rows=1<<18,device='cpu'):
+    # recompute distances, hard clusters, K-harmonic loss and mean latent
+    # of all stored baselines with the centroids of mod (Kmeans)
+    # yield (baselines,distances,cluster,kharmonic,latent,recon_error) per chunk
+    mod=mod.to(device)
+    with torch.no_grad():
+      for key,Mu,recon_error in self.iter_chunks(chunk_rows):
+        Mu=torch.from_numpy(Mu).to(device)
+        npatch=torch.from_numpy(key[:,4]).to(device)
+        seg=torch.repeat_interleave(torch.arange(key.shape[0],device=device),npatch)
+        def segment_mean(A):
+          S=torch.zeros(key.shape[0],A.shape[1],dtype=A.dtype,device=device)
+          S.index_add_(0,seg,A)
+          return S/npatch[:,None]
+        dist=segment_mean(mod.distances(Mu))
+        cluster=torch.argmin(dist,dim=1)
+        kharmonic=segment_mean(mod.harmonic_mean(Mu).view(-1,1))[:,0]/(mod.K*mod.latent_dim)
+        latent=segment_mean(Mu)
+        yield key,dist.cpu().numpy(),cluster.cpu().numpy(),kharmonic.cpu().numpy(),latent.cpu().numpy(),recon_error
+
+  def close(self):
+    self.f.close()
+
+########################################################
+if __name__=='__main__':
+  # rescore stored latents with new centroids, write the result as score_store.py output
+  # usage: python latent_store.py latents.h5 khm.model scores.h5 Khp net.model netT.model netF.model
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s %(message)s')
+  store_file,khm_file,score_file=sys.argv[1:4]
+  Khp=int(sys.argv[4])
+  encoder_hash=checkpoint_hash(sys.argv[5:8])
+  store=LatentStore(store_file,encoder_hash,readonly=True)
+  if len(store)==0:
+    log.error(f"{store_file}: no latents for these encoder checkpoints, run evaluate_clustering.py first.")
+    sys.exit(1)
+  checkpoint=torch.load(khm_file,map_location=torch.device('cpu'))
+  (Kc,latent_dim)=checkpoint['model_state_dict']['M'].shape
+  assert(latent_dim==store.latent_dim)
+  mod=Kmeans(latent_dim=latent_dim,K=Kc,p=Khp)
+  mod.load_state_dict(checkpoint['model_state_dict'])
+  mod.eval()
+  with ScoreWriter(score_file,K=Kc,latent_dim=latent_dim) as scores:
+    # observations whose earlier rows in score_file are already replaced
+    replaced=set()
+    for key,dist,cluster,kharmonic,latent,recon_error in store.rescore(mod):
+      # rows are grouped by (sas_id,SAP) in the order they were stored
+      for sid,sap in np.unique(key[:,:2],axis=0):
+        if (sid,sap) not in replaced:
+          scores.remove(sid,sap)
+          replaced.add((sid,sap))
+        rows=np.flatnonzero((key[:,0]==sid)&(key[:,1]==sap))
+        scores.append(sid,sap,key[rows,2],dist[rows],cluster[rows],kharmonic[rows],latent[rows],recon_error[rows])
+  log.info(f"Rescored {len(store)} baselines.")
+  store.close()
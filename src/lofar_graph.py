@@ -0,0 +1,217 @@
+import torch
+import torch.nn as nn
+import numpy as np
+import scipy.sparse as sp
+import h5py
+import os
+import logging
+
+from lofar_tools import get_data_for_baselines
+
+log = logging.getLogger()
+
+# Line graph of the baselines of a SAP: nodes are baselines, two baselines are
+# connected if they share a station (every baseline also has a self loop).
+# With the station incidence matrix B (nbase x nstation, B[i,s]=1 if baseline i
+# uses station s) the adjacency matrix is
+#   A = B B^T - diag(d) + I,  d_i = number of (distinct) stations of baseline i
+# The number of edges grows as sum_s deg(s)^2, so instead of building the
+# edge list, A X can be applied as B (B^T X) - (d-1) X (see IncidencePropagation).
+
+########################################################
+def station_incidence(baselines):
+  # baselines: nbase x 2 station ids (as in measurement/saps/<SAP>/baselines)
+  # return B (scipy csr, nbase x nstation, float32), station ids (nstation)
+  baselines=np.asarray(baselines,dtype=np.int64)
+  (nbase,_)=baselines.shape
+  stations,col=np.unique(baselines.reshape(-1),return_inverse=True)
+  col=col.reshape(nbase,2)
+  row=np.repeat(np.arange(nbase),2)
+  # autocorrelations (same station twice) : keep only one entry
+  keep=np.ones((nbase,2),dtype=bool)
+  keep[:,1]=col[:,0]!=col[:,1]
+  B=sp.csr_matrix((np.ones(keep.sum(),dtype=np.float32),(row[keep.reshape(-1)],col[keep])),
+     shape=(nbase,stations.shape[0]))
+  return B,stations
+
+########################################################
+def line_graph_edges(B):
+  # B: station incidence matrix from station_incidence()
+  # return edge index 2 x nedges (int64), both directions and self loops included
+  A=(B@B.T).tocoo()
+  edge_index=np.vstack((A.row,A.col)).astype(np.int64)
+  # sort by source node, then target node
+  order=np.lexsort((edge_index[1],edge_index[0]))
+  return edge_index[:,order]
+
+########################################################
+class IncidencePropagation(nn.Module):
+  """
+  Apply the line graph adjacency A (or its symmetric normalization
+  D^-1/2 A D^-1/2 as used by GCNs) to node features, without building A.
+  Cost is O(nbase x features) instead of O(nedges x features).
+
+  B: station incidence matrix (scipy sparse, nbase x nstation)
+  normalize: (bool) use D^-1/2 A D^-1/2, D=diag(row sums of A)
+  """
+  def __init__(self,B,normalize=True):
+    super(IncidencePropagation,self).__init__()
+    B=B.tocoo()
+    Bt=torch.sparse_coo_tensor(np.vstack((B.row,B.col)),B.data,B.shape,dtype=torch.float32).coalesce()
+    self.register_buffer('B',Bt)
+    self.register_buffer('Bt',Bt.t().coalesce())
+    # number of stations of each baseline
+    d=torch.from_numpy(np.asarray(B.sum(axis=1)).reshape(-1).astype(np.float32))
+    self.register_buffer('dm1',(d-1).view(-1,1))
+    self.normalize=normalize
+    if normalize:
+      # row sums of A : B (B^T 1) - (d-1)
+      deg=self._propagate(torch.ones(B.shape[0],1))
+      self.register_buffer('dinv_sqrt',torch.pow(deg,-0.5))
+
+  def _propagate(self,X):
+    return torch.sparse.mm(self.B,torch.sparse.mm(self.Bt,X))-self.dm1*X
+
+  def forward(self,X):
+    # X: nbase x features
+    if self.normalize:
+      return self.dinv_sqrt*self._propagate(self.dinv_sqrt*X)
+    return self._propagate(X)
+
+########################################################
+class IncidenceGCNConv(nn.Module):
+  """
+  Graph convolution X -> D^-1/2 A D^-1/2 X W + b on the line graph,
+  same as GCNConv on the edges of line_graph_edges(), using IncidencePropagation.
+
+  propagation: IncidencePropagation (normalize=True), can be shared between layers
+  in_channels,out_channels: (int) feature sizes
+  """
+  def __init__(self,propagation,in_channels,out_channels):
+    super(IncidenceGCNConv,self).__init__()
+    self.propagation=propagation
+    self.lin=nn.Linear(in_channels,out_channels,bias=False)
+    self.bias=nn.Parameter(torch.zeros(out_channels))
+    nn.init.xavier_uniform_(self.lin.weight)
+
+  def forward(self,X):
+    return self.propagation(self.lin(X))+self.bias
+
+########################################################
+# line graphs already built, keyed by (filename,SAP)
+_graph_cache=dict()
+
+def get_line_graph(filename,SAP,edges=True):
+  # station incidence matrix and edge index of the baselines of a SAP (cached)
+  # edges: also build the edge index (not needed with IncidencePropagation)
+  # return B, edge_index (2 x nedges, None if edges=False)
+  key=(filename,SAP)
+  if key not in _graph_cache:
+    with h5py.File(filename,'r') as f:
+      baselines=f['measurement']['saps'][SAP]['baselines'][:]
+    B,_=station_incidence(baselines)
+    _graph_cache[key]=[B,None]
+  if edges and _graph_cache[key][1] is None:
+    _graph_cache[key][1]=line_graph_edges(_graph_cache[key][0])
+  return tuple(_graph_cache[key])
+
+########################################################
+def get_node_features(filename,SAP,cascade,mod,patch_size=128,num_channels=4,baseline_batch=16,stride=None,cache_dir=None,cache_key=None,device='cpu'):
+  # node features of the line graph: for each baseline of a SAP,
+  # the mean latent Mu (over its patches) and the mean distance ||Mu-m_k|| to each centroid
+  # computed in one pass over the baselines, baseline_batch at a time
+  # cascade: AutoEncoderCascade, mod: Kmeans
+  # cache_dir: directory to keep the result (None: no cache)
+  # cache_key: (str) identifies the models, e.g. latent_store.checkpoint_hash() of their checkpoints
+  # return node_data (nbase x latent dim), node_label (nbase x K)
+  with h5py.File(filename,'r') as f:
+    sas_id=int(f['measurement/sas_id'][0])
+    nbase=f['measurement']['saps'][SAP]['visibilities'].shape[0]
+  if cache_dir:
+    cache_file=os.path.join(cache_dir,f"nodes_{sas_id}_{SAP}_{patch_size}_{stride}_{cache_key}.npz")
+    if os.path.exists(cache_file):
+      cached=np.load(cache_file)
+      return torch.from_numpy(cached['node_data']),torch.from_numpy(cached['node_label'])
+  node_data=torch.zeros((nbase,mod.latent_dim))
+  node_label=torch.zeros((nbase,mod.K))
+  with torch.no_grad():
+    for nb0 in range(0,nbase,baseline_batch):
+      baselinelist=np.arange(nb0,min(nbase,nb0+baseline_batch))
+      patchx,patchy,x,uv=get_data_for_baselines(filename,SAP,baselinelist,patch_size=patch_size,num_channels=num_channels,uvdist=True,stride=stride,device=device)
+      Mu=cascade.latents(x,uv)
+      npatch=patchx*patchy
+      node_data[baselinelist]=mod.group_mean(Mu,npatch).cpu()
+      node_label[baselinelist]=mod.group_mean(mod.distances(Mu,p=1),npatch).cpu()
+  if cache_dir:
+    os.makedirs(cache_dir,exist_ok=True)
+    np.savez(cache_file,node_data=node_data.numpy(),node_label=node_label.numpy())
+    log.info(f"[get_node_features] saved {cache_file}.")
+  return node_data,node_label
+
+########################################################
+class LineGraphSampler(object):
+  """
+  Minibatches for GCN training over the line graphs of several observations,
+  with neighbour sampling (as PyG NeighborLoader): the graphs are stacked
+  into one block diagonal graph, for each minibatch of seed baselines,
+  num_neighbors[0] neighbours of each seed are sampled, then num_neighbors[1]
+  neighbours of those, and so on. Neighbours are sampled through the station
+  incidence matrix (a station of the baseline, then a baseline of that station),
+  so the edge list of the full graph is never built.
+  Iterating gives (x,edge_index,y,nseed): features, edges (source,target) in
+  local node ids, labels and the number of seeds (the first nseed nodes).
+
+  graphs: list of (B,node_data,node_label) for each observation (SAP)
+  num_neighbors: (tuple) neighbours sampled per node, for each layer
+  batch_size: (int) number of seed baselines per minibatch
+  shuffle: (bool) shuffle the seeds each epoch
+  """
+  def __init__(self,graphs,num_neighbors=(10,10),batch_size=512,shuffle=True):
+    self.B=sp.block_diag([B for (B,_,_) in graphs],format='csr')
+    # station -> baselines
+    self.Bc=self.B.tocsc()
+    self.x=torch.cat([node_data for (_,node_data,_) in graphs],0)
+    self.y=torch.cat([node_label for (_,_,node_label) in graphs],0)
+    self.num_nodes=self.B.shape[0]
+    self.num_neighbors=num_neighbors
+    self.batch_size=batch_size
+    self.shuffle=shuffle
+
+  def __len__(self):
+    return (self.num_nodes+self.batch_size-1)//self.batch_size
+
+  def sample_neighbors(self,nodes,k):
+    # k neighbours (with replacement) of each node, return source nodes (len(nodes)*k)
+    nodes=np.repeat(nodes,k)
+    deg=self.B.indptr[nodes+1]-self.B.indptr[nodes]
+    station=self.B.indices[self.B.indptr[nodes]+(np.random.rand(nodes.shape[0])*deg).astype(np.int64)]
+    count=self.Bc.indptr[station+1]-self.Bc.indptr[station]
+    return self.Bc.indices[self.Bc.indptr[station]+(np.random.rand(nodes.shape[0])*count).astype(np.int64)]
+
+  def sample(self,seeds):
+    # subgraph of the seeds and their sampled neighbourhood
+    nodes=[seeds]
+    src=[]
+    dst=[]
+    frontier=seeds
+    for k in self.num_neighbors:
+      neighbors=self.sample_neighbors(frontier,k)
+      src.append(neighbors)
+      dst.append(np.repeat(frontier,k))
+      frontier=np.unique(neighbors)
+      nodes.append(frontier)
+    # local ids, seeds first
+    nodes=np.concatenate(nodes)
+    _,first=np.unique(nodes,return_index=True)
+    nodes=nodes[np.sort(first)]
+    local=np.full(self.num_nodes,-1,dtype=np.int64)
+    local[nodes]=np.arange(nodes.shape[0])
+    edges=np.unique(np.vstack((local[np.concatenate(src)],local[np.concatenate(dst)])),axis=1)
+    edge_index=torch.from_numpy(edges)
+    idx=torch.from_numpy(nodes)
+    return self.x[idx],edge_index,self.y[idx],seeds.shape[0]
+
+  def __iter__(self):
+    order=np.random.permutation(self.num_nodes) if self.shuffle else np.arange(self.num_nodes)
+    for ci in range(0,self.num_nodes,self.batch_size):
+      yield self.sample(order[ci:ci+self.batch_size])
@@ -83,10 +83,14 @@ class AutoEncoderCNN2(nn.Module):
         self.tconv4=nn.ConvTranspose2d(12,8,self.k,stride=self.s,padding=self.p,output_padding=1)
         self.tconv5=nn.ConvTranspose2d(8,channels,self.k,stride=self.s,padding=self.p,output_padding=1)
 
-    def forward(self,x,uv):
+    def harmonics(self,uv):
+        # uv distance harmonics, input to both encoder and decoder
         uv=torch.kron(self.harmonic_scales,uv)
         uv=torch.cat((torch.sin(uv),torch.cos(uv)),dim=1)
-        uv=torch.flatten(uv,start_dim=1)
+        return torch.flatten(uv,start_dim=1)
+
+    def forward(self,x,uv):
+        uv=self.harmonics(uv)
         mu=self.encode(x,uv)
         if not self.rica:
           return self.decode(mu,uv),mu
@@ -95,6 +99,11 @@ class AutoEncoderCNN2(nn.Module):
           muprime=F.elu(self.fc2out(mu))
           return self.decode(muprime,uv),mu
 
+    def latents(self,x,uv):
+        # latent mu only (same as forward), without decoder (and fc2out)
+        mu=self.encode(x,self.harmonics(uv))
+        return F.elu(self.fc2in(mu)) if self.rica else mu
+
     def encode(self,x,uv):
         #In  1,4,128,128
         x=F.elu(self.conv0(x)) # 1,8,64,64
@@ -220,18 +229,27 @@ class AutoEncoder1DCNN(nn.Module):
         self.tconv4=nn.ConvTranspose1d(12,8,self.k,stride=self.s,padding=0,output_padding=0)
         self.tconv5=nn.ConvTranspose1d(8,channels,self.k,stride=self.s,padding=0,output_padding=0)
 
-    def forward(self, x, uv):
+    def harmonics(self, uv):
+        # uv distance harmonics, input to both encoder and decoder
         uv=torch.kron(self.harmonic_scales,uv)
         uv=torch.cat((torch.sin(uv),torch.cos(uv)),dim=1)
-        uv=torch.flatten(uv,start_dim=1)
+        return torch.flatten(uv,start_dim=1)
+
+    def forward(self, x, uv):
+        uv=self.harmonics(uv)
         mu=self.encode(x,uv)
         if not self.rica:
-          return self.decode(mu), mu
+          return self.decode(mu,uv), mu
         else:
           mu=F.elu(self.fc2in(mu))
           muprime=F.elu(self.fc2out(mu))
           return self.decode(muprime,uv),mu
 
+    def latents(self, x, uv):
+        # latent mu only (same as forward), without decoder (and fc2out)
+        mu=self.encode(x,self.harmonics(uv))
+        return F.elu(self.fc2in(mu)) if self.rica else mu
+
     def encode(self, x, uv):
         #In  1,4,128^2
         x=F.elu(self.conv0(x)) # 1,8,64^2
@@ -272,6 +290,92 @@ class AutoEncoder1DCNN(nn.Module):
         return x # 1,channels,128^2
 
 
+########################################################
+class AutoEncoderCascade(nn.Module):
+    # 2D AE followed by two 1D AEs (time and frequency axes) on its residual
+    def __init__(self,net,netT,netF):
+        """
+        net: (AutoEncoderCNN2) 2D autoencoder
+        netT: (AutoEncoder1DCNN) 1D autoencoder along time axis
+        netF: (AutoEncoder1DCNN) 1D autoencoder along frequency axis
+        """
+        super(AutoEncoderCascade,self).__init__()
+        self.net=net
+        self.netT=netT
+        self.netF=netF
+
+    def forward(self,x,uv):
+        # return outputs x1 (2D AE), x2 (time AE), x3 (frequency AE),
+        # so the reconstruction is x1+x2+x3, and the latent Mu=(mu,yyTmu,yyFmu)
+        x1,mu=self.net(x,uv)
+        # residual
+        x11=(x-x1)/2
+        # vectorize
+        iy1=torch.flatten(x11,start_dim=2,end_dim=3)
+        iy2=torch.flatten(torch.transpose(x11,2,3),start_dim=2,end_dim=3)
+        yyT,yyTmu=self.netT(iy1,uv)
+        yyF,yyFmu=self.netF(iy2,uv)
+        # reshape 1D outputs
+        x2=yyT.view_as(x11)
+        x3=torch.transpose(yyF.view_as(x11),2,3)
+        return x1,x2,x3,torch.cat((mu,yyTmu,yyFmu),1)
+
+    def latents(self,x,uv):
+        # return only the latent Mu=(mu,yyTmu,yyFmu) (same as forward):
+        # the 2D decoder is still needed for the residual, but the
+        # 1D decoders (and the rica fc2out of the 1D AEs) are skipped
+        x1,mu=self.net(x,uv)
+        x11=(x-x1)/2
+        iy1=torch.flatten(x11,start_dim=2,end_dim=3)
+        iy2=torch.flatten(torch.transpose(x11,2,3),start_dim=2,end_dim=3)
+        yyTmu=self.netT.latents(iy1,uv)
+        yyFmu=self.netF.latents(iy2,uv)
+        return torch.cat((mu,yyTmu,yyFmu),1)
+
+
+########################################################
+class FastScreeningEncoder(nn.Module):
+    # small CNN on a whole baseline averaged down to input_size x input_size,
+    # distilled to predict log of the cascade's K centroid distances
+    # and of the K-harmonic loss of the baseline (see screening.py)
+    def __init__(self,channels=4,input_size=64,K=10,harmonic_scales=None,width=8):
+        """
+        channels: (int) input channels
+        input_size: (int) input is channels x input_size x input_size (power of 2, >=16)
+        K: (int) number of K-harmonic centroids
+        harmonic_scales: (torch.tensor) scaled multipliers for the UV input
+        width: (int) channels of the first conv layer
+        """
+        super(FastScreeningEncoder,self).__init__()
+        self.input_size=input_size
+        self.K=K
+        self.harmonic_scales=harmonic_scales
+        self.harmonic_dim=(self.harmonic_scales.size()[0])*2*2
+        # input_size -> input_size/16
+        self.conv1=nn.Conv2d(channels,width,3,stride=2,padding=1)
+        self.conv2=nn.Conv2d(width,2*width,3,stride=2,padding=1)
+        self.conv3=nn.Conv2d(2*width,4*width,3,stride=2,padding=1)
+        self.conv4=nn.Conv2d(4*width,4*width,3,stride=2,padding=1)
+        self.fcuv=nn.Linear(self.harmonic_dim,self.harmonic_dim)
+        self.fc1=nn.Linear(4*width*(input_size//16)**2+self.harmonic_dim,64)
+        self.fc2=nn.Linear(64,K+1)
+
+    def forward(self,x,uv):
+        # x: nbase x channels x input_size x input_size, uv: nbase x 2
+        # return nbase x (K+1): log distances (K) and log K-harmonic loss
+        uv=torch.kron(self.harmonic_scales,uv)
+        uv=torch.cat((torch.sin(uv),torch.cos(uv)),dim=1)
+        uv=torch.flatten(uv,start_dim=1)
+        x=F.elu(self.conv1(x))
+        x=F.elu(self.conv2(x))
+        x=F.elu(self.conv3(x))
+        x=F.elu(self.conv4(x))
+        x=torch.flatten(x,start_dim=1)
+        x=torch.cat((x,F.elu(self.fcuv(uv))),dim=1)
+        x=F.elu(self.fc1(x))
+        return self.fc2(x)
+
+
 ########################################################
 #### K harmonic means module
 class Kmeans(nn.Module):
@@ -284,16 +388,52 @@ class Kmeans(nn.Module):
      # cluster centroids
      self.M=torch.nn.Parameter(torch.rand(self.K,self.latent_dim),requires_grad=True)
 
+  def pairwise_distance(self,X):
+     # ||x_n-m_k|| for each row x_n of X and each centroid m_k : nbatch x K
+     # (not using matrix multiplication, so it is exact and has the same
+     # gradient as torch.linalg.norm(M[k]-X[n]))
+     return torch.cdist(X,self.M,compute_mode='donot_use_mm_for_euclid_dist')
+
+  def distances(self,X,p=None):
+     # ||x_n-m_k||^p : nbatch x K, p=None uses the K harmonic mean order self.p
+     if p is None:
+       p=self.p
+     D=self.pairwise_distance(X)
+     return D if p==1 else torch.pow(D,p)
+
+  def group_mean(self,D,group_size):
+     # mean of D (nbatch x K) over consecutive groups of group_size rows,
+     # e.g. the patchx*patchy patches of each baseline : nbatch/group_size x K
+     return D.view(-1,group_size,D.shape[1]).mean(dim=1)
+
+  def soft_assign(self,X,group_size=None):
+     # K harmonic means membership of each x_n (or group of rows) to each centroid
+     # m(k|x) = ||x-m_k||^(-p-2) / sum_j ||x-m_j||^(-p-2) : nbatch x K, rows sum to 1
+     # for groups of rows, ||x-m_k|| is replaced by (mean over group ||x-m_k||^p)^(1/p)
+     if group_size:
+       D=torch.pow(self.group_mean(self.distances(X),group_size),1.0/self.p)
+     else:
+       D=self.pairwise_distance(X)
+     W=1.0/(torch.pow(D,self.p+2)+self.EPS)
+     return W/torch.sum(W,dim=1,keepdim=True)
+
+  def hard_assign(self,X,group_size=None):
+     # index of the closest centroid for each x_n : nbatch
+     # if group_size is given, for each group of rows (using mean distance ^p)
+     D=self.distances(X)
+     if group_size:
+       D=self.group_mean(D,group_size)
+     return torch.argmin(D,dim=1)
+
+  def harmonic_mean(self,X):
+     # harmonic mean for each x_n := K/ sum_k (1/||x_n-m_k||^p) : nbatch
+     ek=torch.sum(1.0/(self.distances(X)+self.EPS),dim=1)
+     return self.K/(ek+self.EPS)
+
   def forward(self,X):
      # calculate distance of each X from cluster centroids
      (nbatch,_)=X.shape
-     loss=0
-     for nb in range(nbatch):
-       # calculate harmonic mean for x := K/ sum_k (1/||x-m_k||^p)
-       ek=0
-       for ck in range(self.K):
-         ek=ek+1.0/(torch.pow(torch.linalg.norm(self.M[ck,:]-X[nb,:],2),self.p)+self.EPS)
-       loss=loss+self.K/(ek+self.EPS)
+     loss=torch.sum(self.harmonic_mean(X))
      return loss/(nbatch*self.K*self.latent_dim)
 
   def clustering_error(self,X):
@@ -319,33 +459,20 @@ class Kmeans(nn.Module):
   def offline_update(self,X):
       # update cluster centroids using recursive formula
       # Eq (7.1-7.5) of B. Zhang - generalized K-harmonic means
-      (nbatch,_)=X.shape
-      alpha=torch.zeros(nbatch)
-      Q=torch.zeros(nbatch,self.K)
-      q=torch.zeros(self.K)
-      P=torch.zeros(nbatch,self.K)
       # indices i=1..nbatch, k or j=1..K
-      for ci in range(nbatch):
+      with torch.no_grad():
+        D=self.pairwise_distance(X)
         # alpha_i := 1/ (sum_k (1/||x_i-m_k||^p))^2
-        ek=0
-        for ck in range(self.K):
-          ek=ek+1.0/(torch.pow(torch.linalg.norm(self.M[ck,:]-X[ci,:],2),self.p)+self.EPS)
-        alpha[ci]=1.0/(ek**2+self.EPS)
+        ek=torch.sum(1.0/(torch.pow(D,self.p)+self.EPS),dim=1)
+        alpha=1.0/(ek**2+self.EPS)
         # Q_ij = alpha_i/ ||x_i-m_j||^(p+2)
-        for ck in range(self.K):
-          Q[ci,ck]=alpha[ci]/(torch.pow(torch.linlag.norm(self.M[ck,:]-X[ci,:],2),self.p+2)+self.EPS)
-      # q_j = sum_i Q_ij
-      for ck in range(self.K):
-          q[ck]=torch.sum(Q[:,ck])
-      # P_ij = Q_ij/q_j
-      for ci in range(nbatch):
-        for ck in range(self.K):
-          P[ci,ck]=Q[ci,ck]/q[ck]
-      # M_j = sum_i P_ij x_i
-      for ck in range(self.K):
-        self.M[ck,:]=0
-        for ci in range(nbatch):
-          self.M[ck,:]+=P[ci,ck]*X[ci,:]
+        Q=alpha[:,None]/(torch.pow(D,self.p+2)+self.EPS)
+        # q_j = sum_i Q_ij
+        q=torch.sum(Q,dim=0)
+        # P_ij = Q_ij/q_j
+        P=Q/q[None,:]
+        # M_j = sum_i P_ij x_i
+        self.M.copy_(torch.matmul(P.t(),X))
       del P,Q,q,alpha
 ########################################################
 
@@ -9,6 +9,12 @@ import h5py
 import glob
 import os,math
 import logging
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import contextlib
 
 log = logging.getLogger()
 
@@ -36,61 +42,400 @@ def torch_fftshift(real, imag):
 def channel_to_rgb(x):
   # x: 4 x nx x ny image
   # output 3 x nx ny image for RGB plot
+  # x is not modified
   (nchan,nx,ny)=x.shape
   assert(nchan==4)
+  return channels_to_rgb(x.unsqueeze(0))[0]
 
-  # normalize
-  xmean=x.mean()
-  xstd=x.std()
-  x.sub_(xmean).div_(xstd)
+########################################################
+def channels_to_rgb(x,out=None):
+  # x: N x 4 x nx x ny images
+  # out: N x 3 x nx x ny (optional) output buffer
+  # each image is normalized with its own mean,std, x is not modified
+  # R=(x0+0.3 x1)/1.3, G=(x1+x2)/2, B=(0.3 x2+x3)/1.3
+  # return N x 3 x nx x ny images for RGB plot
+  (N,nchan,nx,ny)=x.shape
+  assert(nchan==4)
+  if out is None:
+    out=torch.empty(N,3,nx,ny,dtype=x.dtype,device=x.device)
+  xstd,xmean=torch.std_mean(x.reshape(N,-1),dim=1)
+  torch.add(x[:,0],x[:,1],alpha=0.3,out=out[:,0])
+  out[:,0].div_(1.3)
+  torch.add(x[:,1],x[:,2],out=out[:,1])
+  out[:,1].div_(2.0)
+  torch.add(x[:,3],x[:,2],alpha=0.3,out=out[:,2])
+  out[:,2].div_(1.3)
+  # the weights of each colour sum to 1, so normalizing after mixing is the same
+  out.sub_(xmean.view(N,1,1,1)).div_(xstd.view(N,1,1,1))
+  return out
+
+########################################################
+class VisibilityReader(object):
+  """
+  Fast reader for measurement/saps/<SAP>/visibilities (int8) of a LOFAR H5 file.
+  h5py hyperslab selection has a large per-call overhead for small reads,
+  so depending on the storage layout of the dataset:
+   contiguous (no filters): find the file offset and serve data via np.memmap
+   chunked (no filter, deflate, shuffle): read raw chunks with read_direct_chunk
+      and decompress them in a thread pool
+   anything else: fall back to h5py
+  Whole baselines (optionally a time/frequency window) are returned as
+  ntime x nfreq x npol x 2 int8 arrays.
+
+  filename: (str) LOFAR H5 file
+  SAP: (str) SAP id
+  num_threads: (int) threads used for chunk decompression
+  """
+  def __init__(self,filename,SAP,num_threads=4):
+    self.filename=filename
+    self.SAP=SAP
+    self.f=h5py.File(filename,'r')
+    # select a dataset SAP (int8)
+    self.vis=self.f['measurement']['saps'][SAP]['visibilities']
+    self.shape=self.vis.shape
+    self.dtype=self.vis.dtype
+    self.chunks=self.vis.chunks
+    self.num_threads=num_threads
+    self._scales=None
+    self._pool=None
+    # guards _scales, _pool and the statistics (a reader is shared by threads)
+    self._lock=threading.Lock()
+    # I/O statistics
+    self.bytes_read=0
+    self.read_time=0.0
+
+    self.mode='h5py'
+    dcpl=self.vis.id.get_create_plist()
+    layout=dcpl.get_layout()
+    filters=[dcpl.get_filter(ci)[0] for ci in range(dcpl.get_nfilters())]
+    if layout==h5py.h5d.CONTIGUOUS and not filters and self.dtype.itemsize==1:
+      offset=self.vis.id.get_offset()
+      # offset is None if storage is not allocated (or external)
+      if offset is not None:
+        self.mm=np.memmap(filename,dtype=self.dtype,mode='r',offset=offset,shape=self.shape)
+        self.mode='memmap'
+    elif layout==h5py.h5d.CHUNKED and set(filters)<=set([h5py.h5z.FILTER_DEFLATE,h5py.h5z.FILTER_SHUFFLE]) \
+        and self.dtype.itemsize==1:
+      # shuffle is a no-op for 1 byte types, only deflate needs decoding
+      # remember its position in the filter pipeline (bit in the filter mask)
+      self.deflate=(h5py.h5z.FILTER_DEFLATE in filters)
+      self.deflate_bit=(1<<filters.index(h5py.h5z.FILTER_DEFLATE)) if self.deflate else 0
+      self.mode='chunked'
+    log.debug(f"[VisibilityReader] {filename} SAP {SAP} using {self.mode}.")
+
+  def read_scales(self,mybase):
+    # visibility scale factors (float32) nfreq x npol for baseline mybase
+    # these are small, so they are read once for all baselines
+    with self._lock:
+      if self._scales is None:
+        self._scales=self.f['measurement']['saps'][self.SAP]['visibility_scale_factors'][()]
+    return self._scales[mybase]
+
+  def read_baseline(self,mybase,time_slice=slice(None),freq_slice=slice(None)):
+    # return ntime x nfreq x npol x 2 int8 array for baseline mybase
+    return self.read_baselines([mybase],time_slice,freq_slice)[0]
+
+  def read_baselines(self,baseline_list,time_slice=slice(None),freq_slice=slice(None)):
+    # return len(baseline_list) x ntime x nfreq x npol x 2 int8 array
+    # time_slice,freq_slice: slice (unit step) to read only a window
+    tic=time.perf_counter()
+    baseline_list=np.asarray(baseline_list,dtype=np.int64)
+    (nbase,ntime,nfreq,npol,ncomplex)=self.shape
+    t0,t1,_=time_slice.indices(ntime)
+    f0,f1,_=freq_slice.indices(nfreq)
+    if self.mode=='chunked':
+      y=self._read_chunked(baseline_list,t0,t1,f0,f1)
+    else:
+      # one plain slice per run of consecutive baselines
+      # (faster than fancy indexing of the memmap or h5py point selections)
+      src=self.mm if self.mode=='memmap' else self.vis
+      y=np.empty((len(baseline_list),t1-t0,f1-f0,npol,ncomplex),dtype=self.dtype)
+      for (ck,b0,b1) in baseline_runs(baseline_list):
+        y[ck:ck+b1-b0]=src[b0:b1,t0:t1,f0:f1]
+    with self._lock:
+      self.bytes_read+=y.nbytes
+      self.read_time+=time.perf_counter()-tic
+    return y
+
+  def _read_chunked(self,baseline_list,t0,t1,f0,f1):
+    (nbase,ntime,nfreq,npol,ncomplex)=self.shape
+    cshape=self.chunks
+    y=np.zeros((len(baseline_list),t1-t0,f1-f0,npol,ncomplex),dtype=self.dtype)
+    if y.size==0:
+      return y
+    # find all chunks needed, each chunk is read (and decompressed) only once
+    # even if it holds more than one of the requested baselines
+    rows=dict()
+    for ck,mybase in enumerate(baseline_list):
+      rows.setdefault(int(mybase)//cshape[0],list()).append(ck)
+    offsets=list()
+    for cb in rows:
+      for ct in range(t0//cshape[1],(t1-1)//cshape[1]+1):
+        for cf in range(f0//cshape[2],(f1-1)//cshape[2]+1):
+          for cp in range(0,npol,cshape[3]):
+            for cc in range(0,ncomplex,cshape[4]):
+              offsets.append((cb*cshape[0],ct*cshape[1],cf*cshape[2],cp,cc))
+    # raw reads go through the (serialized) HDF5 library
+    raw=list()
+    for offset in offsets:
+      try:
+        raw.append(self.vis.id.read_direct_chunk(offset))
+      except (KeyError,RuntimeError,OSError):
+        # chunk not allocated: it only holds the fill value
+        raw.append(None)
 
-  y=torch.zeros(3,nx,ny)
-  y[0]=(x[0]+0.3*x[1])/1.3
-  y[1]=(0.7*x[1]+0.7*x[2])/1.4
-  y[2]=(0.3*x[2]+x[3])/1.3
-  return y
+    def _copy(offset,chunk):
+      if chunk is None:
+        data=np.full(cshape,self.vis.fillvalue,dtype=self.dtype)
+      else:
+        (filter_mask,buf)=chunk
+        # deflate bit set in filter_mask means it was skipped for this chunk
+        if self.deflate and not (filter_mask & self.deflate_bit):
+          buf=zlib.decompress(buf)
+        data=np.frombuffer(buf,dtype=self.dtype).reshape(cshape)
+      # intersect chunk with the requested window
+      ts=max(t0,offset[1]); te=min(t1,offset[1]+cshape[1])
+      fs=max(f0,offset[2]); fe=min(f1,offset[2]+cshape[2])
+      pe=min(npol,offset[3]+cshape[3])
+      ce=min(ncomplex,offset[4]+cshape[4])
+      for ck in rows[offset[0]//cshape[0]]:
+        b=int(baseline_list[ck])-offset[0]
+        y[ck,ts-t0:te-t0,fs-f0:fe-f0,offset[3]:pe,offset[4]:ce]=\
+          data[b,ts-offset[1]:te-offset[1],fs-offset[2]:fe-offset[2],:pe-offset[3],:ce-offset[4]]
+
+    # decompression (zlib releases the GIL) and copy in parallel
+    if self.deflate and self.num_threads>1 and len(offsets)>1:
+      with self._lock:
+        if self._pool is None:
+          self._pool=ThreadPoolExecutor(max_workers=self.num_threads)
+      list(self._pool.map(_copy,offsets,raw))
+    else:
+      for offset,chunk in zip(offsets,raw):
+        _copy(offset,chunk)
+    return y
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.shutdown()
+      self._pool=None
+    if self.mode=='memmap':
+      del self.mm
+    self.f.close()
+
+def baseline_runs(baseline_list):
+  # split baseline_list into runs of consecutive baselines
+  # return list of (position in baseline_list,first baseline,last baseline+1)
+  runs=list()
+  ck=0
+  nb=len(baseline_list)
+  while ck<nb:
+    cl=ck+1
+    while cl<nb and baseline_list[cl]==baseline_list[cl-1]+1:
+      cl+=1
+    runs.append((ck,int(baseline_list[ck]),int(baseline_list[cl-1])+1))
+    ck=cl
+  return runs
 
 ########################################################
-def get_data_minibatch(file_list,SAP_list,batch_size=2,patch_size=32,normalize_data=False,num_channels=8,transform=None,uvdist=False):
-  # len(file_list)==len(SAP_list)
-  # SAP_list should match each file name in file_list
-  # open LOFAR H5 file, read data from a SAP,
-  # randomly select number of baselines equal to batch_size
-  # and sample patches and return input for training
+def sample_baselines(nbase,batch_size,run_length=1):
+  # randomly select batch_size baselines out of nbase, sorted and without
+  # duplicates (duplicates only if batch_size>nbase, then all baselines are used
+  # and the remainder is drawn again)
+  # run_length>1: select whole runs of run_length consecutive baselines,
+  # aligned to multiples of run_length (e.g. the HDF5 chunk size along baselines),
+  # so that a minibatch touches as few chunks as possible
+  #
+  # uniform coverage: runs are selected uniformly without replacement, and the last
+  # run is only partially used by selecting a random subset of it. When all runs
+  # have the same length, every baseline is selected with probability
+  # batch_size/nbase, exactly as with independent uniform draws, so over many epochs
+  # the coverage of baselines is uniform. Only when nbase is not a multiple of
+  # run_length, baselines in the (shorter) last run are selected slightly less often.
+  # What changes is the correlation: baselines in the same run appear together.
+  if batch_size>nbase:
+    extra=sample_baselines(nbase,batch_size-nbase,run_length)
+    return np.sort(np.concatenate((np.arange(nbase),extra)))
+  if run_length<=1:
+    return np.sort(np.random.choice(nbase,batch_size,replace=False))
+  nruns=(nbase+run_length-1)//run_length
+  selected=list()
+  nsel=0
+  for run in np.random.permutation(nruns):
+    b0=run*run_length
+    b1=min(nbase,b0+run_length)
+    if nsel+b1-b0<=batch_size:
+      selected.append(np.arange(b0,b1))
+      nsel+=b1-b0
+    else:
+      selected.append(b0+np.random.choice(b1-b0,batch_size-nsel,replace=False))
+      nsel=batch_size
+    if nsel==batch_size:
+      break
+  return np.sort(np.concatenate(selected))
+
+########################################################
+# cache of open readers, so repeated calls for the same file/SAP
+# do not open the file again (shared by all threads)
+# readers in use are pinned (visibility_reader()), only readers nobody
+# holds are closed when there are more than max_open_readers
+max_open_readers=32
+_reader_cache=OrderedDict()
+_reader_pins=dict()
+_reader_cache_lock=threading.Lock()
+def _evict_readers():
+  # close least recently used unpinned readers (called with the lock held)
+  for key in list(_reader_cache.keys()):
+    if len(_reader_cache)<=max_open_readers:
+      break
+    if _reader_pins.get(key,0)==0:
+      _reader_cache.pop(key).close()
+
+def get_visibility_reader(filename,SAP,pin=False):
+  # return (cached) VisibilityReader for filename,SAP
+  # pin=True: keep it open until unpin_visibility_reader() (use visibility_reader() instead)
+  key=(filename,SAP)
+  with _reader_cache_lock:
+    if key in _reader_cache:
+      _reader_cache.move_to_end(key)
+      reader=_reader_cache[key]
+    else:
+      reader=VisibilityReader(filename,SAP)
+      _reader_cache[key]=reader
+    if pin:
+      _reader_pins[key]=_reader_pins.get(key,0)+1
+    _evict_readers()
+    return reader
+
+def unpin_visibility_reader(filename,SAP):
+  key=(filename,SAP)
+  with _reader_cache_lock:
+    _reader_pins[key]-=1
+    if _reader_pins[key]==0:
+      del _reader_pins[key]
+    _evict_readers()
+
+@contextlib.contextmanager
+def visibility_reader(filename,SAP):
+  # with visibility_reader(filename,SAP) as vis: ...
+  # cached VisibilityReader, not closed by the cache while in use
+  vis=get_visibility_reader(filename,SAP,pin=True)
+  try:
+    yield vis
+  finally:
+    unpin_visibility_reader(filename,SAP)
+
+########################################################
+def fill_channels(x,vis,scales,num_channels):
+  # x: output tensor ... x num_channels x ntime x nfreq (float)
+  # vis: int8 array/tensor ... x ntime x nfreq x npol x 2
+  # scales: visibility scale factors ... x nfreq x npol
   # num_channels=4 real,imag XX and YY
-  # num_channels=8 real,imag XX, XY, YX and YY 
-  # if transform (torchvision.transforms) is given (not None)
-  # each baseline patches will be transformed, and appended to the original data
-  # in other words, the number of patches output will be 2 times the original value
-  # the original and transformed data will be grouped according to the baselines
-  # if uvdist=True, return u,v distance in wavelengths (per each patch)
-  # average value for the central frequency and start time of observation
+  # num_channels=8 real,imag XX, XY, YX and YY
+  # channel order: 2*pol+(0:real,1:imag)
+  pols=[0,1,2,3] if num_channels==8 else [0,3]
+  vis=torch.as_tensor(vis)[...,pols,:].to(x.device,non_blocking=True)
+  scales=torch.as_tensor(scales)[...,pols].to(x.device,non_blocking=True)
+  # ... x ntime x nfreq x npol x 2 -> ... x npol x 2 x ntime x nfreq
+  y=vis.to(x.dtype)*scales.unsqueeze(-3).unsqueeze(-1)
+  y=y.movedim((-2,-1),(-4,-3))
+  x.copy_(y.reshape(x.shape))
+  return x
 
-  # light speed
-  c=2.99792458e8
+########################################################
+class CompactPatches(object):
+  """
+  Patches kept as int8 visibilities plus per-(freq,pol) float scale vectors,
+  i.e. as stored in the H5 files, which is about 4x smaller than float32 patches
+  in memory, prefetch queues and host to device transfer.
+  dequantize() does scaling, clamping and normalization in one step,
+  just before the data is passed on to the model.
 
-  assert(len(file_list)==len(SAP_list))
-  assert(num_channels==4 or num_channels==8)
-  file_id=np.random.randint(0,len(file_list))
-  filename=file_list[file_id]
-  SAP=SAP_list[file_id]
+  data: (torch.tensor) int8, npatch x channels x patch_size x patch_size
+  scale: (torch.tensor) float32, npatch x channels x patch_size (along freq axis)
+  clamp: (float) clip values to [-clamp,clamp] after scaling
+  normalize_data: (bool) normalize by mean,std of all patches after clamping
+  """
+  def __init__(self,data,scale,clamp=1e3,normalize_data=False):
+    self.data=data
+    self.scale=scale
+    self.clamp=clamp
+    self.normalize_data=normalize_data
+    self.shape=data.shape
 
-  # randomly select a file and corresponding SAP
-  f=h5py.File(filename,'r')
-  # select a dataset SAP (int8)
-  g=f['measurement']['saps'][SAP]['visibilities']
-  # scale factors for the dataset (float32)
-  h=f['measurement']['saps'][SAP]['visibility_scale_factors']
+  @classmethod
+  def from_padded(cls,xq,sc,patch_size,clamp=1e3,normalize_data=False,stride=None):
+    # unfold int8 data xq: nbase x channels x ntime x nfreq and scales
+    # sc: nbase x channels x nfreq into patches (1/2 overlap, unless stride is given),
+    # grouped per baseline as in get_data_minibatch()
+    # return CompactPatches,patchx,patchy
+    if not stride:
+      stride=patch_size//2
+    y=xq.unfold(2,patch_size,stride).unfold(3,patch_size,stride)
+    (nbase1,nchan1,patchx,patchy,nx,ny)=y.shape
+    y=y.permute(0,2,3,1,4,5).reshape(nbase1*patchx*patchy,nchan1,nx,ny).contiguous()
+    # scales only depend on frequency: nbase x chan x patchy x ny
+    s=sc.unfold(2,patch_size,stride)
+    s=s.permute(0,2,1,3).unsqueeze(1).expand(nbase1,patchx,patchy,nchan1,ny)
+    s=s.reshape(nbase1*patchx*patchy,nchan1,ny).contiguous()
+    return cls(y,s,clamp=clamp,normalize_data=normalize_data),patchx,patchy
 
-  (nbase,ntime,nfreq,npol,ncomplex)=g.shape
-  # h shape : nbase, nfreq, npol
+  def __len__(self):
+    return self.shape[0]
 
-  # pad zeros if ntime or nfreq is smaller than patch_size
-  x=torch.zeros(batch_size,num_channels,max(ntime,patch_size),max(nfreq,patch_size)).to(mydevice,non_blocking=True)
-  # randomly select baseline subset
-  baselinelist=np.random.randint(0,nbase,batch_size)
+  def nbytes(self):
+    return self.data.numel()*self.data.element_size()+self.scale.numel()*self.scale.element_size()
 
-  if uvdist:
+  def to(self,device,non_blocking=True):
+    return CompactPatches(self.data.to(device,non_blocking=non_blocking),
+        self.scale.to(device,non_blocking=non_blocking),clamp=self.clamp,normalize_data=self.normalize_data)
+
+  def dequantize(self,device=None):
+    # return float32 patches npatch x channels x patch_size x patch_size on device
+    # scale, clamp and normalize in one step (in place on the float copy)
+    if not device:
+      device=mydevice
+    y=self.data.to(device,non_blocking=True).to(torch.float32)
+    y.mul_(self.scale.to(device,non_blocking=True).unsqueeze(2))
+    y.clamp_(-self.clamp,self.clamp)
+    if self.normalize_data:
+      ymean=y.mean()
+      ystd=y.std()
+      y.sub_(ymean).div_(ystd)
+    return y
+
+########################################################
+def read_baselines_compact(filename,SAP,baselinelist,patch_size=32,num_channels=8):
+  # int8 version of read_baselines_padded(), data is not scaled
+  # return xq: len(baselinelist) x num_channels x max(ntime,patch_size) x max(nfreq,patch_size) (int8)
+  # and sc: len(baselinelist) x num_channels x max(nfreq,patch_size) scale factors (float32)
+  # channel order as in fill_channels(), padded values are 0
+  with visibility_reader(filename,SAP) as vis:
+    (nbase,ntime,nfreq,npol,ncomplex)=vis.shape
+    pols=[0,1,2,3] if num_channels==8 else [0,3]
+    batch_size=len(baselinelist)
+    xq=torch.zeros(batch_size,num_channels,max(ntime,patch_size),max(nfreq,patch_size),dtype=torch.int8)
+    sc=torch.zeros(batch_size,num_channels,max(nfreq,patch_size))
+    # batch x ntime x nfreq x npol x 2 -> batch x npol x 2 x ntime x nfreq
+    data=torch.from_numpy(vis.read_baselines(baselinelist))[...,pols,:]
+    xq[:,:,:ntime,:nfreq]=data.permute(0,3,4,1,2).reshape(batch_size,num_channels,ntime,nfreq)
+    # batch x nfreq x npol -> batch x (npol x 2) x nfreq
+    scales=torch.from_numpy(vis.read_scales(baselinelist))[...,pols]
+    sc[:,:,:nfreq]=scales.permute(0,2,1).repeat_interleave(2,dim=1)
+    return xq,sc
+
+########################################################
+def get_baseline_uv(filename,SAP,baselinelist,device=None):
+  # return len(baselinelist) x 2 tensor of u,v distance in wavelengths,
+  # average value for the central frequency and start time of observation
+  if not device:
+    device=mydevice
+
+  # light speed
+  c=2.99792458e8
+
+  with visibility_reader(filename,SAP) as vis:
+    f=vis.f
+    batch_size=len(baselinelist)
     # observation start time
     hms=f['measurement']['info']['start_time'][0].decode('ascii').split()[1].split(sep=':')
     # time in hours, in [0,24]
@@ -110,40 +455,10 @@ def get_data_minibatch(file_list,SAP_list,batch_size=2,patch_size=32,normalize_d
 
     baselines=f['measurement']['saps'][SAP]['baselines']
     xyz=f['measurement']['saps'][SAP]['antenna_locations']['XYZ']
-    uv=torch.zeros(batch_size,2).to(mydevice,non_blocking=True)
+    uv=torch.zeros(batch_size,2).to(device,non_blocking=True)
 
-  ck=0
-  for mybase in baselinelist:
-   if num_channels==8:
-     # this is 8 channels in torch tensor
-     for ci in range(4):
-      # get visibility scales
-      scalefac=torch.from_numpy(h[mybase,:,ci]).to(mydevice,non_blocking=True)
-      # add missing (time) dimension
-      scalefac=scalefac[None,:]
-      x[ck,2*ci,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,0])
-      x[ck,2*ci,:ntime,:nfreq]=x[ck,2*ci,:ntime,:nfreq]*scalefac
-      x[ck,2*ci+1,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,1])
-      x[ck,2*ci+1,:ntime,:nfreq]=x[ck,2*ci+1,:ntime,:nfreq]*scalefac
-   else: # num_channels==4
-      ci=0
-      # get visibility scales
-      scalefac=torch.from_numpy(h[mybase,:,ci]).to(mydevice,non_blocking=True)
-      # add missing (time) dimension
-      scalefac=scalefac[None,:]
-      x[ck,0,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,0])
-      x[ck,0,:ntime,:nfreq]=x[ck,0,:ntime,:nfreq]*scalefac
-      x[ck,1,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,1])
-      x[ck,1,:ntime,:nfreq]=x[ck,1,:ntime,:nfreq]*scalefac
-      ci=3
-      scalefac=torch.from_numpy(h[mybase,:,ci]).to(mydevice,non_blocking=True)
-      scalefac=scalefac[None,:]
-      x[ck,2,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,0])
-      x[ck,2,:ntime,:nfreq]=x[ck,2,:ntime,:nfreq]*scalefac
-      x[ck,3,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,1])
-      x[ck,3,:ntime,:nfreq]=x[ck,3,:ntime,:nfreq]*scalefac
-
-   if uvdist:
+    ck=0
+    for mybase in baselinelist:
      # get u,v coordinates for this baseline
      # convert xx,yy to wavelengths and rotate by theta
      xx=xyz[baselines[mybase][0]][0]-xyz[baselines[mybase][1]][0]
@@ -152,36 +467,138 @@ def get_data_minibatch(file_list,SAP_list,batch_size=2,patch_size=32,normalize_d
      vv=-xx*rot01+yy*rot00
      uv[ck,0]=uu
      uv[ck,1]=vv
+     ck=ck+1
+    return uv
+
+########################################################
+def read_baselines_padded(filename,SAP,baselinelist,patch_size=32,num_channels=8,uvdist=False,device=None):
+  # read given baselines of one file/SAP into a zero padded tensor
+  # (padded if ntime or nfreq is smaller than patch_size)
+  # return x: len(baselinelist) x num_channels x max(ntime,patch_size) x max(nfreq,patch_size)
+  # and if uvdist=True, also uv: len(baselinelist) x 2 (u,v in wavelengths)
+  if not device:
+    device=mydevice
+
+  # reader for the dataset SAP (int8) and its scale factors (float32)
+  with visibility_reader(filename,SAP) as vis:
+
+    (nbase,ntime,nfreq,npol,ncomplex)=vis.shape
+    # scale factors shape : nbase, nfreq, npol
+    batch_size=len(baselinelist)
+
+    # pad zeros if ntime or nfreq is smaller than patch_size
+    x=torch.zeros(batch_size,num_channels,max(ntime,patch_size),max(nfreq,patch_size)).to(device,non_blocking=True)
+
+    # read all selected baselines at once and scale them
+    tic=time.perf_counter()
+    fill_channels(x[:,:,:ntime,:nfreq],vis.read_baselines(baselinelist),vis.read_scales(baselinelist),num_channels)
+    toc=time.perf_counter()
+    log.debug(f"[read_baselines_padded] read {batch_size*ntime*nfreq*npol*ncomplex/1e6:.1f} MB at {batch_size*ntime*nfreq*npol*ncomplex/1e6/(toc-tic):.1f} MB/s.")
+
+    if uvdist:
+      return x,get_baseline_uv(filename,SAP,baselinelist,device=device)
+    return x
+
+########################################################
+def get_data_minibatch(file_list,SAP_list,batch_size=2,patch_size=32,normalize_data=False,num_channels=8,transform=None,uvdist=False,chunk_aligned=False,num_sources=1,num_workers=None,compact=False):
+  # len(file_list)==len(SAP_list)
+  # SAP_list should match each file name in file_list
+  # open LOFAR H5 file, read data from a SAP,
+  # randomly select number of baselines equal to batch_size
+  # and sample patches and return input for training
+  # num_channels=4 real,imag XX and YY
+  # num_channels=8 real,imag XX, XY, YX and YY 
+  # if transform (torchvision.transforms) is given (not None)
+  # each baseline patches will be transformed, and appended to the original data
+  # in other words, the number of patches output will be 2 times the original value
+  # the original and transformed data will be grouped according to the baselines
+  # if uvdist=True, return u,v distance in wavelengths (per each patch)
+  # average value for the central frequency and start time of observation
+  # baselines are selected (sorted, no duplicates) with sample_baselines(),
+  # if chunk_aligned=True, in runs aligned with the HDF5 chunks of the dataset
+  # num_sources=1 : all baselines from one randomly selected file/SAP
+  # num_sources=N>1 : the batch is split over N randomly selected file/SAP pairs,
+  # read concurrently by num_workers threads (default N), the time/frequency
+  # extent is cropped to the smallest one, so all baselines have the same
+  # patchx x patchy patches
+  # output patches are grouped per baseline (patchx*patchy consecutive patches
+  # for each baseline, time major), as needed by augmented_loss
+  # if compact=True, patches are returned as CompactPatches (int8 + scales, on cpu)
+  # instead of float32, call dequantize() just before passing them to the model
+  # (transform is not supported in this case)
+
+  assert(len(file_list)==len(SAP_list))
+  assert(num_channels==4 or num_channels==8)
+  assert(not (compact and transform))
+  # randomly select files and corresponding SAPs
+  # (at most max_open_readers, so all their readers fit in the cache)
+  num_sources=min(num_sources,batch_size,max_open_readers)
+  file_ids=np.random.choice(len(file_list),num_sources,replace=(num_sources>len(file_list)))
+  # number of baselines taken from each source
+  source_batch=[len(b) for b in np.array_split(np.arange(batch_size),num_sources)]
+
+  # select baselines (opening readers here, not in the worker threads)
+  jobs=list()
+  for file_id,nb in zip(file_ids,source_batch):
+    with visibility_reader(file_list[file_id],SAP_list[file_id]) as vis:
+      # randomly select baseline subset
+      run_length=vis.chunks[0] if (chunk_aligned and vis.chunks) else 1
+      baselinelist=sample_baselines(vis.shape[0],nb,run_length)
+    jobs.append((file_list[file_id],SAP_list[file_id],baselinelist))
+
+  def _read(job):
+    if compact:
+      x=read_baselines_compact(job[0],job[1],job[2],patch_size=patch_size,num_channels=num_channels)
+      if uvdist:
+        return x,get_baseline_uv(job[0],job[1],job[2])
+      return x
+    return read_baselines_padded(job[0],job[1],job[2],patch_size=patch_size,num_channels=num_channels,uvdist=uvdist)
+
+  if num_sources==1:
+    results=[_read(jobs[0])]
+  else:
+    with ThreadPoolExecutor(max_workers=num_workers if num_workers else num_sources) as pool:
+      results=list(pool.map(_read,jobs))
+  if uvdist:
+    uv=torch.cat([res[1] for res in results])
+  else:
+    results=[(res,None) for res in results]
 
-   ck=ck+1
+  if compact:
+    # int8 data and scales, crop to the common time,freq extent and concatenate
+    nx=min([res[0][0].shape[2] for res in results])
+    ny=min([res[0][0].shape[3] for res in results])
+    xq=torch.cat([res[0][0][:,:,:nx,:ny] for res in results])
+    sc=torch.cat([res[0][1][:,:,:ny] for res in results])
+    del results
+    y,patchx,patchy=CompactPatches.from_padded(xq,sc,patch_size,clamp=1e3,normalize_data=normalize_data)
+    if uvdist:
+      return patchx,patchy,y,uv.repeat_interleave(patchx*patchy,dim=0)
+    return patchx,patchy,y
 
+  # crop to the common time,freq extent and concatenate
+  nx=min([res[0].shape[2] for res in results])
+  ny=min([res[0].shape[3] for res in results])
+  if len(results)==1:
+    x=results[0][0]
+  else:
+    x=torch.cat([res[0][:,:,:nx,:ny] for res in results])
+  del results
 
   #torchvision.utils.save_image(x[0,0].data, 'sample.png')
   stride = patch_size//2 # patch stride (with 1/2 overlap)
   y = x.unfold(2, patch_size, stride).unfold(3, patch_size, stride)
   # get new shape
   (nbase1,nchan1,patchx,patchy,nx,ny)=y.shape
-  # create a new tensor
-  y1=torch.zeros([nbase1*patchx*patchy,nchan1,nx,ny]).to(mydevice,non_blocking=True)
-
-  if uvdist:
-    # create a tensor for uv coordinates to match size of y1
-    uv1=torch.zeros([nbase1*patchx*patchy,2]).to(mydevice,non_blocking=True)
-
-  # copy data ordered according to the patches
-  ck=0
-  for ci in range(patchx):
-   for cj in range(patchy):
-     y1[ck*nbase1:(ck+1)*nbase1,:,:,:]=y[:,:,ci,cj,:,:]
-     ck=ck+1
+  # copy data ordered according to the baselines, then the patches
+  # (contiguous() makes sure this is a copy, the patches overlap in memory)
+  y = y.permute(0,2,3,1,4,5).reshape(nbase1*patchx*patchy,nchan1,nx,ny).contiguous()
 
   if uvdist:
-    for ci in range(nbase1):
-     uv1[ci*patchx*patchy:(ci+1)*patchx*patchy,0]=uv[ci,0]
-     uv1[ci*patchx*patchy:(ci+1)*patchx*patchy,1]=uv[ci,1]
+    # create a tensor for uv coordinates to match size of y
+    uv1=uv.repeat_interleave(patchx*patchy,dim=0)
 
-  y = y1
-  del x,y1
+  del x
   # note: nbatch = batch_size x patchx x patchy
   #(nbatch,nchan,nxx,nyy)=y.shape
 
@@ -204,6 +621,9 @@ def get_data_minibatch(file_list,SAP_list,batch_size=2,patch_size=32,normalize_d
       y1[2*ci*patchx*patchy:(2*ci+1)*patchx*patchy]=y[ci*patchx*patchy:(ci+1)*patchx*patchy]
       y1[(2*ci+1)*patchx*patchy:(2*ci+2)*patchx*patchy]=transform(y[ci*patchx*patchy:(ci+1)*patchx*patchy])
     y=y1
+    if uvdist:
+      # the transformed patches keep the u,v coordinates of their baseline
+      uv1=uv1.view(nbase1,patchx*patchy,2).repeat(1,2,1).view(-1,2)
 
   # Note: if transform is given, size of y is doubled
   # size y: batchsize,channels,patch_size,patch_size
@@ -214,7 +634,7 @@ def get_data_minibatch(file_list,SAP_list,batch_size=2,patch_size=32,normalize_d
     return patchx,patchy,y
 
 ########################################################
-def get_data_for_baseline(filename,SAP,baseline_id,patch_size=32,num_channels=8,give_baseline=False,uvdist=False,device=None):
+def get_data_for_baseline(filename,SAP,baseline_id,patch_size=32,num_channels=8,give_baseline=False,uvdist=False,device=None,compact=False,stride=None):
   # open LOFAR H5 file, read data from a SAP,
   # return data for given baseline_id
   # num_channels=4 real,imag XX and YY
@@ -222,136 +642,177 @@ def get_data_for_baseline(filename,SAP,baseline_id,patch_size=32,num_channels=8,
   # if give_basline=True, also return tuple [station1,station2] of the selected baseline
   # if uvdist=True, return u,v distance in wavelengths (per each patch)
   # average value for the central frequency and start time of observation
+  # if compact=True, patches are returned as CompactPatches (int8 + scales, on cpu),
+  # dequantize() gives the same (normalized) patches
+  # stride: patch stride, default patch_size//2 as in training, at inference
+  # a larger stride (up to patch_size) means fewer patches per baseline
   if not device:
     device = mydevice
+  if not stride:
+    stride = patch_size//2 # patch stride (with 1/2 overlap)
 
   # light speed
   c=2.99792458e8
 
   assert(num_channels==4 or num_channels==8)
-  f=h5py.File(filename,'r')
-  # select a dataset SAP (int8)
-  g=f['measurement']['saps'][SAP]['visibilities']
-  # scale factors for the dataset (float32)
-  h=f['measurement']['saps'][SAP]['visibility_scale_factors']
-  if give_baseline or uvdist:
-    baselines=f['measurement']['saps'][SAP]['baselines']
+  # reader for the dataset SAP (int8) and its scale factors (float32)
+  with visibility_reader(filename,SAP) as vis:
+    f=vis.f
+    if give_baseline or uvdist:
+      baselines=f['measurement']['saps'][SAP]['baselines']
 
-  (nbase,ntime,nfreq,npol,ncomplex)=g.shape
-  # h shape : nbase, nfreq, npol
+    (nbase,ntime,nfreq,npol,ncomplex)=vis.shape
+    # scale factors shape : nbase, nfreq, npol
 
-  # pad zeros if ntime or nfreq is smaller than patch_size
-  x=torch.zeros(1,num_channels,max(ntime,patch_size),max(nfreq,patch_size))
+    # pad zeros if ntime or nfreq is smaller than patch_size
+    x=torch.zeros(1,num_channels,max(ntime,patch_size),max(nfreq,patch_size))
   
-  mybase=baseline_id
-  if uvdist:
-    # observation start time
-    hms=f['measurement']['info']['start_time'][0].decode('ascii').split()[1].split(sep=':')
-    # time in hours, in [0,24]
-    start_time=float(hms[0])+float(hms[1])/60.0+float(hms[2])/3600
-    # convert to radians
-    theta=start_time/24.0*(2*math.pi)
-    # frequencies in Hz
-    frq=f['measurement']['saps'][SAP]['central_frequencies']
-    Nf0=frq.shape[0]//2
-    # central frequency
-    freq0=frq[Nf0]
-    # 1/lambda=freq0/c
-    inv_lambda=freq0/c
-    # rotation matrix =[cos(theta) sin(theta); -sin(theta) cos(theta)]
-    rot00=math.cos(theta)*inv_lambda
-    rot01=math.sin(theta)*inv_lambda
+    mybase=baseline_id
+    if uvdist:
+      # observation start time
+      hms=f['measurement']['info']['start_time'][0].decode('ascii').split()[1].split(sep=':')
+      # time in hours, in [0,24]
+      start_time=float(hms[0])+float(hms[1])/60.0+float(hms[2])/3600
+      # convert to radians
+      theta=start_time/24.0*(2*math.pi)
+      # frequencies in Hz
+      frq=f['measurement']['saps'][SAP]['central_frequencies']
+      Nf0=frq.shape[0]//2
+      # central frequency
+      freq0=frq[Nf0]
+      # 1/lambda=freq0/c
+      inv_lambda=freq0/c
+      # rotation matrix =[cos(theta) sin(theta); -sin(theta) cos(theta)]
+      rot00=math.cos(theta)*inv_lambda
+      rot01=math.sin(theta)*inv_lambda
 
-    baselines=f['measurement']['saps'][SAP]['baselines']
-    xyz=f['measurement']['saps'][SAP]['antenna_locations']['XYZ']
-    uv=torch.zeros(1,2).to(device,non_blocking=True)
-
-  # this is 8 channels in torch tensor
-  if num_channels==8:
-   for ci in range(4):
-    # get visibility scales
-    scalefac=torch.from_numpy(h[mybase,:,ci])
-    # add missing (time) dimension
-    scalefac=scalefac[None,:]
-    x[0,2*ci,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,0])
-    x[0,2*ci,:ntime,:nfreq]=x[0,2*ci,:ntime,:nfreq]*scalefac
-    x[0,2*ci+1,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,1])
-    x[0,2*ci+1,:ntime,:nfreq]=x[0,2*ci+1,:ntime,:nfreq]*scalefac
-  else: # num_channels==4
-    ci=0
-    # get visibility scales
-    scalefac=torch.from_numpy(h[mybase,:,ci])
-    # add missing (time) dimension
-    scalefac=scalefac[None,:]
-    x[0,0,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,0])
-    x[0,0,:ntime,:nfreq]=x[0,0,:ntime,:nfreq]*scalefac
-    x[0,1,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,1])
-    x[0,1,:ntime,:nfreq]=x[0,1,:ntime,:nfreq]*scalefac
-    ci=3
-    scalefac=torch.from_numpy(h[mybase,:,ci])
-    scalefac=scalefac[None,:]
-    x[0,2,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,0])
-    x[0,2,:ntime,:nfreq]=x[0,2,:ntime,:nfreq]*scalefac
-    x[0,3,:ntime,:nfreq]=torch.from_numpy(g[mybase,:,:,ci,1])
-    x[0,3,:ntime,:nfreq]=x[0,3,:ntime,:nfreq]*scalefac
+      baselines=f['measurement']['saps'][SAP]['baselines']
+      xyz=f['measurement']['saps'][SAP]['antenna_locations']['XYZ']
+      uv=torch.zeros(1,2).to(device,non_blocking=True)
 
-  if uvdist:
-     # get u,v coordinates for this baseline
-     # convert xx,yy to wavelengths and rotate by theta
-     xx=xyz[baselines[mybase][0]][0]-xyz[baselines[mybase][1]][0]
-     yy=xyz[baselines[mybase][0]][1]-xyz[baselines[mybase][1]][1]
-     uu=xx*rot00+yy*rot01
-     vv=-xx*rot01+yy*rot00
-     uv[0,0]=uu
-     uv[0,1]=vv
+    if compact:
+      xq,sc=read_baselines_compact(filename,SAP,[mybase],patch_size=patch_size,num_channels=num_channels)
+      y,patchx,patchy=CompactPatches.from_padded(xq,sc,patch_size,clamp=1e6,normalize_data=True,stride=stride)
+      if uvdist:
+        uv1=get_baseline_uv(filename,SAP,[mybase],device=device).repeat(patchx*patchy,1)
+      if not give_baseline:
+        return (patchx,patchy,y,uv1) if uvdist else (patchx,patchy,y)
+      return (baselines[mybase],patchx,patchy,y,uv1) if uvdist else (baselines[mybase],patchx,patchy,y)
 
-  stride = patch_size//2 # patch stride (with 1/2 overlap)
-  y = x.unfold(2, patch_size, stride).unfold(3, patch_size, stride)
-  # get new shape
-  (nbase1,nchan1,patchx,patchy,nx,ny)=y.shape
-  # create a new tensor
-  y1=torch.zeros([nbase1*patchx*patchy,nchan1,nx,ny]).to(device,non_blocking=True)
+    # read baseline and scale it
+    fill_channels(x[0,:,:ntime,:nfreq],vis.read_baseline(mybase),vis.read_scales(mybase),num_channels)
 
-  if uvdist:
-    # create a tensor for uv coordinates to match size of y1
-    uv1=torch.zeros([nbase1*patchx*patchy,2]).to(device,non_blocking=True)
+    if uvdist:
+       # get u,v coordinates for this baseline
+       # convert xx,yy to wavelengths and rotate by theta
+       xx=xyz[baselines[mybase][0]][0]-xyz[baselines[mybase][1]][0]
+       yy=xyz[baselines[mybase][0]][1]-xyz[baselines[mybase][1]][1]
+       uu=xx*rot00+yy*rot01
+       vv=-xx*rot01+yy*rot00
+       uv[0,0]=uu
+       uv[0,1]=vv
 
-  # copy data ordered according to the patches
-  ck=0
-  for ci in range(patchx):
-   for cj in range(patchy):
-     y1[ck*nbase1:(ck+1)*nbase1,:,:,:]=y[:,:,ci,cj,:,:]
-     ck=ck+1
+    y = x.unfold(2, patch_size, stride).unfold(3, patch_size, stride)
+    # get new shape
+    (nbase1,nchan1,patchx,patchy,nx,ny)=y.shape
+    # create a new tensor
+    y1=torch.zeros([nbase1*patchx*patchy,nchan1,nx,ny]).to(device,non_blocking=True)
 
-  if uvdist:
-    for ci in range(nbase1):
-      uv1[ci*patchx*patchy:(ci+1)*patchx*patchy,0]=uv[ci,0]
-      uv1[ci*patchx*patchy:(ci+1)*patchx*patchy,1]=uv[ci,1]
+    if uvdist:
+      # create a tensor for uv coordinates to match size of y1
+      uv1=torch.zeros([nbase1*patchx*patchy,2]).to(device,non_blocking=True)
 
-  y = y1
-  del x,y1
-  # note: nbatch = batch_size x patchx x patchy
-  #(nbatch,nchan,nxx,nyy)=y.shape
+    # copy data ordered according to the patches
+    ck=0
+    for ci in range(patchx):
+     for cj in range(patchy):
+       y1[ck*nbase1:(ck+1)*nbase1,:,:,:]=y[:,:,ci,cj,:,:]
+       ck=ck+1
 
-  # do some rough cleanup of data
-  ##y[y!=y]=0 # set NaN,Inf to zero
-  y.clamp_(-1e6,1e6) # clip high values
+    if uvdist:
+      for ci in range(nbase1):
+        uv1[ci*patchx*patchy:(ci+1)*patchx*patchy,0]=uv[ci,0]
+        uv1[ci*patchx*patchy:(ci+1)*patchx*patchy,1]=uv[ci,1]
 
-  # normalize data
-  ymean=y.mean()
-  ystd=y.std()
-  y.sub_(ymean).div_(ystd)
+    y = y1
+    del x,y1
+    # note: nbatch = batch_size x patchx x patchy
+    #(nbatch,nchan,nxx,nyy)=y.shape
 
-  if not give_baseline:
-    if uvdist:
-      return patchx,patchy,y,uv1
-    else:
-      return patchx,patchy,y
-  else:
-    if uvdist:
-      return baselines[mybase],patchx,patchy,y,uv1
+    # do some rough cleanup of data
+    ##y[y!=y]=0 # set NaN,Inf to zero
+    y.clamp_(-1e6,1e6) # clip high values
+
+    # normalize data
+    ymean=y.mean()
+    ystd=y.std()
+    y.sub_(ymean).div_(ystd)
+
+    if not give_baseline:
+      if uvdist:
+        return patchx,patchy,y,uv1
+      else:
+        return patchx,patchy,y
     else:
-      return baselines[mybase],patchx,patchy,y
+      if uvdist:
+        return baselines[mybase],patchx,patchy,y,uv1
+      else:
+        return baselines[mybase],patchx,patchy,y
+
+########################################################
+def get_data_for_baselines(filename,SAP,baselinelist,patch_size=32,num_channels=8,uvdist=False,stride=None,device=None):
+  # batched version of get_data_for_baseline(): read all baselines in baselinelist
+  # at once, each baseline is clamped and normalized by its own mean,std
+  # (as get_data_for_baseline()), patches are grouped per baseline
+  # stride: patch stride (default patch_size//2)
+  # return patchx,patchy,y and uv1 if uvdist=True
+  # y: len(baselinelist)*patchx*patchy x num_channels x patch_size x patch_size
+  if not device:
+    device=mydevice
+  if not stride:
+    stride=patch_size//2
+  assert(num_channels==4 or num_channels==8)
+  x=read_baselines_padded(filename,SAP,baselinelist,patch_size=patch_size,num_channels=num_channels,device=device)
+  y=x.unfold(2,patch_size,stride).unfold(3,patch_size,stride)
+  (nbase1,nchan1,patchx,patchy,nx,ny)=y.shape
+  y=y.permute(0,2,3,1,4,5).reshape(nbase1*patchx*patchy,nchan1,nx,ny).contiguous()
+  del x
+  # do some rough cleanup of data
+  y.clamp_(-1e6,1e6) # clip high values
+  # normalize data per baseline
+  yb=y.view(nbase1,-1)
+  ymean=yb.mean(dim=1,keepdim=True)
+  ystd=yb.std(dim=1,keepdim=True)
+  yb.sub_(ymean).div_(ystd)
+  if uvdist:
+    uv=get_baseline_uv(filename,SAP,baselinelist,device=device)
+    return patchx,patchy,y,uv.repeat_interleave(patchx*patchy,dim=0)
+  return patchx,patchy,y
+
+########################################################
+def stitch_patches(y,patchx,patchy,stride=None,out_shape=None):
+  # inverse of unfolding into patches: overlap-add the patches of each baseline
+  # back into a full resolution image, averaging where patches overlap
+  # y: nbase*patchx*patchy x channels x patch_size x patch_size, grouped per baseline
+  # stride: patch stride used for unfolding (default patch_size//2)
+  # out_shape: (ntime,nfreq) to crop (or zero pad) the output to
+  # return nbase x channels x ntime x nfreq
+  (npatch,nchan,nx,ny)=y.shape
+  if not stride:
+    stride=nx//2
+  nbase=npatch//(patchx*patchy)
+  # columns for F.fold: nbase x (channels*nx*ny) x (patchx*patchy)
+  cols=y.reshape(nbase,patchx*patchy,nchan*nx*ny).transpose(1,2)
+  size=((patchx-1)*stride+nx,(patchy-1)*stride+ny)
+  out=F.fold(cols,size,(nx,ny),stride=stride)
+  count=F.fold(torch.ones_like(cols[:1]),size,(nx,ny),stride=stride)
+  out=out/count
+  if out_shape:
+    (ntime,nfreq)=out_shape
+    if ntime>size[0] or nfreq>size[1]:
+      out=F.pad(out,(0,max(0,nfreq-size[1]),0,max(0,ntime-size[0])))
+    out=out[:,:,:ntime,:nfreq]
+  return out
 
 ########################################################
 def get_data_for_baseline_flat(filename,SAP,baseline_id,num_channels=8,uvdist=False,device=None):
@@ -364,90 +825,163 @@ def get_data_for_baseline_flat(filename,SAP,baseline_id,num_channels=8,uvdist=Fa
   if not device:
     device = mydevice
 
-  f=h5py.File(filename,'r')
-  # select a dataset SAP (int8)
-  g=f['measurement']['saps'][SAP]['visibilities']
-  # scale factors for the dataset (float32)
-  h=f['measurement']['saps'][SAP]['visibility_scale_factors']
+  # reader for the dataset SAP (int8) and its scale factors (float32)
+  with visibility_reader(filename,SAP) as vis:
+    f=vis.f
 
-  (nbase,ntime,nfreq,npol,ncomplex)=g.shape
-  # h shape : nbase, nfreq, npol
+    (nbase,ntime,nfreq,npol,ncomplex)=vis.shape
+    # scale factors shape : nbase, nfreq, npol
 
-  x=torch.zeros(1,num_channels,ntime,nfreq)
+    x=torch.zeros(1,num_channels,ntime,nfreq)
   
-  mybase=baseline_id
-  if num_channels==8:
-   # this is 8 channels in torch tensor
-   for ci in range(4):
-    # get visibility scales
-    scalefac=torch.from_numpy(h[mybase,:,ci])
-    # add missing (time) dimension
-    scalefac=scalefac[None,:]
-    x[0,2*ci]=torch.from_numpy(g[mybase,:,:,ci,0])
-    x[0,2*ci]=x[0,2*ci]*scalefac
-    x[0,2*ci+1]=torch.from_numpy(g[mybase,:,:,ci,1])
-    x[0,2*ci+1]=x[0,2*ci+1]*scalefac
-  else: # num_channels==4
-    ci=0
-    # get visibility scales
-    scalefac=torch.from_numpy(h[mybase,:,ci])
-    # add missing (time) dimension
-    scalefac=scalefac[None,:]
-    x[0,0]=torch.from_numpy(g[mybase,:,:,ci,0])
-    x[0,0]=x[0,0]*scalefac
-    x[0,1]=torch.from_numpy(g[mybase,:,:,ci,1])
-    x[0,1]=x[0,1]*scalefac
-    ci=3
-    scalefac=torch.from_numpy(h[mybase,:,ci])
-    scalefac=scalefac[None,:]
-    x[0,2]=torch.from_numpy(g[mybase,:,:,ci,0])
-    x[0,2]=x[0,2]*scalefac
-    x[0,3]=torch.from_numpy(g[mybase,:,:,ci,1])
-    x[0,3]=x[0,3]*scalefac
+    mybase=baseline_id
+    # read baseline and scale it
+    fill_channels(x[0],vis.read_baseline(mybase),vis.read_scales(mybase),num_channels)
 
-  if uvdist:
-    # light speed
-    c=2.99792458e8
-    # observation start time
-    hms=f['measurement']['info']['start_time'][0].decode('ascii').split()[1].split(sep=':')
-    # time in hours, in [0,24]
-    start_time=float(hms[0])+float(hms[1])/60.0+float(hms[2])/3600
-    # convert to radians
-    theta=start_time/24.0*(2*math.pi)
-    # frequencies in Hz
-    frq=f['measurement']['saps'][SAP]['central_frequencies']
-    Nf0=frq.shape[0]//2
-    # central frequency
-    freq0=frq[Nf0]
-    # 1/lambda=freq0/c
-    inv_lambda=freq0/c
-    # rotation matrix =[cos(theta) sin(theta); -sin(theta) cos(theta)]
-    rot00=math.cos(theta)*inv_lambda
-    rot01=math.sin(theta)*inv_lambda
+    if uvdist:
+      # light speed
+      c=2.99792458e8
+      # observation start time
+      hms=f['measurement']['info']['start_time'][0].decode('ascii').split()[1].split(sep=':')
+      # time in hours, in [0,24]
+      start_time=float(hms[0])+float(hms[1])/60.0+float(hms[2])/3600
+      # convert to radians
+      theta=start_time/24.0*(2*math.pi)
+      # frequencies in Hz
+      frq=f['measurement']['saps'][SAP]['central_frequencies']
+      Nf0=frq.shape[0]//2
+      # central frequency
+      freq0=frq[Nf0]
+      # 1/lambda=freq0/c
+      inv_lambda=freq0/c
+      # rotation matrix =[cos(theta) sin(theta); -sin(theta) cos(theta)]
+      rot00=math.cos(theta)*inv_lambda
+      rot01=math.sin(theta)*inv_lambda
 
-    baselines=f['measurement']['saps'][SAP]['baselines']
-    xyz=f['measurement']['saps'][SAP]['antenna_locations']['XYZ']
-    uv=torch.zeros(1,2).to(device,non_blocking=True)
+      baselines=f['measurement']['saps'][SAP]['baselines']
+      xyz=f['measurement']['saps'][SAP]['antenna_locations']['XYZ']
+      uv=torch.zeros(1,2).to(device,non_blocking=True)
 
-    # get u,v coordinates for this baseline
-    # convert xx,yy to wavelengths and rotate by theta
-    xx=xyz[baselines[mybase][0]][0]-xyz[baselines[mybase][1]][0]
-    yy=xyz[baselines[mybase][0]][1]-xyz[baselines[mybase][1]][1]
-    uu=xx*rot00+yy*rot01
-    vv=-xx*rot01+yy*rot00
-    uv[0,0]=uu
-    uv[0,1]=vv
+      # get u,v coordinates for this baseline
+      # convert xx,yy to wavelengths and rotate by theta
+      xx=xyz[baselines[mybase][0]][0]-xyz[baselines[mybase][1]][0]
+      yy=xyz[baselines[mybase][0]][1]-xyz[baselines[mybase][1]][1]
+      uu=xx*rot00+yy*rot01
+      vv=-xx*rot01+yy*rot00
+      uv[0,0]=uu
+      uv[0,1]=vv
 
-  # do some rough cleanup of data
-  ##y[y!=y]=0 # set NaN,Inf to zero
-  x.clamp_(-1e6,1e6) # clip high values
-  x.to(device,non_blocking=True)
+    # do some rough cleanup of data
+    ##y[y!=y]=0 # set NaN,Inf to zero
+    x.clamp_(-1e6,1e6) # clip high values
+    x.to(device,non_blocking=True)
 
-  if uvdist:
-    return x,uv
-  else:
-    return x
+    if uvdist:
+      return x,uv
+    else:
+      return x
+
+########################################################
+def _patch_windows(npatch,max_patch_rows):
+  # split npatch patch rows into windows of at most max_patch_rows rows
+  return [(ci,min(npatch,ci+max_patch_rows)) for ci in range(0,npatch,max_patch_rows)]
+
+def _read_patch_window(vis,mybase,ci0,ci1,cj0,cj1,patch_size,num_channels,stride):
+  # read the part of baseline mybase needed for patch rows ci0..ci1-1
+  # and patch columns cj0..cj1-1 (zero padded where outside the data)
+  # return 1 x num_channels x window time x window freq
+  (nbase,ntime,nfreq,npol,ncomplex)=vis.shape
+  t0=ci0*stride
+  t1=(ci1-1)*stride+patch_size
+  f0=cj0*stride
+  f1=(cj1-1)*stride+patch_size
+  x=torch.zeros(1,num_channels,t1-t0,f1-f0)
+  nt=min(t1,ntime)-t0
+  nf=min(f1,nfreq)-f0
+  if nt>0 and nf>0:
+    fill_channels(x[0,:,:nt,:nf],vis.read_baseline(mybase,slice(t0,t0+nt),slice(f0,f0+nf)),
+      vis.read_scales(mybase)[f0:f0+nf],num_channels)
+  return x
+
+def iter_data_for_baseline(filename,SAP,baseline_id,patch_size=32,num_channels=8,uvdist=False,max_patch_rows=1,freq_patches=None,normalize_data=True,device=None,stride=None):
+  # generator version of get_data_for_baseline() for long observations:
+  # only the time window needed for the next max_patch_rows rows of patches
+  # (and optionally only a frequency sub-band) is read, so memory is capped at
+  # max_patch_rows x patchy patches instead of the full ntime x nfreq plane
+  # freq_patches: (cj0,cj1) range of patch columns to use (default all)
+  # yields (ci,patches) or (ci,patches,uv1) if uvdist=True,
+  # ci: first patch row in this block, patches: nrows*ncols x channels x patch_size x patch_size
+  # ordered as in get_data_for_baseline() (time major), so concatenating all
+  # patches gives the same output as get_data_for_baseline()
+  # normalize_data=True: normalize with the mean,std of all patches of the baseline,
+  # found with an extra streaming pass over the data (which only differs from
+  # get_data_for_baseline() in float rounding of mean,std)
+  # stride: patch stride (default patch_size//2), as in get_data_for_baseline()
+  if not device:
+    device=mydevice
+  assert(num_channels==4 or num_channels==8)
+  with visibility_reader(filename,SAP) as vis:
+    (nbase,ntime,nfreq,npol,ncomplex)=vis.shape
+    mybase=baseline_id
+    if not stride:
+      stride=patch_size//2
+    patchx=(max(ntime,patch_size)-patch_size)//stride+1
+    patchy=(max(nfreq,patch_size)-patch_size)//stride+1
+    (cj0,cj1)=freq_patches if freq_patches else (0,patchy)
+
+    def _patches(ci0,ci1,cj0,cj1):
+      x=_read_patch_window(vis,mybase,ci0,ci1,cj0,cj1,patch_size,num_channels,stride)
+      y=x.unfold(2,patch_size,stride).unfold(3,patch_size,stride)
+      # contiguous(): with one patch row reshape gives a view of overlapping patches
+      y=y[0].permute(1,2,0,3,4).reshape((ci1-ci0)*(cj1-cj0),num_channels,patch_size,patch_size).contiguous()
+      # do some rough cleanup of data
+      return y.clamp_(-1e6,1e6) # clip high values
 
+    if normalize_data:
+      # first pass: statistics of all patches (with their overlap)
+      ysum=0.0
+      ysumsq=0.0
+      for (ci0,ci1) in _patch_windows(patchx,max_patch_rows):
+        y=_patches(ci0,ci1,0,patchy).double()
+        ysum+=y.sum().item()
+        ysumsq+=(y*y).sum().item()
+      N=patchx*patchy*num_channels*patch_size*patch_size
+      ymean=ysum/N
+      ystd=math.sqrt(max(ysumsq-N*ymean*ymean,0.0)/(N-1))
+
+    if uvdist:
+      uv=get_baseline_uv(filename,SAP,[mybase],device=device)
+
+    for (ci0,ci1) in _patch_windows(patchx,max_patch_rows):
+      y=_patches(ci0,ci1,cj0,cj1)
+      if normalize_data:
+        y.sub_(ymean).div_(ystd)
+      y=y.to(device,non_blocking=True)
+      if uvdist:
+        yield ci0,y,uv.repeat(y.shape[0],1)
+      else:
+        yield ci0,y
+
+########################################################
+def iter_data_for_baseline_flat(filename,SAP,baseline_id,num_channels=8,time_rows=256,freq_range=None,device=None):
+  # generator version of get_data_for_baseline_flat() (without unfolding):
+  # reads time_rows time samples (and optionally only frequencies freq_range=(f0,f1))
+  # at a time, yields (t0,x) with x: 1 x channels x time_rows x nfreq,
+  # t0: first time sample in this block
+  if not device:
+    device=mydevice
+  assert(num_channels==4 or num_channels==8)
+  with visibility_reader(filename,SAP) as vis:
+    (nbase,ntime,nfreq,npol,ncomplex)=vis.shape
+    (f0,f1)=freq_range if freq_range else (0,nfreq)
+    scales=vis.read_scales(baseline_id)[f0:f1]
+    for t0 in range(0,ntime,time_rows):
+      t1=min(ntime,t0+time_rows)
+      x=torch.zeros(1,num_channels,t1-t0,f1-f0)
+      fill_channels(x[0],vis.read_baseline(baseline_id,slice(t0,t1),slice(f0,f1)),scales,num_channels)
+      # do some rough cleanup of data
+      x.clamp_(-1e6,1e6) # clip high values
+      yield t0,x.to(device,non_blocking=True)
 
 ########################################################
 def get_metadata(filename,SAP,give_baseline=False):
@@ -469,6 +1003,28 @@ def get_metadata(filename,SAP,give_baseline=False):
   return g.shape
  
 
+########################################################
+def get_valid_SAPs(filename):
+  # return list of SAPs of filename with usable visibilities
+  SAPs=list()
+  f=h5py.File(filename,'r')
+  g=f['measurement']['saps']
+  for SAP in g:
+    try:
+     vis=f['measurement']['saps'][SAP]['visibilities']
+     (nbase,ntime,nfreq,npol,reim)=vis.shape
+     # select valid datasets (larger than 90 say)
+     if nbase>1 and nfreq>=90 and ntime>=90 and npol==4 and reim==2:
+       SAPs.append(SAP)
+    except:
+     log.error('Failed opening'+filename)
+  return SAPs
+
+########################################################
+def get_sas_id(filename):
+  # observation id of a LOFAR H5 file
+  return int(h5py.File(filename,'r')['measurement/sas_id'][0])
+
 ########################################################
 def get_fileSAP(pathname,pattern='L*.MS_extract.h5',exclude=None,include=None):
   # search in pathname for files matching 'pattern'
@@ -495,25 +1051,12 @@ def get_fileSAP(pathname,pattern='L*.MS_extract.h5',exclude=None,include=None):
   # Get meta and see if useful
   for filename in rawlist:
     log.debug(f"[get_fileSAP] Processing file {filename}.")
-    f=h5py.File(filename,'r')
-    g=f['measurement']['saps']
-    SAPs=[SAP for SAP in g]
-    # flag to remember if this file is useful
-    fileused=False
-    if len(SAPs)>0:
-     for SAP in SAPs:
-      try:
-       vis=f['measurement']['saps'][SAP]['visibilities']
-       (nbase,ntime,nfreq,npol,reim)=vis.shape
-       # select valid datasets (larger than 90 say)
-       if nbase>1 and nfreq>=90 and ntime>=90 and npol==4 and reim==2:
-         file_list.append(filename)
-         sap_list.append(SAP)
-         fileused=True
-      except:
-       log.error('Failed opening'+filename)
-    
-    if not fileused:
+    SAPs=get_valid_SAPs(filename)
+    for SAP in SAPs:
+      file_list.append(filename)
+      sap_list.append(SAP)
+
+    if not SAPs:
       # To avoid this being printed every time
       log.debug('File '+filename+' not used') 
 
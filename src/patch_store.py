@@ -0,0 +1,201 @@
+import torch
+import numpy as np
+import h5py
+import json
+import os
+import sys
+import logging
+
+from lofar_tools import *
+from lofar_tools import mydevice
+
+log = logging.getLogger()
+
+# Offline preprocessing of LOFAR H5 extracts into a memory-mapped patch store.
+# The visibilities never change between epochs, so decoding int8 data,
+# applying scale factors, clamping and unfolding into 50% overlapping patches
+# is done once here. Training then only reads the store (pure mmap reads).
+#
+# Store layout (one directory):
+#  patches.npy   : Npatch x channels x patch_size x patch_size (float32 or float16)
+#  uv.npy        : Nbline x 2 u,v coordinates (float32), one row per baseline
+#  index.npy     : Npatch x 4 (sas_id,SAP,baseline,patch) int64
+#  baselines.npy : Nbline x 6 (sas_id,SAP,baseline,first patch,patchx,patchy) int64
+#  meta.json     : patch_size, num_channels, dtype, clamp value and source files
+# Patches of one baseline are contiguous and ordered as in get_data_for_baseline().
+
+########################################################
+def _patch_grid(ntime,nfreq,patch_size):
+  # number of patches along time,freq for 1/2 overlap (as in get_data_minibatch)
+  stride=patch_size//2
+  patchx=(max(ntime,patch_size)-patch_size)//stride+1
+  patchy=(max(nfreq,patch_size)-patch_size)//stride+1
+  return patchx,patchy
+
+########################################################
+def build_patch_store(store_path,file_list,sap_list,patch_size=128,num_channels=4,use_float16=False,clamp=1e3):
+  # file_list,sap_list: as returned by get_fileSAP()
+  # store_path: directory to write the store (created if needed)
+  # use_float16: store patches as float16 (half the disk/page cache footprint)
+  # clamp: clip values to [-clamp,clamp] (same as get_data_minibatch)
+  # normalization is not done here, because it depends on the minibatch,
+  # it is applied when reading (see PatchStoreDataset.get_minibatch())
+  assert(len(file_list)==len(sap_list))
+  assert(num_channels==4 or num_channels==8)
+  os.makedirs(store_path,exist_ok=True)
+  dtype=np.float16 if use_float16 else np.float32
+  stride=patch_size//2
+
+  # first pass: only metadata, to find the size of the store
+  sources=[]
+  npatch=0
+  nbline=0
+  for filename,SAP in zip(file_list,sap_list):
+    sas_id=int(h5py.File(filename,'r')['measurement/sas_id'][0])
+    (nbase,ntime,nfreq,_,_)=get_metadata(filename,SAP)
+    patchx,patchy=_patch_grid(ntime,nfreq,patch_size)
+    sources.append((filename,SAP,sas_id,nbase,patchx,patchy))
+    npatch+=nbase*patchx*patchy
+    nbline+=nbase
+  log.info(f"[build_patch_store] {len(sources)} SAPs, {nbline} baselines, {npatch} patches.")
+
+  patches=np.lib.format.open_memmap(os.path.join(store_path,'patches.npy'),mode='w+',
+      dtype=dtype,shape=(npatch,num_channels,patch_size,patch_size))
+  uv=np.lib.format.open_memmap(os.path.join(store_path,'uv.npy'),mode='w+',
+      dtype=np.float32,shape=(nbline,2))
+  index=np.lib.format.open_memmap(os.path.join(store_path,'index.npy'),mode='w+',
+      dtype=np.int64,shape=(npatch,4))
+  baselines=np.zeros((nbline,6),dtype=np.int64)
+
+  # second pass: read, scale, unfold and write each baseline
+  cp=0
+  cb=0
+  for (filename,SAP,sas_id,nbase,patchx,patchy) in sources:
+    log.debug(f"[build_patch_store] Processing {filename} SAP {SAP}.")
+    for mybase in range(nbase):
+      x,uvb=get_data_for_baseline_flat(filename,SAP,baseline_id=mybase,num_channels=num_channels,uvdist=True,device='cpu')
+      (_,_,ntime,nfreq)=x.shape
+      # pad zeros if ntime or nfreq is smaller than patch_size
+      if ntime<patch_size or nfreq<patch_size:
+        xpad=torch.zeros(1,num_channels,max(ntime,patch_size),max(nfreq,patch_size))
+        xpad[:,:,:ntime,:nfreq]=x
+        x=xpad
+      y=x.unfold(2,patch_size,stride).unfold(3,patch_size,stride)
+      # 1,chan,patchx,patchy,nx,ny -> patchx*patchy,chan,nx,ny
+      y=y[0].permute(1,2,0,3,4).reshape(patchx*patchy,num_channels,patch_size,patch_size)
+      y.clamp_(-clamp,clamp)
+      nb=patchx*patchy
+      patches[cp:cp+nb]=y.numpy().astype(dtype)
+      index[cp:cp+nb,0]=sas_id
+      index[cp:cp+nb,1]=int(SAP)
+      index[cp:cp+nb,2]=mybase
+      index[cp:cp+nb,3]=np.arange(nb)
+      uv[cb]=uvb[0].cpu().numpy()
+      baselines[cb]=(sas_id,int(SAP),mybase,cp,patchx,patchy)
+      cp+=nb
+      cb+=1
+
+  patches.flush()
+  uv.flush()
+  index.flush()
+  del patches,uv,index
+  np.save(os.path.join(store_path,'baselines.npy'),baselines)
+  meta={'patch_size':patch_size,'num_channels':num_channels,
+     'dtype':np.dtype(dtype).name,'clamp':clamp,
+     'files':[[f,s] for f,s in zip(file_list,sap_list)]}
+  with open(os.path.join(store_path,'meta.json'),'w') as fp:
+    json.dump(meta,fp,indent=1)
+
+########################################################
+class PatchStoreDataset(torch.utils.data.Dataset):
+  """
+  Random access dataset over a patch store written by build_patch_store().
+  One item is one baseline: (patches,uv) with patches of size
+  patchx*patchy x channels x patch_size x patch_size and uv of size patchx*patchy x 2.
+  All arrays are memory-mapped, so nothing is read until it is indexed.
+
+  store_path: (str) directory of the store
+  """
+  def __init__(self,store_path):
+    with open(os.path.join(store_path,'meta.json'),'r') as fp:
+      self.meta=json.load(fp)
+    self.patch_size=self.meta['patch_size']
+    self.num_channels=self.meta['num_channels']
+    self.patches=np.load(os.path.join(store_path,'patches.npy'),mmap_mode='r')
+    self.uv=np.load(os.path.join(store_path,'uv.npy'),mmap_mode='r')
+    self.index=np.load(os.path.join(store_path,'index.npy'),mmap_mode='r')
+    self.baselines=np.load(os.path.join(store_path,'baselines.npy'))
+    # group baselines by source (sas_id,SAP), each source has one patch grid
+    self.sources=dict()
+    for ci in range(self.baselines.shape[0]):
+      key=(int(self.baselines[ci,0]),int(self.baselines[ci,1]))
+      if key not in self.sources:
+        self.sources[key]=list()
+      self.sources[key].append(ci)
+    self.source_keys=list(self.sources.keys())
+    for key in self.source_keys:
+      self.sources[key]=np.array(self.sources[key])
+
+  def __len__(self):
+    return self.baselines.shape[0]
+
+  def __getitem__(self,idx):
+    (_,_,_,start,patchx,patchy)=self.baselines[idx]
+    nb=patchx*patchy
+    y=torch.from_numpy(np.array(self.patches[start:start+nb],dtype=np.float32))
+    uv=torch.from_numpy(np.array(self.uv[idx],dtype=np.float32)).repeat(nb,1)
+    return y,uv
+
+  def get_minibatch(self,batch_size=2,normalize_data=False,transform=None,device=None):
+    # drop-in replacement of get_data_minibatch(...,uvdist=True):
+    # select a source (sas_id,SAP) at random and batch_size baselines of it
+    # (sorted, no duplicates, as sample_baselines())
+    # patches of each baseline are kept together (as augmented_loss expects)
+    # return patchx,patchy,y,uv1
+    if not device:
+      device=mydevice
+    key=self.source_keys[np.random.randint(0,len(self.source_keys))]
+    rows=self.sources[key][sample_baselines(len(self.sources[key]),batch_size)]
+    patchx=int(self.baselines[rows[0],4])
+    patchy=int(self.baselines[rows[0],5])
+    nb=patchx*patchy
+    y=torch.zeros(batch_size*nb,self.num_channels,self.patch_size,self.patch_size)
+    uv1=torch.zeros(batch_size*nb,2)
+    # read in ascending order of position in the store
+    order=np.argsort(rows,kind='stable')
+    for ck in order:
+      start=self.baselines[rows[ck],3]
+      y[ck*nb:(ck+1)*nb]=torch.from_numpy(np.array(self.patches[start:start+nb],dtype=np.float32))
+      uv1[ck*nb:(ck+1)*nb]=torch.from_numpy(np.array(self.uv[rows[ck]],dtype=np.float32))
+    y=y.to(device,non_blocking=True)
+    uv1=uv1.to(device,non_blocking=True)
+
+    # normalize data
+    if normalize_data:
+      ymean=y.mean()
+      ystd=y.std()
+      y.sub_(ymean).div_(ystd)
+
+    # transform
+    if transform:
+      y1=torch.zeros(2*batch_size*nb,self.num_channels,self.patch_size,self.patch_size).to(device,non_blocking=True)
+      uv2=torch.zeros(2*batch_size*nb,2).to(device,non_blocking=True)
+      for ci in range(batch_size):
+        y1[2*ci*nb:(2*ci+1)*nb]=y[ci*nb:(ci+1)*nb]
+        y1[(2*ci+1)*nb:(2*ci+2)*nb]=transform(y[ci*nb:(ci+1)*nb])
+        uv2[2*ci*nb:(2*ci+2)*nb]=uv1[ci*nb:(ci+1)*nb].repeat(2,1)
+      y=y1
+      uv1=uv2
+
+    return patchx,patchy,y,uv1
+
+########################################################
+if __name__=='__main__':
+  # usage: python patch_store.py data_path store_path [patch_size] [float16]
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s %(message)s')
+  data_path=sys.argv[1]
+  store_path=sys.argv[2]
+  patch_size=int(sys.argv[3]) if len(sys.argv)>3 else 128
+  use_float16=(len(sys.argv)>4 and sys.argv[4]=='float16')
+  file_list,sap_list=get_fileSAP(data_path)
+  build_patch_store(store_path,file_list,sap_list,patch_size=patch_size,use_float16=use_float16)
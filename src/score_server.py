@@ -0,0 +1,224 @@
+import torch
+import numpy as np
+import asyncio
+import collections
+import json
+import os
+import socket
+import sys
+import time
+import logging
+
+from lofar_tools import *
+from lofar_models import *
+
+log = logging.getLogger()
+
+# Long running scoring service: the trained cascade (net, netT, netF) and
+# the K-harmonic centroids (khm) are loaded once, then jobs are received over
+# a Unix socket (or TCP) as JSON lines
+#   {"file": "L123.MS_extract.h5", "SAP": "0", "baselines": [first, last+1]}
+# and one JSON line is sent back per baseline as it is scored
+#   {"baseline": nb, "distances": [...], "cluster": k}
+# followed by {"done": true, "latency": seconds} (or {"error": "..."}).
+# {"stats": true} returns queue depth, batches and latency percentiles.
+# Baselines of concurrent jobs (same file and SAP) are scored together in
+# batches of up to max_batch baselines, waiting at most max_latency seconds
+# for a batch to fill.
+
+# model configuration (same as evaluate_clustering.py)
+L=256-32 # latent dimension
+Lt=16 # latent dimensions in time/frequency axes (1D CNN)
+Kc=10 # K-harmonic clusters
+Khp=4 # order of K harmonic mean 1/|| ||^p norm
+use_rica=True
+patch_size=128
+num_in_channels=4
+
+########################################################
+def load_models(model_dir='.',device='cpu'):
+  # return AutoEncoderCascade, Kmeans loaded from model_dir/{net,netT,netF,khm}.model
+  harmonic_scales=torch.tensor([1e-4, 1e-3, 1e-2, 1e-1]).to(device)
+  net=AutoEncoderCNN2(latent_dim=L,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica)
+  netT=AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica)
+  netF=AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica)
+  mod=Kmeans(latent_dim=(L+Lt+Lt),K=Kc,p=Khp)
+  for model,name in [(net,'net'),(netT,'netT'),(netF,'netF'),(mod,'khm')]:
+    checkpoint=torch.load(os.path.join(model_dir,name+'.model'),map_location=torch.device(device))
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model.to(device)
+    model.eval()
+  return AutoEncoderCascade(net,netT,netF),mod
+
+########################################################
+class ScoreServer(object):
+  """
+  Micro-batching scoring server.
+
+  cascade: AutoEncoderCascade, mod: Kmeans
+  max_batch: (int) max baselines scored together
+  max_latency: (float) max seconds to wait for more baselines before scoring a batch
+  device: device of the models
+  """
+  def __init__(self,cascade,mod,max_batch=32,max_latency=0.05,device='cpu'):
+    self.cascade=cascade
+    self.mod=mod
+    self.max_batch=max_batch
+    self.max_latency=max_latency
+    self.device=device
+    # pending work: (filename,SAP,baseline,reply queue)
+    self.pending=collections.deque()
+    self.wakeup=None
+    self._batcher=None
+    self.latencies=collections.deque(maxlen=10000)
+    self.batches=0
+    self.scored=0
+
+  def score_batch(self,filename,SAP,baselinelist):
+    # run in a worker thread: distances (n x K) and clusters (n) of the baselines
+    with torch.no_grad():
+      patchx,patchy,x,uv=get_data_for_baselines(filename,SAP,baselinelist,patch_size=patch_size,num_channels=num_in_channels,uvdist=True,device=self.device)
+      Mu=self.cascade.latents(x,uv)
+      dist=self.mod.group_mean(self.mod.distances(Mu),patchx*patchy)
+    return dist.cpu().numpy(),torch.argmin(dist,dim=1).cpu().numpy()
+
+  async def batcher(self):
+    loop=asyncio.get_running_loop()
+    while True:
+      while not self.pending:
+        self.wakeup.clear()
+        await self.wakeup.wait()
+      # give other requests max_latency to join, unless the batch is full
+      deadline=loop.time()+self.max_latency
+      while len(self.pending)<self.max_batch and loop.time()<deadline:
+        self.wakeup.clear()
+        try:
+          await asyncio.wait_for(self.wakeup.wait(),deadline-loop.time())
+        except asyncio.TimeoutError:
+          break
+      # take up to max_batch baselines of the same file,SAP as the oldest one
+      (filename,SAP,_,_)=self.pending[0]
+      batch=list()
+      rest=collections.deque()
+      while self.pending:
+        item=self.pending.popleft()
+        if len(batch)<self.max_batch and item[0]==filename and item[1]==SAP:
+          batch.append(item)
+        else:
+          rest.append(item)
+      self.pending=rest
+      baselinelist=np.array([item[2] for item in batch])
+      try:
+        dist,cluster=await loop.run_in_executor(None,self.score_batch,filename,SAP,baselinelist)
+        for ci,item in enumerate(batch):
+          item[3].put_nowait({'baseline':int(item[2]),'distances':dist[ci].tolist(),'cluster':int(cluster[ci])})
+      except Exception as e:
+        log.exception(f"[ScoreServer] {filename} SAP {SAP}")
+        for item in batch:
+          item[3].put_nowait({'baseline':int(item[2]),'error':str(e)})
+      self.batches+=1
+      self.scored+=len(batch)
+
+  def stats(self):
+    lat=np.array(self.latencies) if self.latencies else np.zeros(1)
+    return {'queue_depth':len(self.pending),'batches':self.batches,'scored':self.scored,
+       'mean_batch':self.scored/max(1,self.batches),
+       'latency_p50':float(np.percentile(lat,50)),'latency_p90':float(np.percentile(lat,90)),
+       'latency_p99':float(np.percentile(lat,99))}
+
+  async def handle(self,reader,writer):
+    # one connection, any number of requests (one JSON object per line)
+    while True:
+      line=await reader.readline()
+      if not line:
+        break
+      try:
+        request=json.loads(line)
+        if request.get('stats'):
+          writer.write((json.dumps(self.stats())+'\n').encode())
+          await writer.drain()
+          continue
+        tic=time.perf_counter()
+        (first,last)=request['baselines']
+        replies=asyncio.Queue()
+        for nb in range(first,last):
+          self.pending.append((request['file'],str(request['SAP']),nb,replies))
+        self.wakeup.set()
+        for ci in range(last-first):
+          writer.write((json.dumps(await replies.get())+'\n').encode())
+          await writer.drain()
+        latency=time.perf_counter()-tic
+        self.latencies.append(latency)
+        writer.write((json.dumps({'done':True,'latency':latency})+'\n').encode())
+      except Exception as e:
+        writer.write((json.dumps({'error':str(e)})+'\n').encode())
+      await writer.drain()
+    writer.close()
+
+  async def serve(self,address):
+    # address: path of a Unix socket, or host:port
+    self.wakeup=asyncio.Event()
+    if ':' in address:
+      host,port=address.rsplit(':',1)
+      server=await asyncio.start_server(self.handle,host,int(port))
+    else:
+      server=await asyncio.start_unix_server(self.handle,address)
+    log.info(f"[ScoreServer] listening on {address}.")
+    self._batcher=asyncio.create_task(self.batcher())
+    def batcher_done(task):
+      # the batcher only returns on an error: stop serving, clients would wait forever
+      if not task.cancelled() and task.exception():
+        log.error("[ScoreServer] batcher failed, closing the server.",exc_info=task.exception())
+        server.close()
+    self._batcher.add_done_callback(batcher_done)
+    try:
+      async with server:
+        await server.serve_forever()
+    except asyncio.CancelledError:
+      # closed by batcher_done(): report why
+      if self._batcher.done() and not self._batcher.cancelled() and self._batcher.exception():
+        raise self._batcher.exception()
+      raise
+    finally:
+      self._batcher.cancel()
+
+########################################################
+def request(address,message):
+  # client: send one request, yield the replies until done (or error)
+  if ':' in address:
+    host,port=address.rsplit(':',1)
+    sock=socket.create_connection((host,int(port)))
+  else:
+    sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    sock.connect(address)
+  with sock,sock.makefile('rw') as fp:
+    fp.write(json.dumps(message)+'\n')
+    fp.flush()
+    for line in fp:
+      reply=json.loads(line)
+      yield reply
+      if 'done' in reply or 'stats' in message or ('error' in reply and 'baseline' not in reply):
+        break
+
+########################################################
+if __name__=='__main__':
+  # usage:
+  #  python score_server.py serve address [model_dir] [max_batch] [max_latency]
+  #  python score_server.py score address filename SAP first last
+  #  python score_server.py stats address
+  # address: Unix socket path or host:port
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s %(message)s')
+  command,address=sys.argv[1:3]
+  if command=='serve':
+    model_dir=sys.argv[3] if len(sys.argv)>3 else '.'
+    max_batch=int(sys.argv[4]) if len(sys.argv)>4 else 32
+    max_latency=float(sys.argv[5]) if len(sys.argv)>5 else 0.05
+    cascade,mod=load_models(model_dir,device=mydevice)
+    server=ScoreServer(cascade,mod,max_batch=max_batch,max_latency=max_latency,device=mydevice)
+    asyncio.run(server.serve(address))
+  elif command=='score':
+    for reply in request(address,{'file':sys.argv[3],'SAP':sys.argv[4],'baselines':[int(sys.argv[5]),int(sys.argv[6])]}):
+      print(json.dumps(reply))
+  elif command=='stats':
+    for reply in request(address,{'stats':True}):
+      print(json.dumps(reply))
@@ -0,0 +1,143 @@
+import numpy as np
+import h5py
+import logging
+
+log = logging.getLogger()
+
+# Columnar per baseline output of evaluate_clustering, written as the
+# baselines are scored (so a partial run keeps everything done so far)
+# and read back by slicing (nothing is loaded until it is indexed).
+#
+# HDF5 layout, one row per (sas_id,SAP,baseline), all datasets chunked and extendible:
+#  key         : N x 3 (sas_id,SAP,baseline) int64
+#  distances   : N x K mean ||x-m_k||^p over the patches of the baseline, float32
+#  cluster     : N hard K-harmonic cluster, int32
+#  kharmonic   : N K-harmonic loss of the baseline, float32
+#  latent      : N x L mean latent vector over the patches, float32
+#  recon_error : N mean squared reconstruction error, float32
+# attribute 'rows' is the number of rows written completely.
+
+_columns=['key','distances','cluster','kharmonic','latent','recon_error']
+
+########################################################
+class ScoreWriter(object):
+  """
+  Append per baseline scores to an HDF5 file.
+
+  filename: (str) output file, appended to if it exists
+  K: (int) number of centroids
+  latent_dim: (int) dimension of the latent vectors
+  chunk_rows: (int) rows per HDF5 chunk
+  overwrite: (bool) start a new file even if it exists
+  """
+  def __init__(self,filename,K,latent_dim,chunk_rows=1024,overwrite=False):
+    self.f=h5py.File(filename,'w' if overwrite else 'a')
+    shapes={'key':((3,),np.int64),'distances':((K,),np.float32),'cluster':((),np.int32),
+       'kharmonic':((),np.float32),'latent':((latent_dim,),np.float32),'recon_error':((),np.float32)}
+    for name in _columns:
+      (shape,dtype)=shapes[name]
+      if name not in self.f:
+        self.f.create_dataset(name,shape=(0,)+shape,maxshape=(None,)+shape,
+           chunks=(chunk_rows,)+shape,dtype=dtype)
+      elif self.f[name].shape[1:]!=shape:
+        raise ValueError(f"{filename}: {name} has shape {self.f[name].shape[1:]}, expected {shape}")
+    self.rows=int(self.f.attrs.get('rows',0))
+
+  def append(self,sas_id,SAP,baselines,distances,cluster,kharmonic,latent,recon_error):
+    # baselines: (n,) baseline ids of one SAP, others : n rows (numpy or torch on cpu)
+    n=len(baselines)
+    key=np.zeros((n,3),dtype=np.int64)
+    key[:,0]=sas_id
+    key[:,1]=int(SAP)
+    key[:,2]=baselines
+    values={'key':key,'distances':distances,'cluster':cluster,'kharmonic':kharmonic,
+       'latent':latent,'recon_error':recon_error}
+    for name in _columns:
+      d=self.f[name]
+      d.resize(self.rows+n,axis=0)
+      d[self.rows:self.rows+n]=np.asarray(values[name],dtype=d.dtype)
+    self.rows+=n
+    # rows are only counted as written after all columns are
+    self.f.attrs['rows']=self.rows
+    self.f.flush()
+
+  def truncate(self,rows):
+    # drop all rows after the first rows (e.g. of an interrupted observation)
+    if rows<self.rows:
+      for name in _columns:
+        self.f[name].resize(rows,axis=0)
+      self.rows=rows
+      self.f.attrs['rows']=self.rows
+      self.f.flush()
+
+  def remove(self,sas_id,SAP):
+    # drop the rows of one observation SAP (e.g. before scoring it again),
+    # the other rows are moved up, one chunk at a time
+    key=self.f['key'][:self.rows]
+    keep=np.flatnonzero((key[:,0]!=sas_id)|(key[:,1]!=int(SAP)))
+    if keep.shape[0]==self.rows:
+      return
+    # until done, only the rows before the first removed one count as written
+    first=np.flatnonzero(keep!=np.arange(keep.shape[0]))
+    self.f.attrs['rows']=int(first[0]) if first.shape[0]>0 else keep.shape[0]
+    self.f.flush()
+    chunk_rows=self.f['key'].chunks[0]
+    for name in _columns:
+      d=self.f[name]
+      nout=0
+      for ci in range(0,self.rows,chunk_rows):
+        sel=keep[(keep>=ci)&(keep<ci+chunk_rows)]
+        if sel.shape[0]>0:
+          # rows are only moved towards the start, so unread rows are not overwritten
+          d[nout:nout+sel.shape[0]]=d[ci:min(self.rows,ci+chunk_rows)][sel-ci]
+          nout+=sel.shape[0]
+    self.truncate(keep.shape[0])
+    log.info(f"[ScoreWriter] removed {key.shape[0]-keep.shape[0]} rows of {sas_id} SAP {SAP}.")
+
+  def close(self):
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,traceback):
+    self.close()
+
+########################################################
+class ScoreReader(object):
+  """
+  Read a file written by ScoreWriter by slicing,
+  reader[a:b] or reader[index array] returns a dict of columns.
+
+  filename: (str) input file
+  columns: (list of str) columns to read, default all
+  """
+  def __init__(self,filename,columns=None):
+    self.f=h5py.File(filename,'r')
+    self.rows=int(self.f.attrs.get('rows',0))
+    self.columns=columns if columns else _columns
+
+  def __len__(self):
+    return self.rows
+
+  def __getitem__(self,idx):
+    if isinstance(idx,slice):
+      idx=slice(*idx.indices(self.rows))
+    else:
+      idx=np.asarray(idx)
+    return {name:self.f[name][idx] for name in self.columns}
+
+  def rows_of(self,sas_id,SAP):
+    # row indices of one observation SAP (reads only the key column)
+    key=self.f['key'][:self.rows]
+    return np.flatnonzero((key[:,0]==sas_id)&(key[:,1]==int(SAP)))
+
+  def iter_chunks(self,chunk_rows=None):
+    # iterate over all rows, one HDF5 chunk at a time
+    if not chunk_rows:
+      chunk_rows=self.f['key'].chunks[0]
+    for ci in range(0,self.rows,chunk_rows):
+      yield self[ci:min(self.rows,ci+chunk_rows)]
+
+  def close(self):
+    self.f.close()
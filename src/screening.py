@@ -0,0 +1,176 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+import sys
+import time
+import logging
+
+from lofar_tools import *
+from lofar_models import *
+from score_store import ScoreReader
+from score_server import load_models, Kc, num_in_channels
+from ingest import score_range
+
+log = logging.getLogger()
+
+# Two tier screening: a small encoder (FastScreeningEncoder) sees each baseline
+# averaged down to input_size x input_size and predicts the K-harmonic loss
+# the full cascade would give it. Only baselines with a predicted loss above
+# a threshold are scored by the full models (2D + two 1D autoencoders on
+# 50% overlapping 128x128 patches), the others are taken to be healthy.
+# The encoder is distilled from a score file (score_store.py) of the full models.
+# A baseline is flagged by the full pipeline if its loss is above the
+# flag_quantile quantile of the training baselines; the screening threshold
+# is set so that target_recall of the flagged held out baselines pass it.
+#
+#  python screening.py train data_path scores.h5 screen.model [epochs]
+#  python screening.py evaluate filename SAP screen.model [model_dir]
+
+input_size=64
+flag_quantile=0.9
+target_recall=0.99
+baseline_batch=16
+
+harmonic_scales=torch.tensor([1e-4, 1e-3, 1e-2, 1e-1])
+
+########################################################
+def screen_inputs(filename,SAP,baselinelist,device='cpu'):
+  # baselines averaged down to input_size x input_size, each normalized by its mean,std
+  # return x: len(baselinelist) x num_in_channels x input_size x input_size, uv: len(baselinelist) x 2
+  x,uv=read_baselines_padded(filename,SAP,baselinelist,patch_size=input_size,num_channels=num_in_channels,uvdist=True,device=device)
+  x.clamp_(-1e3,1e3)
+  x=F.adaptive_avg_pool2d(x,(input_size,input_size))
+  xstd,xmean=torch.std_mean(x.reshape(x.shape[0],-1),dim=1)
+  x=(x-xmean.view(-1,1,1,1))/(xstd.view(-1,1,1,1)+1e-6)
+  return x,uv
+
+########################################################
+def train_screening(file_list,sap_list,score_file,model_file,epochs=20,device='cpu'):
+  # distill FastScreeningEncoder from the rows of score_file (of observations in file_list,sap_list)
+  reader=ScoreReader(score_file,columns=['key','distances','kharmonic'])
+  rows=reader[:]
+  files={(get_sas_id(f),int(s)):(f,s) for f,s in zip(file_list,sap_list)}
+  # inputs of all scored baselines (small, kept in memory)
+  X=list()
+  UV=list()
+  Y=list()
+  for (sas_id,SAP) in np.unique(rows['key'][:,:2],axis=0):
+    if (sas_id,SAP) not in files:
+      continue
+    (filename,sap)=files[(sas_id,SAP)]
+    sel=np.flatnonzero((rows['key'][:,0]==sas_id)&(rows['key'][:,1]==SAP))
+    for ci in range(0,sel.shape[0],baseline_batch):
+      idx=sel[ci:ci+baseline_batch]
+      x,uv=screen_inputs(filename,sap,rows['key'][idx,2],device='cpu')
+      X.append(x)
+      UV.append(uv.cpu())
+      Y.append(torch.log(torch.from_numpy(np.column_stack((rows['distances'][idx],rows['kharmonic'][idx])))))
+  X=torch.cat(X)
+  UV=torch.cat(UV)
+  Y=torch.cat(Y).float()
+  nbase=X.shape[0]
+  log.info(f"[train_screening] {nbase} baselines.")
+  # hold out 20% for calibration of the threshold
+  perm=torch.randperm(nbase)
+  ntrain=max(1,int(0.8*nbase))
+  train,calib=perm[:ntrain],perm[ntrain:] if nbase>ntrain else perm
+
+  enc=FastScreeningEncoder(channels=num_in_channels,input_size=input_size,K=Kc,harmonic_scales=harmonic_scales.to(device)).to(device)
+  optimizer=torch.optim.Adam(enc.parameters(),lr=1e-3)
+  # standardize targets
+  ymean=Y[train].mean(dim=0)
+  ystd=Y[train].std(dim=0)+1e-6
+  for epoch in range(epochs):
+    order=train[torch.randperm(ntrain)]
+    epoch_loss=0
+    for ci in range(0,ntrain,64):
+      idx=order[ci:ci+64]
+      optimizer.zero_grad()
+      pred=enc(X[idx].to(device),UV[idx].to(device))
+      loss=F.mse_loss(pred,((Y[idx]-ymean)/ystd).to(device))
+      loss.backward()
+      optimizer.step()
+      epoch_loss+=loss.item()*idx.shape[0]
+    log.info(f"[train_screening] epoch {epoch} loss {epoch_loss/ntrain:e}")
+
+  # threshold: predicted log loss that keeps target_recall of the flagged calibration baselines
+  enc.eval()
+  with torch.no_grad():
+    pred=enc(X[calib].to(device),UV[calib].to(device)).cpu()*ystd+ymean
+  flag_threshold=float(torch.quantile(Y[train,Kc],flag_quantile))
+  flagged=Y[calib,Kc]>=flag_threshold
+  if flagged.any():
+    threshold=float(torch.quantile(pred[flagged,Kc],1.0-target_recall))
+  else:
+    threshold=flag_threshold
+  torch.save({'model_state_dict':enc.state_dict(),'ymean':ymean,'ystd':ystd,
+     'threshold':threshold,'flag_threshold':flag_threshold},model_file)
+  log.info(f"[train_screening] flag log loss >= {flag_threshold:f}, screening threshold {threshold:f}.")
+
+########################################################
+def load_screening(model_file,device='cpu'):
+  checkpoint=torch.load(model_file,map_location=torch.device(device))
+  enc=FastScreeningEncoder(channels=num_in_channels,input_size=input_size,K=Kc,harmonic_scales=harmonic_scales.to(device))
+  enc.load_state_dict(checkpoint['model_state_dict'])
+  enc.to(device)
+  enc.eval()
+  return enc,checkpoint
+
+########################################################
+def screen(filename,SAP,enc,checkpoint,device='cpu'):
+  # predicted log distances and loss of all baselines of a SAP,
+  # return predictions (nbase x K+1), baselines passing the threshold
+  (nbase,_,_,_,_)=get_metadata(filename,SAP)
+  pred=torch.zeros(nbase,Kc+1)
+  with torch.no_grad():
+    for nb0 in range(0,nbase,baseline_batch):
+      baselinelist=np.arange(nb0,min(nbase,nb0+baseline_batch))
+      x,uv=screen_inputs(filename,SAP,baselinelist,device=device)
+      pred[baselinelist]=enc(x,uv).cpu()*checkpoint['ystd']+checkpoint['ymean']
+  return pred,np.flatnonzero(pred[:,Kc].numpy()>=checkpoint['threshold'])
+
+########################################################
+class _Rows(object):
+  # collects score_range() output in memory (same interface as ScoreWriter.append)
+  def __init__(self):
+    self.rows=list()
+  def append(self,sas_id,SAP,baselines,distances,cluster,kharmonic,latent,recon_error):
+    self.rows+=list(zip(baselines,kharmonic))
+
+########################################################
+def evaluate_screening(filename,SAP,enc,checkpoint,cascade,mod,device='cpu'):
+  # recall of screening against the full pipeline on one observation, and speedup
+  (nbase,_,_,_,_)=get_metadata(filename,SAP)
+  tic=time.perf_counter()
+  full=_Rows()
+  score_range(filename,SAP,0,nbase,cascade,mod,full,device=device)
+  t_full=time.perf_counter()-tic
+  kharmonic=np.zeros(nbase)
+  for nb,k in full.rows:
+    kharmonic[nb]=k
+  flagged=np.log(kharmonic)>=checkpoint['flag_threshold']
+
+  tic=time.perf_counter()
+  _,passed=screen(filename,SAP,enc,checkpoint,device=device)
+  screened=_Rows()
+  # full models only on the baselines passing the screening (in contiguous runs)
+  for (_,first,last) in baseline_runs(passed):
+    score_range(filename,SAP,first,last,cascade,mod,screened,device=device)
+  t_screen=time.perf_counter()-tic
+
+  recall=np.sum(flagged[passed])/max(1,np.sum(flagged))
+  result={'baselines':nbase,'flagged':int(np.sum(flagged)),'passed':int(passed.shape[0]),
+    'recall':float(recall),'time_full':t_full,'time_screening':t_screen,'speedup':t_full/t_screen}
+  log.info(f"[evaluate_screening] {result}")
+  return result
+
+########################################################
+if __name__=='__main__':
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s %(message)s')
+  if sys.argv[1]=='train':
+    file_list,sap_list=get_fileSAP(sys.argv[2])
+    train_screening(file_list,sap_list,sys.argv[3],sys.argv[4],epochs=int(sys.argv[5]) if len(sys.argv)>5 else 20,device=mydevice)
+  elif sys.argv[1]=='evaluate':
+    enc,checkpoint=load_screening(sys.argv[4],device=mydevice)
+    cascade,mod=load_models(sys.argv[5] if len(sys.argv)>5 else '.',device=mydevice)
+    print(evaluate_screening(sys.argv[2],sys.argv[3],enc,checkpoint,cascade,mod,device=mydevice))
@@ -0,0 +1,69 @@
+import numpy as np
+import logging
+
+from lofar_graph import station_incidence
+
+log = logging.getLogger()
+
+# Station level view of per baseline scores: the score of a station is the
+# mean over the (scored) baselines using that station, computed with the
+# sparse station incidence matrix, score = B^T values / B^T 1.
+# Scores are updated as batches of baselines are scored.
+
+########################################################
+class StationHealth(object):
+  """
+  Aggregate per baseline values (distances to centroids, cluster memberships...)
+  into per station means.
+
+  baselines: nbase x 2 station ids (get_metadata(...,give_baseline=True))
+  ncols: (int) number of values per baseline
+  """
+  def __init__(self,baselines,ncols):
+    B,self.stations=station_incidence(np.asarray(baselines,dtype=np.int64))
+    # nstation x nbase
+    self.Bt=B.T.tocsc()
+    (nstation,nbase)=self.Bt.shape
+    self.values=np.zeros((nbase,ncols))
+    self.scored=np.zeros(nbase,dtype=bool)
+    self.sums=np.zeros((nstation,ncols))
+    self.counts=np.zeros(nstation)
+
+  def update(self,baselinelist,values):
+    # baselinelist: (n,) baselines, values: n x ncols
+    # baselines scored before are replaced by the new values
+    baselinelist=np.asarray(baselinelist)
+    values=np.asarray(values,dtype=np.float64).reshape(baselinelist.shape[0],-1)
+    Bsub=self.Bt[:,baselinelist]
+    old=self.scored[baselinelist]
+    self.sums+=Bsub@(values-self.values[baselinelist])
+    self.counts+=Bsub@(~old).astype(np.float64)
+    self.values[baselinelist]=values
+    self.scored[baselinelist]=True
+
+  def scores(self):
+    # nstation x ncols mean over the scored baselines of each station (nan if none)
+    with np.errstate(invalid='ignore',divide='ignore'):
+      return self.sums/self.counts[:,None]
+
+  def outliers(self,cols=None):
+    # robust z-score of each station: (score-median)/(1.4826 MAD) over stations
+    # cols: columns to use (mean over them), None: all columns
+    s=self.scores()
+    s=np.nanmean(s if cols is None else s[:,cols],axis=1)
+    med=np.nanmedian(s)
+    mad=1.4826*np.nanmedian(np.abs(s-med))
+    return (s-med)/(mad+1e-12)
+
+  def save(self,filename,header=None,cols=None):
+    # csv: station id, number of scored baselines, scores, z-score (of cols, see outliers())
+    table=np.column_stack((self.stations,self.counts,self.scores(),self.outliers(cols)))
+    np.savetxt(filename,table,delimiter=',',header=header if header else '',fmt='%.6g')
+
+########################################################
+def one_hot(cluster,K):
+  # cluster ids (n,) -> n x K memberships, so station scores are cluster fractions
+  cluster=np.asarray(cluster,dtype=np.int64)
+  Y=np.zeros((cluster.shape[0],K))
+  Y[np.arange(cluster.shape[0]),cluster]=1
+  return Y
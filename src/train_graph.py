@@ -4,7 +4,10 @@ import torch.nn.functional as F
 import numpy as np
 import h5py
 
+from lofar_tools import *
 from lofar_models import *
+from lofar_graph import *
+from latent_store import checkpoint_hash
 
 from matplotlib import pyplot as plt
 
@@ -22,25 +25,32 @@ else:
 
 # Load pre-trained model to evaluate clustering for given LOFAR dataset
 
-L=256 # latent dimension
-Lt=32 # latent dimensions in time/frequency axes (1D CNN)
+L=256-32 # latent dimension
+Lt=16 # latent dimensions in time/frequency axes (1D CNN)
 Kc=10 # K-harmonic clusters
 Khp=4 # order of K harmonic mean 1/|| ||^p norm
 Ko=10 # final hard clusters
 
 patch_size=128
 
+baseline_batch=16 # number of baselines passed through the models at once
+feature_cache='./graph_cache' # directory to keep node features, None: no cache
+# reconstruction ICA
+use_rica=True
+
 # enable this to create psuedocolor images using all XX and YY
 colour_output=True
 
 
 num_in_channels=4 # real,imag XX,YY
+# harmonic scales to use (sin,cos)(scale*u, scale*v) and so on
+harmonic_scales=torch.tensor([1e-4, 1e-3, 1e-2, 1e-1]).to(mydevice)
 # for 128x128 patches
-net=AutoEncoderCNN2(latent_dim=L,channels=num_in_channels)
+net=AutoEncoderCNN2(latent_dim=L,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica)
 
 # 1D autoencoders
-net1D1=AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels)
-net1D2=AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels)
+net1D1=AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica)
+net1D2=AutoEncoder1DCNN(latent_dim=Lt,channels=num_in_channels,harmonic_scales=harmonic_scales,rica=use_rica)
 mod=Kmeans(latent_dim=(L+Lt+Lt),p=Khp)
 
 checkpoint=torch.load('./net.model',map_location=mydevice)
@@ -70,88 +80,42 @@ which_sap=0 # valid in file_list/sap_list -7
 # get nbase,nfreq,ntime,npol,ncomplex
 baselines,(nbase,nfreq,ntime,npol,ncomplex)=get_metadata(file_list[which_sap],sap_list[which_sap],give_baseline=True)
 
-# for debugging use a low value
-NBASE=1000
-#NBASE=nbase
-
-#########################################################################
-def build_edge_graph(baselines):
- # build edge graph (returns edge index, indexed according to basline number)
- # nodes are the baselines
- # for basline sta1,sta2 : edges for all other balines having sta1 or sta2
-  (nbase,_)=baselines.shape
-  # station to basline mapping
-  stations=dict()
-  for nb in range(NBASE):#range(nbase):
-    bline=baselines[nb]
-    if bline[0] not in stations.keys():
-     stations[bline[0]]=list()
-    if nb not in stations[bline[0]]:
-      stations[bline[0]].append(nb)
-    if bline[1] not in stations.keys():
-     stations[bline[1]]=list()
-    if nb not in stations[bline[1]]:
-     stations[bline[1]].append(nb)
-  #print(stations)
-  edgelist=list()
-  for nb in range(NBASE):#range(nbase):
-    bline=baselines[nb]
-    for id1 in stations[bline[0]]:
-      edgelist.append([nb, id1])
-    if bline[0] != bline[1]:
-      for id1 in stations[bline[1]]:
-        if id1 !=nb:
-         edgelist.append([nb, id1])
- 
-  edge_index=np.array(edgelist) 
-  return edge_index
-#########################################################################
-edge_index_np=build_edge_graph(baselines)
-# edge index: baseline id
-edge_index=torch.tensor(edge_index_np.transpose(),dtype=torch.long).contiguous()
-
-# get one baseline to get patch sizes
-patchx,patchy,x=get_data_for_baseline(file_list[which_sap],sap_list[which_sap],baseline_id=0,patch_size=128,num_channels=num_in_channels)
+# message passing through the station incidence matrix, without building the edge list
+# (needed for full arrays, where the number of edges is too large)
+implicit_graph=False
+
+# minibatch training with neighbour sampling over the graphs of all SAPs in graph_saps
+# (instead of full batch training on the graph of which_sap)
+minibatch_graph=False
+graph_saps=[which_sap] # indices in file_list/sap_list
+num_neighbors=(10,10) # neighbours sampled per node, for each GCN layer
+graph_batch_size=512 # seed baselines per minibatch
+
+# station incidence matrix and line graph (edge index: baseline id)
+B,edge_index_np=get_line_graph(file_list[which_sap],sap_list[which_sap],edges=not implicit_graph)
+if not implicit_graph:
+  edge_index=torch.tensor(edge_index_np,dtype=torch.long).contiguous()
+else:
+  edge_index=None
 
 # feature size = latent size
 Nfeat=L+Lt+Lt
 # edge attribute: None
 edge_attr=None
 # node attribute: latent features of each baseline
-node_data=torch.zeros((NBASE,Nfeat))
 # node label: distance from Kharmonic means : Kc values
-node_label=torch.zeros((NBASE,Kc))
-
-# iterate over each baselines
-with torch.no_grad():
- for nb in range(NBASE):#range(nbase):
-   baseline,patchx,patchy,x=get_data_for_baseline(file_list[which_sap],sap_list[which_sap],baseline_id=nb,patch_size=128,num_channels=num_in_channels,give_baseline=True)
-   x=x.cpu()
-   # get latent variable
-   x1,mu=net(x)
-   x11=(x-x1)/2
-   # vectorize
-   iy1=torch.flatten(x11,start_dim=2,end_dim=3)
-   iy2=torch.flatten(torch.transpose(x11,2,3),start_dim=2,end_dim=3)
-   yy1,yy1mu=net1D1(iy1)
-   yy2,yy2mu=net1D2(iy2)
-   Mu=torch.cat((mu,yy1mu,yy2mu),1)
-   # average over batch dimension : patchx x patchy
-   (nbatch,_)=Mu.shape
-   dist=torch.zeros(Kc)
-   for ck in range(Kc):
-     for cn in range(nbatch):
-       dist[ck]=dist[ck]+torch.sum(torch.linalg.norm(Mu[cn,:]-mod.M[ck,:],2))
-   dist=dist/nbatch
-   node_data[nb,:]=torch.mean(Mu,dim=0)
-   node_label[nb,:]=dist
-
-
+cascade=AutoEncoderCascade(net,net1D1,net1D2)
+node_data,node_label=get_node_features(file_list[which_sap],sap_list[which_sap],cascade,mod,
+   patch_size=patch_size,num_channels=num_in_channels,baseline_batch=baseline_batch,
+   cache_dir=feature_cache,cache_key=checkpoint_hash(['./net.model','./netT.model','./netF.model','./khm.model']),device=mydevice)
 
 graphdata=Data(x=node_data,edge_index=edge_index,y=node_label)
 
-print(f'Graph has {graphdata.num_nodes} nodes and {graphdata.num_edges} edges')
-print(f'has self loops {graphdata.contains_self_loops()} is undirected {graphdata.is_undirected()}')
+if not implicit_graph:
+  print(f'Graph has {graphdata.num_nodes} nodes and {graphdata.num_edges} edges')
+  print(f'has self loops {graphdata.contains_self_loops()} is undirected {graphdata.is_undirected()}')
+else:
+  print(f'Graph has {nbase} nodes and {B.shape[1]} stations')
 
 def visualize(h,color=None,epoch=None,loss=None):
     plt.figure(figsize=(7,7))
@@ -169,8 +133,9 @@ def visualize(h,color=None,epoch=None,loss=None):
     plt.show()
 
 
-G=to_networkx(graphdata,to_undirected=True)
-visualize(G)
+if not implicit_graph:
+  G=to_networkx(graphdata,to_undirected=True)
+  visualize(G)
 
 class GraphNet(nn.Module):
     def __init__(self,node_features=Nfeat,node_labels=Kc,hidden_channels=4):
@@ -183,16 +148,53 @@ class GraphNet(nn.Module):
         x=self.conv2(x,edge_index)
         return x
 
+class IncidenceGraphNet(nn.Module):
+    # same as GraphNet, message passing using the station incidence matrix B
+    def __init__(self,B,node_features=Nfeat,node_labels=Kc,hidden_channels=4):
+        super(IncidenceGraphNet,self).__init__()
+        self.propagation=IncidencePropagation(B)
+        self.conv1=IncidenceGCNConv(self.propagation,node_features,hidden_channels)
+        self.conv2=IncidenceGCNConv(self.propagation,hidden_channels,node_labels)
+    def forward(self,x,edge_index=None):
+        x=self.conv1(x)
+        x=x.relu()
+        x=self.conv2(x)
+        return x
+
 
-gnet=GraphNet(node_features=Nfeat,node_labels=Kc,hidden_channels=4)
+if not implicit_graph or minibatch_graph:
+  gnet=GraphNet(node_features=Nfeat,node_labels=Kc,hidden_channels=4)
+else:
+  gnet=IncidenceGraphNet(B,node_features=Nfeat,node_labels=Kc,hidden_channels=4)
 gnet.train()
 optimizer=torch.optim.Adam(gnet.parameters(),lr=0.01)
 criterion=torch.nn.MSELoss()
-for nepoch in range(200):
-  optimizer.zero_grad()
-  gx=gnet(graphdata.x,graphdata.edge_index)
-  loss=criterion(gx,graphdata.y)
-  loss.backward()
-  print(loss.data.item())
-  optimizer.step()
+if not minibatch_graph:
+  for nepoch in range(200):
+    optimizer.zero_grad()
+    gx=gnet(graphdata.x,graphdata.edge_index)
+    loss=criterion(gx,graphdata.y)
+    loss.backward()
+    print(loss.data.item())
+    optimizer.step()
+else:
+  graphs=list()
+  for ci in graph_saps:
+    Bi,_=get_line_graph(file_list[ci],sap_list[ci],edges=False)
+    xi,yi=get_node_features(file_list[ci],sap_list[ci],cascade,mod,
+      patch_size=patch_size,num_channels=num_in_channels,baseline_batch=baseline_batch,
+      cache_dir=feature_cache,cache_key=checkpoint_hash(['./net.model','./netT.model','./netF.model','./khm.model']),device=mydevice)
+    graphs.append((Bi,xi,yi))
+  sampler=LineGraphSampler(graphs,num_neighbors=num_neighbors,batch_size=graph_batch_size)
+  for nepoch in range(200):
+    epoch_loss=0
+    for x,edge_index,y,nseed in sampler:
+      optimizer.zero_grad()
+      gx=gnet(x,edge_index)
+      # loss only on the seeds, the other nodes are their neighbourhood
+      loss=criterion(gx[:nseed],y[:nseed])
+      loss.backward()
+      optimizer.step()
+      epoch_loss+=loss.data.item()*nseed
+    print(epoch_loss/sampler.num_nodes)
 
@@ -0,0 +1,143 @@
+import torch
+import math
+import contextlib
+import logging
+
+log = logging.getLogger()
+
+# Helpers for the training loop of kharmonic_lofar.py
+
+########################################################
+class AdaptiveADMM(object):
+  """
+  ADMM controller for the constraints x=x1, x11=x2, x11=x3 of the cascade:
+  Lagrange multipliers, primal and dual residuals, early stopping and
+  residual balancing of rho (Boyd et al., Distributed optimization and
+  statistical learning via ADMM, sec. 3.3 and 3.4.1).
+
+  primal residual r: ||(x-x1, x11-x2, x11-x3)||
+  dual residual s: rho ||(x1,x2,x3)-(x1,x2,x3) of the previous iteration||
+  stop when s <= sqrt(n) eps_abs + eps_rel ||y|| and either
+   r <= sqrt(n) eps_abs + eps_rel max(||(x,x11,x11)||,||(x1,x2,x3)||)
+   or r changed less than eps_rel r since the previous iteration
+   (the constraints are reconstructions, so r usually stalls above the tolerance)
+  rho is multiplied by tau if r > mu s, divided by tau if s > mu r
+  (the multipliers are not scaled, so they need no update when rho changes),
+  and carries over to the next minibatch
+
+  rho: (float) initial penalty
+  max_iter: (int) maximum ADMM iterations per minibatch
+  min_iter: (int) minimum ADMM iterations per minibatch (at least 2, the dual residual needs two)
+  eps_abs, eps_rel: (float) absolute (per element) and relative tolerance
+  mu, tau: (float) residual balancing parameters
+  rho_min, rho_max: (float) limits of rho
+  adaptive: (bool) if False, run max_iter iterations with constant rho (residuals are still tracked)
+  """
+  def __init__(self,rho=1.0,max_iter=10,min_iter=2,eps_abs=1e-3,eps_rel=1e-2,mu=10.0,tau=2.0,rho_min=1e-3,rho_max=1e3,adaptive=True):
+    self.max_iter=max_iter
+    self.min_iter=min_iter
+    self.eps_abs=eps_abs
+    self.eps_rel=eps_rel
+    self.mu=mu
+    self.tau=tau
+    self.rho_min=rho_min
+    self.rho_max=rho_max
+    self.adaptive=adaptive
+    self.rho=rho
+
+  def start(self,n,num_constraints=3,device='cpu'):
+    # new minibatch, n: number of elements in each constraint
+    self.n=n
+    self.y=[torch.zeros(n,requires_grad=False).to(device) for ci in range(num_constraints)]
+    self.previous=None
+    self.primal=float('inf')
+    self.dual=float('inf')
+    self.iterations=0
+    self.converged=False
+
+  def __iter__(self):
+    # ADMM iterations: 0,1,.. until converged or max_iter (update() called in each)
+    for admm in range(self.max_iter):
+      yield admm
+      if self.converged:
+        break
+
+  def update(self,lhs,rhs):
+    # lhs, rhs: lists of tensors (x,x11,x11) and (x1,x2,x3) of the constraints lhs=rhs,
+    # evaluated after the parameter update, return True if converged
+    with torch.no_grad():
+      residual=[(a-b).view(-1) for a,b in zip(lhs,rhs)]
+      primal=self.primal
+      self.primal=math.sqrt(sum([torch.sum(r*r).item() for r in residual]))
+      if self.previous is not None:
+        self.dual=self.rho*math.sqrt(sum([torch.sum(torch.pow(b.reshape(-1)-p,2)).item() for b,p in zip(rhs,self.previous)]))
+      self.previous=[b.detach().reshape(-1).clone() for b in rhs]
+      self.y=[y+self.rho*r for y,r in zip(self.y,residual)]
+      self.iterations+=1
+
+      if self.adaptive:
+        m=len(residual)
+        eps_primal=math.sqrt(m*self.n)*self.eps_abs+self.eps_rel*max(
+          math.sqrt(sum([torch.sum(a*a).item() for a in lhs])),
+          math.sqrt(sum([torch.sum(b*b).item() for b in rhs])))
+        eps_dual=math.sqrt(m*self.n)*self.eps_abs+self.eps_rel*math.sqrt(sum([torch.sum(y*y).item() for y in self.y]))
+        self.converged=self.iterations>=self.min_iter and self.dual<=eps_dual and (self.primal<=eps_primal or abs(primal-self.primal)<=self.eps_rel*self.primal)
+        # residual balancing (once there is a dual residual)
+        if self.iterations==1:
+          pass
+        elif self.primal>self.mu*self.dual:
+          self.rho=min(self.rho_max,self.rho*self.tau)
+        elif self.dual>self.mu*self.primal:
+          self.rho=max(self.rho_min,self.rho/self.tau)
+    return self.converged
+
+########################################################
+class StageScheduler(object):
+  """
+  Staged training: cycle through phases, each training only its own
+  submodels for a number of minibatches. The parameters of the other
+  submodels have requires_grad=False (and no .grad), so no gradients are
+  computed for them, and each phase has its own optimizer (state kept
+  between cycles).
+
+  phases: list of (name, list of modules, number of minibatches)
+  make_optimizer: function returning an optimizer for a list of parameters
+  frozen: list of modules that are not trained in any phase
+  """
+  def __init__(self,phases,make_optimizer,frozen=()):
+    self.phases=phases
+    for m in frozen:
+      for p in m.parameters():
+        p.requires_grad_(False)
+        p.grad=None
+    self.optimizers=[make_optimizer([p for m in modules for p in m.parameters()]) for (_,modules,_) in phases]
+    self.current=-1
+    self.remaining=0
+
+  def step(self):
+    # call before each minibatch, return the name of the current phase
+    if self.remaining==0:
+      self.current=(self.current+1)%len(self.phases)
+      self.remaining=self.phases[self.current][2]
+      for ci,(name,modules,_) in enumerate(self.phases):
+        for m in modules:
+          for p in m.parameters():
+            p.requires_grad_(ci==self.current)
+            if ci!=self.current:
+              p.grad=None
+      log.info(f"[StageScheduler] phase {self.phase}.")
+    self.remaining-=1
+    return self.phase
+
+  @property
+  def phase(self):
+    return self.phases[self.current][0]
+
+  @property
+  def optimizer(self):
+    return self.optimizers[self.current]
+
+  def grad(self,*names):
+    # context for a computation that only needs gradients if one of the
+    # phases in names is active (i.e. it depends on their parameters), no_grad otherwise
+    return contextlib.nullcontext() if self.phase in names else torch.no_grad()
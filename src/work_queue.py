@@ -0,0 +1,190 @@
+import sqlite3
+import socket
+import threading
+import os
+import sys
+import time
+import logging
+
+from lofar_tools import *
+from score_store import ScoreWriter, ScoreReader
+from score_server import load_models, Kc, L, Lt
+from ingest import score_range
+
+log = logging.getLogger()
+
+# Distributed evaluation: (file,SAP,baseline range) work units in a sqlite
+# queue (on a filesystem shared by all hosts). Any number of workers lease
+# units, keep their lease alive with heartbeats while scoring, and write the
+# results to their own score file (score_store.py). A unit whose lease expires
+# (worker died) or that failed is leased again, up to max_attempts times.
+# merge() collects the rows of all completed units into one score file.
+#
+#  python work_queue.py init queue.db data_path [baselines_per_unit]
+#  python work_queue.py worker queue.db out_dir [model_dir]   (run on each host/process)
+#  python work_queue.py status queue.db
+#  python work_queue.py merge queue.db scores.h5
+
+lease_time=300 # seconds a lease is valid without heartbeat
+heartbeat_interval=60 # seconds between heartbeats
+max_attempts=3 # a unit is marked failed after this many leases
+
+########################################################
+class WorkQueue(object):
+  """
+  sqlite backed queue of work units with leases.
+  units: id, file, SAP, first, last (baselines first..last-1), status (pending, leased, done, failed),
+   worker, lease expiry time, attempts, result file and row range in it
+
+  filename: (str) sqlite database
+  """
+  def __init__(self,filename):
+    # long timeout: many workers compete for the write lock
+    self.db=sqlite3.connect(filename,timeout=120,isolation_level=None)
+    self.db.execute('''CREATE TABLE IF NOT EXISTS units (id INTEGER PRIMARY KEY, file TEXT, SAP TEXT,
+      first INTEGER, last INTEGER, status TEXT, worker TEXT, expires REAL, attempts INTEGER,
+      result TEXT, row0 INTEGER, nrows INTEGER)''')
+    self.db.execute('CREATE INDEX IF NOT EXISTS units_status ON units (status)')
+
+  def add(self,file_list,sap_list,baselines_per_unit=256):
+    # split every (file,SAP) into units of baselines_per_unit baselines
+    self.db.execute('BEGIN IMMEDIATE')
+    for filename,SAP in zip(file_list,sap_list):
+      (nbase,_,_,_,_)=get_metadata(filename,SAP)
+      for first in range(0,nbase,baselines_per_unit):
+        self.db.execute("INSERT INTO units (file,SAP,first,last,status,attempts) VALUES (?,?,?,?,'pending',0)",
+          (filename,SAP,first,min(nbase,first+baselines_per_unit)))
+    self.db.execute('COMMIT')
+
+  def lease(self,worker):
+    # lease the next pending (or expired) unit, return (id,file,SAP,first,last) or None
+    now=time.time()
+    self.db.execute('BEGIN IMMEDIATE')
+    # expired leases go back to pending (or failed after max_attempts)
+    self.db.execute("UPDATE units SET status=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END WHERE status='leased' AND expires<?",(max_attempts,now))
+    unit=self.db.execute("SELECT id,file,SAP,first,last FROM units WHERE status='pending' ORDER BY id LIMIT 1").fetchone()
+    if unit:
+      self.db.execute("UPDATE units SET status='leased',worker=?,expires=?,attempts=attempts+1 WHERE id=?",(worker,now+lease_time,unit[0]))
+    self.db.execute('COMMIT')
+    return unit
+
+  def heartbeat(self,unit_id,worker):
+    # extend the lease, False if it was lost (expired and leased by another worker)
+    cur=self.db.execute("UPDATE units SET expires=? WHERE id=? AND worker=? AND status='leased'",(time.time()+lease_time,unit_id,worker))
+    return cur.rowcount==1
+
+  def complete(self,unit_id,worker,result,row0,nrows):
+    cur=self.db.execute("UPDATE units SET status='done',result=?,row0=?,nrows=? WHERE id=? AND worker=? AND status='leased'",(result,row0,nrows,unit_id,worker))
+    return cur.rowcount==1
+
+  def fail(self,unit_id,worker):
+    self.db.execute("UPDATE units SET status=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END WHERE id=? AND worker=?",(max_attempts,unit_id,worker))
+
+  def next_expiry(self):
+    # earliest expiry time of the leased units, None if no unit is leased
+    return self.db.execute("SELECT min(expires) FROM units WHERE status='leased'").fetchone()[0]
+
+  def status(self):
+    # number of units in each status
+    return dict(self.db.execute('SELECT status,count(*) FROM units GROUP BY status').fetchall())
+
+  def results(self):
+    # (result file,row0,nrows) of completed units, in unit order
+    return self.db.execute("SELECT result,row0,nrows FROM units WHERE status='done' ORDER BY id").fetchall()
+
+########################################################
+class Heartbeat(threading.Thread):
+  # keep the lease of a unit alive while it is processed
+  def __init__(self,queue_file,unit_id,worker):
+    super(Heartbeat,self).__init__(daemon=True)
+    self.queue_file=queue_file
+    self.unit_id=unit_id
+    self.worker=worker
+    self.stopped=threading.Event()
+    self.lost=False
+
+  def run(self):
+    # sqlite connections can not be shared between threads
+    queue=WorkQueue(self.queue_file)
+    while not self.stopped.wait(heartbeat_interval):
+      if not queue.heartbeat(self.unit_id,self.worker):
+        self.lost=True
+        return
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
+
+########################################################
+def worker(queue_file,out_dir,model_dir='.',device='cpu'):
+  # lease and score units until all units are done or failed
+  # (while other workers hold leases, wait: their units are leased again if they die)
+  name=f"{socket.gethostname()}-{os.getpid()}"
+  queue=WorkQueue(queue_file)
+  cascade,mod=load_models(model_dir,device=device)
+  os.makedirs(out_dir,exist_ok=True)
+  result=os.path.join(out_dir,f"scores_{name}.h5")
+  scores=ScoreWriter(result,K=Kc,latent_dim=L+Lt+Lt)
+  nunits=0
+  while True:
+    unit=queue.lease(name)
+    if not unit:
+      expires=queue.next_expiry()
+      if expires is None:
+        break
+      time.sleep(min(lease_time,max(1.0,expires-time.time()+1.0)))
+      continue
+    (unit_id,filename,SAP,first,last)=unit
+    log.info(f"[worker {name}] unit {unit_id}: {filename} SAP {SAP} baselines {first}..{last-1}.")
+    row0=scores.rows
+    heartbeat=Heartbeat(queue_file,unit_id,name)
+    heartbeat.start()
+    try:
+      nrows=score_range(filename,SAP,first,last,cascade,mod,scores,device=device)
+      heartbeat.stop()
+      if heartbeat.lost or not queue.complete(unit_id,name,result,row0,nrows):
+        # another worker has this unit now
+        log.warning(f"[worker {name}] lost the lease of unit {unit_id}.")
+        scores.truncate(row0)
+      else:
+        nunits+=1
+    except Exception:
+      heartbeat.stop()
+      log.exception(f"[worker {name}] unit {unit_id} failed.")
+      scores.truncate(row0)
+      queue.fail(unit_id,name)
+  scores.close()
+  log.info(f"[worker {name}] done, {nunits} units.")
+
+########################################################
+def merge(queue_file,score_file):
+  # copy the rows of all completed units (in unit order) into score_file
+  queue=WorkQueue(queue_file)
+  readers=dict()
+  out=None
+  for (result,row0,nrows) in queue.results():
+    if result not in readers:
+      readers[result]=ScoreReader(result)
+    rows=readers[result][row0:row0+nrows]
+    if out is None:
+      out=ScoreWriter(score_file,K=rows['distances'].shape[1],latent_dim=rows['latent'].shape[1],overwrite=True)
+    key=rows['key']
+    out.append(key[0,0],key[0,1],key[:,2],rows['distances'],rows['cluster'],rows['kharmonic'],rows['latent'],rows['recon_error'])
+  if out is not None:
+    out.close()
+  log.info(f"[merge] {queue.status()}")
+
+########################################################
+if __name__=='__main__':
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s %(message)s')
+  command,queue_file=sys.argv[1:3]
+  if command=='init':
+    file_list,sap_list=get_fileSAP(sys.argv[3])
+    WorkQueue(queue_file).add(file_list,sap_list,baselines_per_unit=int(sys.argv[4]) if len(sys.argv)>4 else 256)
+    print(WorkQueue(queue_file).status())
+  elif command=='worker':
+    worker(queue_file,sys.argv[3],model_dir=sys.argv[4] if len(sys.argv)>4 else '.',device=mydevice)
+  elif command=='status':
+    print(WorkQueue(queue_file).status())
+  elif command=='merge':
+    merge(queue_file,sys.argv[3])